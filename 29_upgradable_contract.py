@@ -6,6 +6,10 @@ def main():
     class DataEndlessWall(sp.Contract):
        def __init__(self, owner):
            self.data.wall_content = sp.big_map({})
+           sp.cast(self.data.wall_content, sp.big_map[sp.pair[sp.address, sp.nat], sp.record(text = sp.string,
+                                                                                                timestamp = sp.timestamp)])
+           self.data.nb_messages = sp.big_map({})
+           sp.cast(self.data.nb_messages, sp.big_map[sp.address, sp.nat])
            self.data.nb_calls = 0
            self.data.owner = owner
     
@@ -13,14 +17,11 @@ def main():
        def write_message(self, message, user):
            sp.cast(user, sp.address)
            assert self.data.owner == sp.sender
-           data = sp.record(text = "", timestamp = sp.timestamp(0))
-           if self.data.wall_content.contains(user):
-               data = self.data.wall_content[user]
-               data.text += "," + message
-           else:
-               data.text = message
-           data.timestamp = sp.now
-           self.data.wall_content[user] = data
+           index = sp.nat(0)
+           if self.data.nb_messages.contains(user):
+               index = self.data.nb_messages[user]
+           self.data.wall_content[(user, index)] = sp.record(text = message, timestamp = sp.now)
+           self.data.nb_messages[user] = index + 1
     
        @sp.entrypoint
        def update_owner(self, new_owner):
@@ -1,55 +1,9 @@
 import smartpy as sp
+from defi_contracts import defi
 
 @sp.module
 def main():
 
-    class FlashLoanTez(sp.Contract):
-        def __init__(self, owner, interest_rate):
-            self.data.owner = owner
-            self.data.interest_rate = interest_rate
-            self.data.in_progress = False
-            self.data.loan_amount = sp.tez(0)
-            self.data.borrower = owner
-            self.data.repaid = False
-
-        @sp.entrypoint
-        def deposit(self):
-            pass
-        
-        @sp.entrypoint
-        def borrow(self, loan_amount, callback):
-            assert not self.data.in_progress
-            self.data.in_progress = True
-
-            self.data.borrower = sp.sender
-            self.data.loan_amount = loan_amount
-            
-            sp.send(sp.sender, loan_amount)
-
-            sp.transfer((), sp.tez(0), callback)
-            
-            flash_loan_check_repaid = sp.contract(sp.unit, sp.self_address(), entrypoint="check_repaid").unwrap_some()
-            sp.transfer((), sp.tez(0), flash_loan_check_repaid)
-
-        @sp.entrypoint
-        def repay(self):
-            assert self.data.in_progress
-            assert sp.amount >= sp.split_tokens(self.data.loan_amount, 100 + self.data.interest_rate, 100)
-            self.data.repaid = True
-        
-        @sp.entrypoint
-        def check_repaid(self):
-            assert self.data.in_progress
-            assert self.data.repaid
-            self.data.in_progress = False
-
-        @sp.entrypoint
-        def claim(self):
-            assert sp.sender == self.data.owner
-            assert not self.data.in_progress
-            sp.send(sp.sender, sp.balance)
-    
-
     class Membership(sp.Contract):
         def __init__(self, membership_threshold):
             self.data.membership_threshold = membership_threshold
@@ -99,16 +53,47 @@ def main():
         def default(self):
             pass
 
+    class Borrower(sp.Contract):
+        def __init__(self, flash_loan, interest_rate, next_borrower):
+            # borrows and repays at once. When next_borrower is set, it is made to borrow
+            # too from within the callback, while the loan of this borrower is still open
+            self.data.flash_loan = flash_loan
+            self.data.interest_rate = interest_rate
+            self.data.next_borrower = next_borrower
+            sp.cast(self.data.next_borrower, sp.option[sp.address])
+            self.data.loan_amount = sp.tez(0)
+
+        @sp.entrypoint
+        def start(self, loan_amount):
+            self.data.loan_amount = loan_amount
+            flash_loan_borrow = sp.contract(sp.record(loan_amount = sp.mutez, callback = sp.contract[sp.unit]),
+                                             self.data.flash_loan,
+                                             entrypoint="borrow").unwrap_some()
+            sp.transfer(sp.record(loan_amount = loan_amount, callback = sp.self_entrypoint("callback")), sp.tez(0), flash_loan_borrow)
+
+        @sp.entrypoint
+        def callback(self):
+            assert sp.sender == self.data.flash_loan
+            if self.data.next_borrower.is_some():
+                next_borrower_start = sp.contract(sp.mutez, self.data.next_borrower.unwrap_some(), entrypoint = "start").unwrap_some()
+                sp.transfer(self.data.loan_amount, sp.tez(0), next_borrower_start)
+            flash_loan_repay = sp.contract(sp.unit, self.data.flash_loan, entrypoint="repay").unwrap_some()
+            sp.transfer((), sp.split_tokens(self.data.loan_amount, 100 + self.data.interest_rate, 100), flash_loan_repay)
+
+        @sp.entrypoint
+        def default(self):
+            pass
+
 @sp.add_test()
 def test():
     alice = sp.test_account("alice")
     bob = sp.test_account("bob")
-    scenario = sp.test_scenario("Test", main)
+    scenario = sp.test_scenario("Test", [defi, main])
 
     membership = main.Membership(sp.tez(10000))
     scenario += membership
 
-    flash_loan = main.FlashLoanTez(owner = alice.address, interest_rate = 1)
+    flash_loan = defi.FlashLoanTez(owner = alice.address, interest_rate = 1)
     scenario += flash_loan
     flash_loan.deposit(_sender = alice, _amount = sp.tez(100000))
     
@@ -116,4 +101,34 @@ def test():
     scenario += attacker
     attacker.impersonate_rich_person(_sender = bob, _amount = sp.tez(500))
 
+@sp.add_test()
+def test_many_borrowers():
+    alice = sp.test_account("alice")
+    scenario = sp.test_scenario("Many borrowers", [defi, main])
+    flash_loan = defi.FlashLoanTez(owner = alice.address, interest_rate = 1)
+    scenario += flash_loan
+    flash_loan.deposit(_sender = alice, _amount = sp.tez(100000))
 
+    scenario.h2("Sequential borrowers")
+    nb_borrowers = 50
+    for i in range(nb_borrowers):
+        borrower = main.Borrower(flash_loan = flash_loan.address, interest_rate = 1, next_borrower = None)
+        scenario += borrower
+        # the amount sent pays the interest
+        borrower.start(sp.tez(1000), _sender = alice, _amount = sp.tez(10))
+    scenario.verify(flash_loan.balance == sp.tez(100000 + 10 * nb_borrowers))
+
+    scenario.h2("A loan taken while another one is open")
+    inner = main.Borrower(flash_loan = flash_loan.address, interest_rate = 1, next_borrower = None)
+    scenario += inner
+    inner.default(_sender = alice, _amount = sp.tez(10))
+    outer = main.Borrower(flash_loan = flash_loan.address, interest_rate = 1, next_borrower = sp.Some(inner.address))
+    scenario += outer
+    outer.start(sp.tez(1000), _sender = alice, _amount = sp.tez(10))
+    scenario.verify(flash_loan.balance == sp.tez(100000 + 10 * (nb_borrowers + 2)))
+
+    scenario.h2("A borrower that can't pay the interest")
+    insolvent = main.Borrower(flash_loan = flash_loan.address, interest_rate = 1, next_borrower = None)
+    scenario += insolvent
+    insolvent.start(sp.tez(1000), _sender = alice, _valid = False)
+    flash_loan.check_repaid(alice.address, _sender = alice, _valid = False)
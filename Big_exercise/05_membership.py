@@ -1,117 +1,21 @@
 import smartpy as sp
+from defi_contracts import defi
 
 @sp.module
 def main():
 
     param_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
 
-    class Ledger(sp.Contract):
-        def __init__(self, owner, total_supply):
-            self.data.balances = sp.big_map({ owner : total_supply })
-            self.data.allowances = sp.big_map({})
-          
-        @sp.entrypoint
-        def transfer(self, source, destination, amount):
-            if source != sp.sender:
-                allowed = self.data.allowances[(source, sp.sender)]
-                assert allowed >= amount
-                self.data.allowances[(source, sp.sender)] = sp.as_nat(allowed - amount)
-            assert self.data.balances[source] >= amount
-            self.data.balances[source] = sp.as_nat(self.data.balances[source] - amount)
-            if not self.data.balances.contains(destination):
-                self.data.balances[destination] = sp.nat(0)
-            self.data.balances[destination] += amount
-
-        @sp.onchain_view
-        def get_balance(self, user):
-            sp.cast(user, sp.address)
-            return self.data.balances[user]
-
-        @sp.entrypoint
-        def allow(self, operator, amount):
-            if not self.data.allowances.contains((sp.sender, operator)):
-                self.data.allowances[(sp.sender, operator)] = 0
-            self.data.allowances[(sp.sender, operator)] += amount
-    
-    class LiquidityPool(sp.Contract):
-        def __init__(self, owner, ledger):
-            self.data.ledger = ledger
-            self.data.ledger_transfer = None
-            self.data.owner = owner
-            self.data.K = sp.tez(0)
-            self.data.tokens_owned = sp.nat(0)
-            # tokens_owned * sp.balance = K -> should always be true
-
-        @sp.entrypoint
-        def provide_liquidity(self, deposited_tokens):
-            assert sp.sender == self.data.owner
-            assert self.data.K == sp.tez(0)
-            self.data.K = sp.mul(sp.balance, deposited_tokens)
-
-            self.data.tokens_owned = deposited_tokens
-
-            self.data.ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer")
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens), sp.tez(0), self.data.ledger_transfer.unwrap_some())
-            
-        @sp.entrypoint
-        def withdraw_liquidity(self):
-            assert sp.sender == self.data.owner
-            sp.send(sp.sender, sp.balance)
-            
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), self.data.ledger_transfer.unwrap_some())
-
-            self.data.tokens_owned = sp.nat(0)
-            self.data.K = sp.tez(0)
-
-        
-        @sp.entrypoint
-        def sell_tokens(self, nb_tokens_sold, min_tez_requested):
-            ratio = sp.ediv(self.data.K, self.data.tokens_owned + nb_tokens_sold).unwrap_some()
-            tez_obtained = sp.balance - sp.fst(ratio)
-            assert tez_obtained >= min_tez_requested
-
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), self.data.ledger_transfer.unwrap_some())
-
-            self.data.tokens_owned += nb_tokens_sold
-            sp.send(sp.sender, tez_obtained)
-
-        @sp.entrypoint
-        def buy_tokens(self, min_tokens_bought):
-            sp.cast(min_tokens_bought, sp.nat)
-            tokens_obtained = sp.as_nat(self.data.tokens_owned - sp.fst(sp.ediv(self.data.K, sp.balance).unwrap_some()))
-            assert tokens_obtained >= min_tokens_bought
-
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), self.data.ledger_transfer.unwrap_some())
-
-            self.data.tokens_owned = sp.as_nat(self.data.tokens_owned - tokens_obtained)
-            
-
-        @sp.onchain_view
-        def get_token_price(self):
-            # returns what we would get if we sold one token
-            ratio1 = sp.ediv(self.data.K, self.data.tokens_owned).unwrap_some()
-            ratio2 = sp.ediv(self.data.K, sp.as_nat(self.data.tokens_owned - 1)).unwrap_some()
-            trace ("The current value of K is:")
-            trace(self.data.K)
-            trace("The pool owns this amount of tokens:")
-            trace(self.data.tokens_owned)
-            trace("The balance of the pool is:")
-            trace(sp.balance)
-            trace("The ratios before and after a potential purchase of 1 token would be:")
-            trace(ratio1)
-            trace(ratio2)
-            token_price = sp.fst(ratio2) - sp.fst(ratio1)
-            trace("The price of the token returned is:")
-            trace(token_price)
-            return token_price
-
     class Membership(sp.Contract):
-        def __init__(self, membership_price, owner, ledger, liquidity_pool):
+        def __init__(self, membership_price, owner, ledger, liquidity_pool, twap_window):
             self.data.owner = owner
             self.data.membership_price = membership_price
             self.data.members = sp.set()
             self.data.ledger = ledger
             self.data.liquidity_pool = liquidity_pool
+            # tokens are valued at their average price over the last twap_window seconds
+            self.data.twap_window = twap_window
+            sp.cast(self.data.twap_window, sp.nat)
 
         @sp.entrypoint
         def join(self):
@@ -123,7 +27,7 @@ def main():
         @sp.entrypoint
         def join_with_tokens(self, nb_tokens):
             sp.cast(nb_tokens, sp.nat)
-            token_price =  sp.view("get_token_price", self.data.liquidity_pool, (), sp.mutez).unwrap_some();
+            token_price = sp.view("get_twap", self.data.liquidity_pool, self.data.twap_window, sp.mutez).unwrap_some()
             assert sp.mul(token_price, nb_tokens) > self.data.membership_price
             ledger_contract = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
             sp.transfer(sp.record(source = sp.sender, destination = self.data.owner, amount = nb_tokens), sp.tez(0), ledger_contract)
@@ -135,21 +39,112 @@ def test():
     bob = sp.test_account("bob")
     carl = sp.test_account("carl")
     
-    scenario = sp.test_scenario("Test", main)
-    ledger = main.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario = sp.test_scenario("Test", [defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
     scenario += ledger
     
-    liquidity_pool = main.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    liquidity_pool = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
     scenario += liquidity_pool
 
     ledger.allow(operator = liquidity_pool.address, amount = 2000, _sender = alice)
     liquidity_pool.provide_liquidity(2000, _sender = alice, _amount = sp.tez(2000))
     
-    membership = main.Membership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address)
+    membership = main.Membership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address,
+                                 twap_window = 3600)
     scenario += membership
 
     membership.join(_sender = carl, _amount = sp.tez(1000))
 
     ledger.transfer(source = alice.address, destination = carl.address, amount = 2000, _sender = alice)
     ledger.allow(operator = membership.address, amount = 1000, _sender = carl)
-    membership.join_with_tokens(1000, _sender = carl)
+    # the pool needs to have existed for the whole window
+    membership.join_with_tokens(1000, _sender = carl, _now = sp.timestamp(1800), _valid = False)
+    membership.join_with_tokens(1000, _sender = carl, _now = sp.timestamp(3600))
+
+@sp.add_test()
+def test_transfer_batch():
+    alice = sp.test_account("alice")
+    recipients = [sp.test_account("recipient_%d" % i).address for i in range(500)]
+
+    # gas per recipient is the gas of each transfer_batch call divided by its size
+    scenario = sp.test_scenario("Transfer batch gas per recipient", [defi, main])
+    for nb_recipients in [1, 10, 100, 500]:
+        scenario.h2("Batch paying %d recipients" % nb_recipients)
+        ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
+        scenario += ledger
+        txs = [sp.record(destination = recipient, amount = 10) for recipient in recipients[:nb_recipients]]
+        ledger.transfer_batch([sp.record(source = alice.address, txs = txs)], _sender = alice)
+        scenario.verify(ledger.data.balances[alice.address] == 1000000 - 10 * nb_recipients)
+        scenario.verify(ledger.data.balances[recipients[nb_recipients - 1]] == 10)
+
+@sp.add_test()
+def test_twap():
+    alice = sp.test_account("alice")
+    bob = sp.test_account("bob")
+    dave = sp.test_account("dave")
+    scenario = sp.test_scenario("Membership priced with the average price", [defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario += ledger
+    liquidity_pool = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += liquidity_pool
+    ledger.allow(operator = liquidity_pool.address, amount = 2000, _sender = alice)
+    # the price of a token is 1000500 mutez
+    liquidity_pool.provide_liquidity(2000, _sender = alice, _amount = sp.tez(2000), _now = sp.timestamp(0))
+    membership = main.Membership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address,
+                                 twap_window = 3600)
+    scenario += membership
+    ledger.transfer(source = alice.address, destination = dave.address, amount = 450, _sender = alice)
+    ledger.allow(operator = membership.address, amount = 450, _sender = dave)
+
+    scenario.h2("A purchase pushing the price up doesn't move the average of its block")
+    liquidity_pool.buy_tokens(600, _sender = bob, _amount = sp.tez(1000), _now = sp.timestamp(3600))
+    # the spot price is now 2252816 mutez, 450 tokens would be worth more than 1000 tez
+    scenario.verify(liquidity_pool.data.tokens_owned == 1333)
+    membership.join_with_tokens(450, _sender = dave, _now = sp.timestamp(3600), _valid = False)
+
+    scenario.h2("Once the higher price has lasted for the whole window, it is the average")
+    membership.join_with_tokens(450, _sender = dave, _now = sp.timestamp(7200))
+    scenario.verify(membership.data.members.contains(dave.address))
+
+@sp.add_test()
+def test_nearly_drained_pool():
+    alice = sp.test_account("alice")
+    bob = sp.test_account("bob")
+    carl = sp.test_account("carl")
+    scenario = sp.test_scenario("Trading down to the last token of the pool", [defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario += ledger
+    liquidity_pool = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += liquidity_pool
+    ledger.allow(operator = liquidity_pool.address, amount = 3, _sender = alice)
+    liquidity_pool.provide_liquidity(3, _sender = alice, _amount = sp.tez(3), _now = sp.timestamp(0))
+
+    liquidity_pool.buy_tokens(2, _sender = bob, _amount = sp.tez(3), _now = sp.timestamp(10))
+    scenario.verify(liquidity_pool.data.tokens_owned == 1)
+    # K - K / 2: selling one more token would bring 4.5 tez out of the 6 tez of the pool
+    scenario.verify(liquidity_pool.get_token_price() == sp.mutez(4500000))
+    # trades still go through with a single token left, which they did not while
+    # the price divided by tokens_owned - 1
+    liquidity_pool.buy_tokens(0, _sender = carl, _amount = sp.tez(1), _now = sp.timestamp(20))
+    ledger.allow(operator = liquidity_pool.address, amount = 1, _sender = bob)
+    liquidity_pool.sell_tokens(nb_tokens_sold = 1, min_tez_requested = sp.mutez(2500000), _sender = bob, _now = sp.timestamp(30))
+    scenario.verify(liquidity_pool.data.tokens_owned == 2)
+    scenario.verify(liquidity_pool.get_twap(20) > sp.tez(0))
+
+
+@sp.add_test()
+def test_expensive_token_twap():
+    alice = sp.test_account("alice")
+    bob = sp.test_account("bob")
+    scenario = sp.test_scenario("TWAP of an expensive token over years", [defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario += ledger
+    liquidity_pool = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += liquidity_pool
+    ledger.allow(operator = liquidity_pool.address, amount = 4, _sender = alice)
+    liquidity_pool.provide_liquidity(4, _sender = alice, _amount = sp.tez(400000), _now = sp.timestamp(0))
+    # about 1.3e11 mutez per token: over ten years the TWAP sums reach 4e19 mutez * seconds,
+    # more than a mutez can hold, and trades still go through as the sums are nats
+    scenario.verify(liquidity_pool.get_token_price() == sp.mutez(133333333333))
+    liquidity_pool.buy_tokens(0, _sender = bob, _amount = sp.mutez(1), _now = sp.timestamp(315360000))
+    scenario.verify(liquidity_pool.get_twap(600) == sp.mutez(133333333333))
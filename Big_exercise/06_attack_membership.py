@@ -1,42 +1,19 @@
 import smartpy as sp
+from contract_handles import handles
+from defi_contracts import defi
 
 @sp.module
 def main():
+    import handles
 
     param_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
 
-    class Ledger(sp.Contract):
-        def __init__(self, owner, total_supply):
-            self.data.balances = sp.big_map({ owner : total_supply })
-            self.data.allowances = sp.big_map({})
-          
-        @sp.entrypoint
-        def transfer(self, source, destination, amount):
-            if source != sp.sender:
-                allowed = self.data.allowances[(source, sp.sender)]
-                assert allowed >= amount
-                self.data.allowances[(source, sp.sender)] = sp.as_nat(allowed - amount)
-            assert self.data.balances[source] >= amount
-            self.data.balances[source] = sp.as_nat(self.data.balances[source] - amount)
-            if not self.data.balances.contains(destination):
-                self.data.balances[destination] = sp.nat(0)
-            self.data.balances[destination] += amount
-
-        @sp.onchain_view
-        def get_balance(self, user):
-            sp.cast(user, sp.address)
-            return self.data.balances[user]
-
-        @sp.entrypoint
-        def allow(self, operator, amount):
-            if not self.data.allowances.contains((sp.sender, operator)):
-                self.data.allowances[(sp.sender, operator)] = 0
-            self.data.allowances[(sp.sender, operator)] += amount
-    
     class LiquidityPool(sp.Contract):
         def __init__(self, owner, ledger):
             self.data.ledger = ledger
+            # typed address of the transfer entrypoint of the ledger, see contract_handles.py
             self.data.ledger_transfer = None
+            sp.cast(self.data.ledger_transfer, sp.option[sp.address])
             self.data.owner = owner
             self.data.K = sp.tez(0)
             self.data.tokens_owned = sp.nat(0)
@@ -50,15 +27,20 @@ def main():
 
             self.data.tokens_owned = deposited_tokens
 
-            self.data.ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer")
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens), sp.tez(0), self.data.ledger_transfer.unwrap_some())
-            
+            self.data.ledger_transfer = sp.Some(handles.resolve_ledger_transfer(self.data.ledger))
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
+
+        @sp.entrypoint
+        def refresh_handles(self):
+            assert sp.sender == self.data.owner
+            self.data.ledger_transfer = sp.Some(handles.resolve_ledger_transfer(self.data.ledger))
+
         @sp.entrypoint
         def withdraw_liquidity(self):
             assert sp.sender == self.data.owner
             sp.send(sp.sender, sp.balance)
             
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), self.data.ledger_transfer.unwrap_some())
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
 
             self.data.tokens_owned = sp.nat(0)
             self.data.K = sp.tez(0)
@@ -70,7 +52,7 @@ def main():
             tez_obtained = sp.balance - sp.fst(ratio)
             assert tez_obtained >= min_tez_requested
 
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), self.data.ledger_transfer.unwrap_some())
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
 
             self.data.tokens_owned += nb_tokens_sold
             sp.send(sp.sender, tez_obtained)
@@ -81,7 +63,7 @@ def main():
             tokens_obtained = sp.as_nat(self.data.tokens_owned - sp.fst(sp.ediv(self.data.K, sp.balance).unwrap_some()))
             assert tokens_obtained >= min_tokens_bought
 
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), self.data.ledger_transfer.unwrap_some())
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
 
             self.data.tokens_owned = sp.as_nat(self.data.tokens_owned - tokens_obtained)
             
@@ -105,51 +87,6 @@ def main():
             trace(token_price)
             return token_price
 
-    class FlashLoanTez(sp.Contract):
-        def __init__(self, owner, ledger, interest_rate):
-            self.data.owner = owner
-            self.data.interest_rate = interest_rate
-            self.data.in_progress = False
-            self.data.loan_amount = sp.tez(0)
-            self.data.borrower = owner
-            self.data.repaid = False
-
-        @sp.entrypoint
-        def deposit(self):
-            pass
-        
-        @sp.entrypoint
-        def borrow(self, loan_amount, callback):
-            assert not self.data.in_progress
-            self.data.in_progress = True
-
-            self.data.borrower = sp.sender
-            self.data.loan_amount = loan_amount
-            sp.send(sp.sender, loan_amount)
-
-            sp.transfer((), sp.tez(0), callback)
-            
-            flash_loan_check_repaid = sp.contract(sp.unit, sp.self_address(), entrypoint="check_repaid").unwrap_some()
-            sp.transfer((), sp.tez(0), flash_loan_check_repaid)
-
-        @sp.entrypoint
-        def repay(self):
-            assert self.data.in_progress
-            assert sp.amount >= sp.split_tokens(self.data.loan_amount, 100 + self.data.interest_rate, 100)
-            self.data.repaid = True
-        
-        @sp.entrypoint
-        def check_repaid(self):
-            assert self.data.in_progress
-            assert self.data.repaid
-            self.data.in_progress = False
-
-        @sp.entrypoint
-        def claim(self):
-            assert sp.sender == self.data.owner
-            assert not self.data.in_progress
-            sp.send(sp.sender, sp.balance)
-    
     class FlashLoan(sp.Contract):
         def __init__(self, owner, ledger, interest_rate):
             self.data.ledger = ledger
@@ -157,14 +94,19 @@ def main():
             self.data.interest_rate = interest_rate
             self.data.in_progress = False
             self.data.loan_amount = sp.nat(0)
-            self.data.ledger_contract_opt = None
+            self.data.ledger_transfer = None
+            sp.cast(self.data.ledger_transfer, sp.option[sp.address])
             self.data.tokens_owned = sp.nat(0)
             self.data.borrower = owner
 
+        @sp.entrypoint
+        def refresh_handles(self):
+            assert sp.sender == self.data.owner
+            self.data.ledger_transfer = sp.Some(handles.resolve_ledger_transfer(self.data.ledger))
+
         @sp.entrypoint
         def deposit(self, tokens_deposited):
-            self.data.ledger_contract_opt = sp.contract(param_type, self.data.ledger, entrypoint="transfer")
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = tokens_deposited), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = tokens_deposited), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
             self.data.tokens_owned = tokens_deposited
         
         @sp.entrypoint
@@ -174,27 +116,26 @@ def main():
 
             self.data.borrower = sp.sender
             
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = loan_amount), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = loan_amount), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
             self.data.loan_amount = loan_amount
 
             #sp.cast(callback, ..)
             sp.transfer((), sp.tez(0), callback)
             
-            flash_loan_check_repaid = sp.contract(sp.unit, sp.self_address(), entrypoint="check_repaid").unwrap_some()
-            sp.transfer((), sp.tez(0), flash_loan_check_repaid)
+            sp.transfer((), sp.tez(0), sp.self_entrypoint("check_repaid"))
 
         @sp.entrypoint
         def check_repaid(self):
             assert self.data.in_progress
             amount_repaid = (self.data.loan_amount * (100 + self.data.interest_rate)) / 100
-            sp.transfer(sp.record(source = self.data.borrower, destination = sp.self_address(), amount = amount_repaid), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
+            sp.transfer(sp.record(source = self.data.borrower, destination = sp.self_address(), amount = amount_repaid), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
             self.data.in_progress = False
 
         @sp.entrypoint
         def claim(self):
             assert sp.sender == self.data.owner
             assert not self.data.in_progress
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
             self.data.tokens_owned = sp.nat(0)
 
     class Membership(sp.Contract):
@@ -203,8 +144,15 @@ def main():
             self.data.membership_price = membership_price
             self.data.members = sp.set()
             self.data.ledger = ledger
+            self.data.ledger_transfer = None
+            sp.cast(self.data.ledger_transfer, sp.option[sp.address])
             self.data.liquidity_pool = liquidity_pool
 
+        @sp.entrypoint
+        def refresh_handles(self):
+            assert sp.sender == self.data.owner
+            self.data.ledger_transfer = sp.Some(handles.resolve_ledger_transfer(self.data.ledger))
+
         @sp.entrypoint
         def join(self):
             assert sp.amount == self.data.membership_price
@@ -217,8 +165,22 @@ def main():
             sp.cast(nb_tokens, sp.nat)
             token_price =  sp.view("get_token_price", self.data.liquidity_pool, (), sp.mutez).unwrap_some();
             assert sp.mul(token_price, nb_tokens) > self.data.membership_price
-            ledger_contract = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
-            sp.transfer(sp.record(source = sp.sender, destination = self.data.owner, amount = nb_tokens), sp.tez(0), ledger_contract)
+            sp.transfer(sp.record(source = sp.sender, destination = self.data.owner, amount = nb_tokens), sp.tez(0), handles.ledger_transfer(self.data.ledger_transfer))
+            self.data.members.add(sp.sender)
+
+    class LookupMembership(Membership):
+        # the same Membership, looking the transfer entrypoint of the ledger up by name on
+        # each call, to compare the gas of both ways in test_handles_gas
+        def __init__(self, membership_price, owner, ledger, liquidity_pool):
+            Membership.__init__(self, membership_price, owner, ledger, liquidity_pool)
+
+        @sp.entrypoint
+        def join_with_tokens(self, nb_tokens):
+            sp.cast(nb_tokens, sp.nat)
+            token_price =  sp.view("get_token_price", self.data.liquidity_pool, (), sp.mutez).unwrap_some();
+            assert sp.mul(token_price, nb_tokens) > self.data.membership_price
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = self.data.owner, amount = nb_tokens), sp.tez(0), ledger_transfer)
             self.data.members.add(sp.sender)
 
     class Attacker(sp.Contract):
@@ -237,7 +199,7 @@ def main():
             flash_loan_borrow = sp.contract(sp.record(loan_amount = sp.mutez, callback = sp.contract[sp.unit]),
                                              self.data.flash_loan,
                                              entrypoint="borrow").unwrap_some()
-            part2_contract = sp.contract(sp.unit, sp.self_address(), entrypoint = "attack_part_2").unwrap_some()
+            part2_contract = sp.self_entrypoint("attack_part_2")
             trace("We borrow this number of tez from the flash_loan. It will then call part 2 of the attack")
             trace(self.data.loan_amount)
             sp.transfer(sp.record(loan_amount = self.data.loan_amount, callback = part2_contract), sp.tez(0), flash_loan_borrow)
@@ -251,7 +213,7 @@ def main():
             trace(self.data.expected_bought_tokens)
             sp.transfer(self.data.expected_bought_tokens, self.data.loan_amount, liquidity_pool_buy_tokens)    
 
-            part3_contract = sp.contract(sp.unit, sp.self_address(), entrypoint = "attack_part_3").unwrap_some()
+            part3_contract = sp.self_entrypoint("attack_part_3")
             trace("We call part3 in a transaction so that it takes place after the purchase is effective")
             sp.transfer((), sp.tez(0), part3_contract)
 
@@ -289,8 +251,8 @@ def main():
 def test():
     alice = sp.test_account("alice")
     bob = sp.test_account("bob")
-    scenario = sp.test_scenario("Test", main)
-    ledger = main.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario = sp.test_scenario("Test", [handles, defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
 
     scenario += ledger
 
@@ -303,8 +265,9 @@ def test():
     
     membership = main.Membership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address)
     scenario += membership
+    membership.refresh_handles(_sender = alice)
 
-    flash_loan = main.FlashLoanTez(owner = alice.address, ledger = ledger.address, interest_rate = 1)
+    flash_loan = defi.FlashLoanTez(owner = alice.address, interest_rate = 1)
     scenario += flash_loan
 
     flash_loan.deposit(_sender = alice, _amount = sp.tez(100000))
@@ -316,3 +279,35 @@ def test():
     ledger.allow(operator = membership.address, amount = 30, _sender = attacker.address)
     
     attacker.attack(_sender = bob, _amount = sp.tez(500))
+
+@sp.add_test()
+def test_handles_gas():
+    # benchmark of the two ways of calling the ledger: run tools/benchmark.py on this
+    # file, in mockup mode, and compare the gas of the join_with_tokens steps of
+    # the membership with a stored handle and of the one with a lookup per call
+    alice = sp.test_account("alice")
+    members = [sp.test_account("member_%d" % i) for i in range(3)]
+    scenario = sp.test_scenario("Entrypoint handles against lookups", [handles, defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario += ledger
+    liquidity_pool = main.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += liquidity_pool
+    ledger.allow(operator = liquidity_pool.address, amount = 2000, _sender = alice)
+    liquidity_pool.provide_liquidity(2000, _sender = alice, _amount = sp.tez(2000))
+    with_handle = main.Membership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address)
+    scenario += with_handle
+    with_lookup = main.LookupMembership(membership_price = sp.tez(1000), owner = alice.address, ledger = ledger.address, liquidity_pool = liquidity_pool.address)
+    scenario += with_lookup
+    # the handle must be set, by the owner only, before the ledger can be called
+    ledger.transfer(source = alice.address, destination = members[0].address, amount = 1000, _sender = alice)
+    ledger.allow(operator = with_handle.address, amount = 1000, _sender = members[0])
+    with_handle.join_with_tokens(1000, _sender = members[0], _valid = False, _exception = "HANDLES_NOT_SET")
+    with_handle.refresh_handles(_sender = members[0], _valid = False)
+    with_handle.refresh_handles(_sender = alice)
+    for membership in [with_handle, with_lookup]:
+        for member in members:
+            ledger.transfer(source = alice.address, destination = member.address, amount = 1000, _sender = alice)
+            ledger.allow(operator = membership.address, amount = 1000, _sender = member)
+            membership.join_with_tokens(1000, _sender = member)
+        scenario.verify(sp.len(membership.data.members) == 3)
+    scenario.verify(ledger.data.balances[alice.address] == 1000000 - 2000 - 1000)
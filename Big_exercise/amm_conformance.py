@@ -0,0 +1,44 @@
+import numpy as np
+import smartpy as sp
+from defi_contracts import defi
+
+from tools import amm_simulator as sim
+
+# Conformance of tools/amm_simulator.py with defi.LiquidityPool: a seeded
+# sequence of trades is applied to both, and every trade, balance,
+# tokens_owned and get_token_price must match exactly.
+# Run it from the root of the repository: PYTHONPATH=. python Big_exercise/amm_conformance.py
+
+@sp.add_test()
+def test():
+    alice = sp.test_account("alice")
+    carl = sp.test_account("carl")
+    scenario = sp.test_scenario("AMM simulator conformance", defi)
+    ledger = defi.Ledger(owner = alice.address, total_supply = 100000000)
+    scenario += ledger
+    liquidity_pool = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += liquidity_pool
+
+    ledger.allow(operator = liquidity_pool.address, amount = 1000000, _sender = alice)
+    liquidity_pool.provide_liquidity(1000000, _sender = alice, _amount = sp.tez(1000))
+    pool = sim.provide_liquidity(1000 * 10**6, 1000000)
+
+    ledger.transfer(source = alice.address, destination = carl.address, amount = 10000000, _sender = alice)
+    ledger.allow(operator = liquidity_pool.address, amount = 10000000, _sender = carl)
+
+    rng = np.random.default_rng(0)
+    for _ in range(40):
+        if rng.integers(2) == 0:
+            amount = int(rng.integers(1, 50 * 10**6))
+            tokens, valid, pool = sim.buy_tokens(pool, amount)
+            assert valid
+            liquidity_pool.buy_tokens(int(tokens), _sender = carl, _amount = sp.mutez(amount))
+        else:
+            nb_tokens_sold = int(rng.integers(1, 50000))
+            tez, valid, pool = sim.sell_tokens(pool, nb_tokens_sold)
+            assert valid
+            liquidity_pool.sell_tokens(nb_tokens_sold = nb_tokens_sold, min_tez_requested = sp.mutez(int(tez)), _sender = carl)
+        price, valid = sim.get_token_price(pool)
+        scenario.verify(liquidity_pool.balance == sp.mutez(int(pool.balance)))
+        scenario.verify(liquidity_pool.data.tokens_owned == int(pool.tokens_owned))
+        scenario.verify(liquidity_pool.get_token_price() == sp.mutez(int(price)))
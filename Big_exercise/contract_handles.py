@@ -0,0 +1,24 @@
+import smartpy as sp
+
+# Typed entrypoint handles shared by the contracts of the Big exercise.
+#
+# A value of type sp.contract cannot be kept in storage, so a contract can't
+# keep the entrypoints it calls already resolved. What it can keep is the
+# typed address of the entrypoint ("KT1...%transfer"): resolve_ledger_transfer
+# checks once, when the contract is configured, that the ledger has a transfer
+# entrypoint of the expected type, and returns that address. Each call then
+# turns it back into a contract with ledger_transfer, which still costs a
+# CONTRACT instruction: test_handles_gas in 06_attack_membership.py measures
+# it against looking the entrypoint up by name on every call.
+
+@sp.module
+def handles():
+    transfer_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
+
+    def resolve_ledger_transfer(ledger):
+        # fails unless ledger has a transfer entrypoint of the expected type
+        sp.cast(ledger, sp.address)
+        return sp.to_address(sp.contract(transfer_type, ledger, entrypoint = "transfer").unwrap_some())
+
+    def ledger_transfer(handle):
+        return sp.contract(transfer_type, handle.unwrap_some(error = "HANDLES_NOT_SET")).unwrap_some()
@@ -1,5 +1,10 @@
+import json
+import sqlite3
+
 import smartpy as sp
 
+from tools import indexer, scenario_operations
+
 @sp.module
 def main():
 
@@ -8,6 +13,8 @@ def main():
                                    operator = sp.address,
                                    token_id = sp.nat
                                   ).layout(("owner", ("operator", "token_id")))
+    balance_of_request_type:type = sp.record(owner = sp.address, token_id = sp.nat).layout(("owner", "token_id"))
+    balance_of_response_type:type = sp.record(request = balance_of_request_type, balance = sp.nat).layout(("request", "balance"))
     
     my_variant:type = sp.variant(add_operator = sp.record(owner = sp.address, operator = sp.address, token_id = sp.address),
                remove_operator = sp.record(owner = sp.address, operator = sp.address, token_id = sp.address))
@@ -16,31 +23,56 @@ def main():
         
         def __init__(self):
             self.data.tokens = sp.big_map()
+            self.data.token_metadata = sp.big_map()
+            sp.cast(self.data.token_metadata, sp.big_map[sp.nat, sp.string])
+            # one key per (owner, operator, token_id), so that operator updates and
+            # checks never load or rewrite the token itself
+            self.data.operators = sp.big_map()
+            sp.cast(self.data.operators, sp.big_map[operator_type, sp.unit])
             self.data.next_token_id = sp.nat(1)
+            # token ids held by each owner, so that wallets can list holdings in one call
+            self.data.owned_tokens = sp.big_map()
+            sp.cast(self.data.owned_tokens, sp.big_map[sp.address, sp.set[sp.nat]])
 
         @sp.entrypoint
         def mint(self, metadata):
             sp.cast(metadata, sp.string)
-            operators = sp.set()
-            sp.cast(operators, sp.set[operator_type])
-            self.data.tokens[self.data.next_token_id] = sp.record(owner = sp.sender, metadata = metadata, operators = sp.set())
+            self.data.tokens[self.data.next_token_id] = sp.record(owner = sp.sender)
+            self.data.token_metadata[self.data.next_token_id] = metadata
+            if not self.data.owned_tokens.contains(sp.sender):
+                self.data.owned_tokens[sp.sender] = sp.set()
+            self.data.owned_tokens[sp.sender].add(self.data.next_token_id)
             self.data.next_token_id += 1
 
         @sp.entrypoint
         def balance_of(self, callback, requests):
-            sp.cast(requests, sp.list[sp.record(owner = sp.address, token_id = sp.nat)])
-            result = []
+            sp.cast(requests, sp.list[balance_of_request_type])
+            sp.cast(callback, sp.contract[sp.list[balance_of_response_type]])
+            # each token is read once from the big_map, however many requests mention it
+            owners = {}
+            sp.cast(owners, sp.map[sp.nat, sp.address])
+            reversed_result = []
             for request in requests:
-                assert self.data.tokens.contains(request.token_id), "FA2_TOKEN_UNDEFINED"
-                token = self.data.tokens[request.token_id]
-                balance = 0
-                if token.owner == request.owner:
+                if not owners.contains(request.token_id):
+                    assert self.data.tokens.contains(request.token_id), "FA2_TOKEN_UNDEFINED"
+                    owners[request.token_id] = self.data.tokens[request.token_id].owner
+                balance = sp.nat(0)
+                if owners[request.token_id] == request.owner:
                     balance = 1
-                result = sp.cons(sp.record(request = sp.record(owner = request.owner, token_id =request.token_id),
-                                           balance = 1),
-                                 result)
-
+                reversed_result = sp.cons(sp.record(request = request, balance = balance), reversed_result)
+            # sp.cons reverses the order, so the responses are reversed back into the request order
+            result = []
+            for response in reversed_result:
+                result = sp.cons(response, result)
             sp.transfer(result, sp.mutez(0), callback)
+
+        @sp.onchain_view
+        def get_owned_tokens(self, owner):
+            sp.cast(owner, sp.address)
+            result = sp.set()
+            if self.data.owned_tokens.contains(owner):
+                result = self.data.owned_tokens[owner]
+            return result
         
         @sp.entrypoint
         def update_operators(self, actions):
@@ -48,19 +80,13 @@ def main():
                 if action.is_variant.add_operator():
                     operator_data = action.unwrap.add_operator()
                     sp.cast(operator_data, operator_type)
-                    token = self.data.tokens[operator_data.token_id]
-                    assert token.owner == sp.sender, "FA2_NOT_OWNER"
                     assert operator_data.owner == sp.sender, "FA2_NOT_OWNER"
-                    token.operators.add(operator_data.operator)
-                    self.data.tokens[operator_data.token_id] = token
+                    self.data.operators[operator_data] = ()
                 else:
                     operator_data = action.unwrap.remove_operator()
                     sp.cast(operator_data, operator_type)
-                    token = self.data.tokens[operator_data.token_id]
-                    assert token.owner == sp.sender, "FA2_NOT_OWNER"
                     assert operator_data.owner == sp.sender, "FA2_NOT_OWNER"
-                    token.operators.remove(operator_data.operator)
-                    self.data.tokens[operator_data.token_id] = token
+                    del self.data.operators[operator_data]
                 
         @sp.entrypoint
         def transfer(self, transfers):
@@ -70,38 +96,125 @@ def main():
                     sp.cast(tx, transaction_type)
                     assert tx.amount == sp.nat(1)
                     token = self.data.tokens[tx.token_id]
-                    assert token.operators.contains(sp.sender)
+                    assert self.data.operators.contains(sp.record(owner = token.owner, operator = sp.sender, token_id = tx.token_id))
                     self.data.tokens[tx.token_id].owner = tx.to_
+                    self.data.owned_tokens[token.owner].remove(tx.token_id)
+                    if not self.data.owned_tokens.contains(tx.to_):
+                        self.data.owned_tokens[tx.to_] = sp.set()
+                    self.data.owned_tokens[tx.to_].add(tx.token_id)
+
+    class BalanceOfReceiver(sp.Contract):
+        def __init__(self):
+            self.data.responses = []
+            sp.cast(self.data.responses, sp.list[balance_of_response_type])
+
+        @sp.entrypoint
+        def receive_balances(self, responses):
+            self.data.responses = responses
 
     class Marketplace(sp.Contract):
         def __init__(self, contract_address):
             self.data.contract_address = contract_address
             self.data.offers = sp.big_map({})
+            sp.cast(self.data.offers, sp.big_map[sp.nat, sp.record(seller = sp.address, token_id = sp.nat, price = sp.mutez)])
+            # offers of each token as (price, offer id) pairs: sets are sorted,
+            # so the cheapest offer of a token is always the first element
+            self.data.order_book = sp.big_map({})
+            sp.cast(self.data.order_book, sp.big_map[sp.nat, sp.set[sp.pair[sp.mutez, sp.nat]]])
             self.data.next_offer_id = 1
      
         @sp.entrypoint
         def new_offer(self, token_id, price):
            self.data.offers[self.data.next_offer_id] = sp.record(seller = sp.sender, token_id = token_id, price = price)
+           if not self.data.order_book.contains(token_id):
+               self.data.order_book[token_id] = sp.set()
+           self.data.order_book[token_id].add((price, self.data.next_offer_id))
            self.data.next_offer_id += 1
-        
-        @sp.entrypoint
-        def buy(self, id_offer):
+
+        @sp.private(with_storage="read-write")
+        def remove_offer(self, id_offer):
             offer = self.data.offers[id_offer]
-            assert offer.price == sp.amount
+            self.data.order_book[offer.token_id].remove((offer.price, id_offer))
+            if sp.len(self.data.order_book[offer.token_id]) == 0:
+                del self.data.order_book[offer.token_id]
+            del self.data.offers[id_offer]
 
+        @sp.private(with_storage="read-only", with_operations=True)
+        def send_tokens(self, txs):
+            # all the tokens moved by a call are delivered by a single FA2 transfer
+            sp.cast(txs, sp.list[transaction_type])
             token_contract = sp.contract(sp.list[sp.record(from_ = sp.address,
                                                            txs = sp.list[sp.record(to_ = sp.address, token_id = sp.nat, amount = sp.nat)])],
                                           self.data.contract_address,
                                           entrypoint="transfer").unwrap_some()
 
-            tx = sp.record(to_ = sp.sender, token_id = offer.token_id, amount = sp.nat(1))
-            sp.cast(tx, transaction_type)
-            sp.transfer([sp.record(from_ = sp.self_address(), txs = [tx])], # TODO: undertand what from_ is for
+            # from_ is the owner the FA2 batch debits: the marketplace, which holds the escrowed tokens
+            sp.transfer([sp.record(from_ = sp.self_address(), txs = txs)],
                         sp.tez(0),
                         token_contract)
 
+        @sp.entrypoint
+        def cancel_offer(self, id_offer):
+            assert self.data.offers[id_offer].seller == sp.sender, "not your offer"
+            self.remove_offer(id_offer)
+        
+        @sp.entrypoint
+        def buy(self, id_offer):
+            offer = self.data.offers[id_offer]
+            assert offer.price == sp.amount
+            self.remove_offer(id_offer)
+            self.send_tokens([sp.record(to_ = sp.sender, token_id = offer.token_id, amount = sp.nat(1))])
             sp.send(offer.seller, offer.price)
 
+        @sp.entrypoint
+        def buy_many(self, offer_ids):
+            # fills the offers in the given order while the amount sent covers them;
+            # offers already gone or over the remaining budget are skipped, the rest is refunded
+            sp.cast(offer_ids, sp.list[sp.nat])
+            spent = sp.tez(0)
+            txs = []
+            payouts = {}
+            sp.cast(payouts, sp.map[sp.address, sp.mutez])
+            for id_offer in offer_ids:
+                if self.data.offers.contains(id_offer):
+                    offer = self.data.offers[id_offer]
+                    if spent + offer.price <= sp.amount:
+                        spent += offer.price
+                        self.remove_offer(id_offer)
+                        txs = sp.cons(sp.record(to_ = sp.sender, token_id = offer.token_id, amount = sp.nat(1)), txs)
+                        if not payouts.contains(offer.seller):
+                            payouts[offer.seller] = sp.tez(0)
+                        payouts[offer.seller] += offer.price
+            if sp.len(txs) > 0:
+                self.send_tokens(txs)
+            # one payment per seller, however many of their offers were filled
+            for payout in payouts.items():
+                sp.send(payout.key, payout.value)
+            if spent < sp.amount:
+                sp.send(sp.sender, sp.amount - spent)
+
+        @sp.onchain_view
+        def get_cheapest_offers(self, token_id, max_items):
+            # (price, offer id) of up to max_items offers of token_id, cheapest first. The
+            # offers of the token are read from the big_map as one set, but only the first
+            # max_items of them are walked through
+            result = []
+            if self.data.order_book.contains(token_id):
+                entries = self.data.order_book[token_id].elements()
+                reversed_result = []
+                nb_items = sp.nat(0)
+                while nb_items < max_items:
+                    match entries:
+                        case []:
+                            nb_items = max_items
+                        case [entry, *tail]:
+                            reversed_result = sp.cons(entry, reversed_result)
+                            entries = tail
+                            nb_items += 1
+                for entry in reversed_result:
+                    result = sp.cons(entry, result)
+            return result
+
 
 @sp.add_test()
 def test():
@@ -123,3 +236,139 @@ def test():
     ledger.update_operators([sp.variant("add_operator", operator_data)], _sender = alice)
 
     marketplace.buy(1, _sender = bob, _amount = sp.tez(10))
+    scenario.verify(marketplace.data.offers.contains(1) == False)
+    # sets are not comparable: check their size and elements
+    scenario.verify(sp.len(ledger.get_owned_tokens(bob.address)) == 1)
+    scenario.verify(ledger.get_owned_tokens(bob.address).contains(1))
+    scenario.verify(sp.len(ledger.get_owned_tokens(alice.address)) == 0)
+
+    ledger.mint("Alice NFT 2", _sender = alice)
+    receiver = main.BalanceOfReceiver()
+    scenario += receiver
+    callback = sp.contract(sp.list[main.balance_of_response_type], receiver.address, entrypoint = "receive_balances").unwrap_some()
+    requests = [sp.record(owner = bob.address, token_id = 1),
+                sp.record(owner = alice.address, token_id = 2),
+                sp.record(owner = alice.address, token_id = 1)]
+    ledger.balance_of(callback = callback, requests = requests)
+    scenario.verify_equal(receiver.data.responses,
+                          [sp.record(request = requests[0], balance = 1),
+                           sp.record(request = requests[1], balance = 1),
+                           sp.record(request = requests[2], balance = 0)])
+
+    ledger.mint("Alice NFT 3", _sender = alice)
+    for token_id in [2, 3]:
+        operator_data = sp.record(owner = alice.address, operator = marketplace.address, token_id = token_id)
+        ledger.update_operators([sp.variant("add_operator", operator_data)], _sender = alice)
+    marketplace.new_offer(token_id = sp.nat(2), price = sp.tez(8), _sender = alice)
+    marketplace.new_offer(token_id = sp.nat(2), price = sp.tez(5), _sender = alice)
+    marketplace.new_offer(token_id = sp.nat(3), price = sp.tez(7), _sender = alice)
+    scenario.verify_equal(marketplace.get_cheapest_offers(sp.record(token_id = 2, max_items = 5)), [(sp.tez(5), 3), (sp.tez(8), 2)])
+    marketplace.cancel_offer(2, _sender = bob, _valid = False)
+    marketplace.cancel_offer(2, _sender = alice)
+    scenario.verify_equal(marketplace.get_cheapest_offers(sp.record(token_id = 2, max_items = 5)), [(sp.tez(5), 3)])
+
+    # the budget covers offer 3 but not offer 4 as well: offer 4 is skipped and 5 tez are refunded
+    marketplace.buy_many([3, 4, 1], _sender = eve, _amount = sp.tez(10))
+    scenario.verify(sp.len(ledger.get_owned_tokens(eve.address)) == 1)
+    scenario.verify(ledger.get_owned_tokens(eve.address).contains(2))
+    scenario.verify(marketplace.data.offers.contains(4))
+    scenario.verify(marketplace.balance == sp.tez(0))
+
+@sp.add_test()
+def test_indexer():
+    alice = sp.test_account("Alice")
+    bob = sp.test_account("Bob")
+    eve = sp.test_account("Eve")
+    # tools/indexer.py replays the operations of this scenario, the FA2 transfers made by the
+    # marketplace included: its tokens table must agree with the storage of the contract
+    scenario = sp.test_scenario("Tokens indexed from the operations", main)
+    recorder = scenario_operations.Recorder(scenario)
+    ledger = main.FA2Token()
+    scenario += ledger
+    marketplace = main.Marketplace(ledger.address)
+    scenario += marketplace
+    ledger.mint("Alice NFT 1", _sender = alice)
+    ledger.mint("Alice NFT 2", _sender = alice)
+    ledger.mint("Bob NFT 1", _sender = bob)
+    for token_id in [1, 2]:
+        operator_data = sp.record(owner = alice.address, operator = marketplace.address, token_id = token_id)
+        ledger.update_operators([sp.variant("add_operator", operator_data)], _sender = alice)
+        marketplace.new_offer(token_id = sp.nat(token_id), price = sp.tez(3), _sender = alice)
+    marketplace.buy(1, _sender = bob, _amount = sp.tez(2), _valid = False)
+    marketplace.buy(1, _sender = bob, _amount = sp.tez(3))
+    marketplace.buy_many([2], _sender = eve, _amount = sp.tez(3))
+
+    db = sqlite3.connect(":memory:")
+    indexer.index((json.dumps(operation) for operation in recorder.operations), db)
+    contract = next(operation["contract"] for operation in recorder.operations if operation["kind"] == "FA2Token")
+    rows = db.execute("SELECT token_id, owner, metadata FROM tokens WHERE contract = ? ORDER BY token_id", (contract,)).fetchall()
+    assert [row[0] for row in rows] == [1, 2, 3]
+    for token_id, owner, metadata in rows:
+        scenario.verify(ledger.data.tokens[token_id].owner == sp.address(owner))
+        scenario.verify(ledger.data.token_metadata[token_id] == metadata)
+        scenario.verify(ledger.get_owned_tokens(sp.address(owner)).contains(token_id))
+    holders = db.execute("SELECT owner, COUNT(*) FROM tokens GROUP BY owner").fetchall()
+    for owner, nb_tokens in holders:
+        scenario.verify(sp.len(ledger.get_owned_tokens(sp.address(owner))) == nb_tokens)
+    assert len(holders) == 2
+
+@sp.add_test()
+def test_operators_gas():
+    alice = sp.test_account("Alice")
+    operators = [sp.test_account("Operator %d" % i).address for i in range(20)]
+    # operator updates only touch their own key: their gas must not depend on the
+    # size of the token metadata nor on the number of operators already set
+    scenario = sp.test_scenario("Gas per operator update with large metadata", main)
+    ledger = main.FA2Token()
+    scenario += ledger
+    ledger.mint("x" * 10000, _sender = alice)
+    for operator in operators:
+        operator_data = sp.record(owner = alice.address, operator = operator, token_id = 1)
+        ledger.update_operators([sp.variant("add_operator", operator_data)], _sender = alice)
+    for operator in operators:
+        operator_data = sp.record(owner = alice.address, operator = operator, token_id = 1)
+        ledger.update_operators([sp.variant("remove_operator", operator_data)], _sender = alice)
+    scenario.verify(ledger.data.operators.contains(sp.record(owner = alice.address, operator = operators[0], token_id = 1)) == False)
+
+@sp.add_test()
+def test_settlement():
+    alice = sp.test_account("Alice")
+    bob = sp.test_account("Bob")
+    # whatever the number of NFTs settled, buy_many emits one FA2 transfer and
+    # one payment per seller: compare the operations and gas of each call
+    scenario = sp.test_scenario("Settlement of several NFTs in one call", main)
+    ledger = main.FA2Token()
+    scenario += ledger
+    marketplace = main.Marketplace(ledger.address)
+    scenario += marketplace
+    offer_ids = []
+    for token_id in range(1, 21):
+        ledger.mint("Alice NFT %d" % token_id, _sender = alice)
+        operator_data = sp.record(owner = alice.address, operator = marketplace.address, token_id = token_id)
+        ledger.update_operators([sp.variant("add_operator", operator_data)], _sender = alice)
+        marketplace.new_offer(token_id = sp.nat(token_id), price = sp.tez(1), _sender = alice)
+        offer_ids.append(token_id)
+    settled = 0
+    for nb_nfts in [1, 4, 15]:
+        scenario.h2("Settling %d NFTs" % nb_nfts)
+        marketplace.buy_many(offer_ids[settled:settled + nb_nfts], _sender = bob, _amount = sp.tez(nb_nfts))
+        settled += nb_nfts
+    scenario.verify(sp.len(ledger.get_owned_tokens(bob.address)) == 20)
+
+@sp.add_test()
+def test_large_order_book():
+    alice = sp.test_account("Alice")
+    # get_cheapest_offers walks at most max_items offers of the book, however large it is
+    scenario = sp.test_scenario("Cheapest offers of a large order book", main)
+    ledger = main.FA2Token()
+    scenario += ledger
+    marketplace = main.Marketplace(ledger.address)
+    scenario += marketplace
+    ledger.mint("Alice NFT 1", _sender = alice)
+    for price in range(200, 0, -1):
+        marketplace.new_offer(token_id = sp.nat(1), price = sp.mutez(price), _sender = alice)
+    scenario.verify_equal(marketplace.get_cheapest_offers(sp.record(token_id = 1, max_items = 3)),
+                          [(sp.mutez(1), 200), (sp.mutez(2), 199), (sp.mutez(3), 198)])
+    scenario.verify(sp.len(marketplace.get_cheapest_offers(sp.record(token_id = 1, max_items = 1000))) == 200)
+    scenario.verify(sp.len(marketplace.get_cheapest_offers(sp.record(token_id = 1, max_items = 0))) == 0)
+    scenario.verify(sp.len(marketplace.get_cheapest_offers(sp.record(token_id = 2, max_items = 3))) == 0)
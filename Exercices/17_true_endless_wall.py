@@ -4,18 +4,37 @@ import smartpy as sp
 def main():
     class TrulyEndlessWall(sp.Contract):
         def __init__(self, owner):
+            # each message is stored under its own key, so writing never loads the history
             self.data.messages = sp.big_map({})
-            sp.cast(self.data.messages, sp.big_map[sp.address, sp.record(text = sp.string,
-                                                                         timestamp = sp.timestamp)])
+            sp.cast(self.data.messages, sp.big_map[sp.pair[sp.address, sp.nat], sp.record(text = sp.string,
+                                                                                             timestamp = sp.timestamp)])
+            self.data.nb_messages = sp.big_map({})
+            sp.cast(self.data.nb_messages, sp.big_map[sp.address, sp.nat])
      
         @sp.entrypoint
         def write_message(self, text):
-           data = sp.record(text = text, timestamp = sp.now)
-           if self.data.messages.contains(sp.sender):
-               data = self.data.messages[sp.sender]
-               data.text += "," + text
-               data.timestamp = sp.now
-           self.data.messages[sp.sender] = data
+           index = sp.nat(0)
+           if self.data.nb_messages.contains(sp.sender):
+               index = self.data.nb_messages[sp.sender]
+           self.data.messages[(sp.sender, index)] = sp.record(text = text, timestamp = sp.now)
+           self.data.nb_messages[sp.sender] = index + 1
+
+        @sp.offchain_view
+        def read_messages(self, user, first, max_items):
+            # returns up to max_items messages of user, in order, starting at index first
+            sp.cast(user, sp.address)
+            end = first + max_items
+            if self.data.nb_messages.contains(user):
+                if self.data.nb_messages[user] < end:
+                    end = self.data.nb_messages[user]
+            else:
+                end = first
+            result = []
+            index = end
+            while index > first:
+                index = sp.as_nat(index - 1)
+                result = sp.cons(self.data.messages[(user, index)], result)
+            return result
     
        
 @sp.add_test()
@@ -28,3 +47,11 @@ def test():
     scenario += c1
     c1.write_message("bob's message 1", _sender= bob)
     c1.write_message("bob's message 2", _sender= bob)
+    c1.write_message("bob's message 3", _sender= bob, _now = sp.timestamp(30))
+    scenario.verify(c1.data.nb_messages[bob] == 3)
+    scenario.verify(c1.data.messages[(bob, 1)].text == "bob's message 2")
+    page = c1.read_messages(sp.record(user = bob, first = 1, max_items = 10))
+    scenario.verify(sp.len(page) == 2)
+    scenario.verify_equal(c1.read_messages(sp.record(user = bob, first = 2, max_items = 1)),
+                          [sp.record(text = "bob's message 3", timestamp = sp.timestamp(30))])
+    scenario.verify(sp.len(c1.read_messages(sp.record(user = eve, first = 0, max_items = 10))) == 0)
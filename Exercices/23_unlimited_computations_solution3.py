@@ -0,0 +1,134 @@
+import smartpy as sp
+
+@sp.module
+def main():
+    class TimeSafe(sp.Contract):
+
+        def __init__(self, owner, bucket_size):
+            # deposits are grouped by deadline bucket: bucket b holds the deadlines in
+            # [b * bucket_size, (b + 1) * bucket_size[ and is indexed by (b, i), for i
+            # in [first, next[ of bucket_ranges[b]. The buckets that hold deposits form
+            # a list sorted by deadline, linked in the links big_map, from head, the
+            # earliest one: withdrawals start at head and stop at the first bucket
+            # that has not expired
+            self.data.owner = owner
+            self.data.bucket_size = bucket_size
+            sp.cast(self.data.bucket_size, sp.nat)
+            self.data.deposits = sp.big_map({})
+            sp.cast(self.data.deposits, sp.big_map[sp.pair[sp.int, sp.nat],
+                                                   sp.record(source = sp.address, deadline = sp.timestamp, amount = sp.mutez)])
+            self.data.bucket_ranges = sp.big_map({})
+            sp.cast(self.data.bucket_ranges, sp.big_map[sp.int, sp.record(first = sp.nat, next = sp.nat)])
+            self.data.links = sp.big_map({})
+            sp.cast(self.data.links, sp.big_map[sp.int, sp.record(previous = sp.option[sp.int], next = sp.option[sp.int])])
+            self.data.head = None
+            sp.cast(self.data.head, sp.option[sp.int])
+
+        @sp.entrypoint
+        def deposit(self, deadline, previous_bucket):
+            # previous_bucket is the last bucket of the list before the one of deadline,
+            # or None if there is none: it is only checked, and ignored when the bucket
+            # of deadline already holds deposits, so the cost doesn't depend on the list
+            sp.cast(previous_bucket, sp.option[sp.int])
+            assert sp.amount > sp.tez(0), "EMPTY_DEPOSIT"
+            bucket = sp.fst(sp.ediv(deadline - sp.timestamp(0), self.data.bucket_size).unwrap_some())
+            if not self.data.bucket_ranges.contains(bucket):
+                next_bucket = self.data.head
+                if previous_bucket.is_some():
+                    previous = previous_bucket.unwrap_some()
+                    assert self.data.links.contains(previous) and previous < bucket, "WRONG_PREVIOUS_BUCKET"
+                    next_bucket = self.data.links[previous].next
+                    self.data.links[previous].next = sp.Some(bucket)
+                else:
+                    self.data.head = sp.Some(bucket)
+                if next_bucket.is_some():
+                    assert bucket < next_bucket.unwrap_some(), "WRONG_PREVIOUS_BUCKET"
+                    self.data.links[next_bucket.unwrap_some()].previous = sp.Some(bucket)
+                self.data.links[bucket] = sp.record(previous = previous_bucket, next = next_bucket)
+                self.data.bucket_ranges[bucket] = sp.record(first = 0, next = 0)
+            bucket_range = self.data.bucket_ranges[bucket]
+            self.data.deposits[(bucket, bucket_range.next)] = sp.record(source = sp.sender, deadline = deadline, amount = sp.amount)
+            self.data.bucket_ranges[bucket] = sp.record(first = bucket_range.first, next = bucket_range.next + 1)
+
+        @sp.entrypoint
+        def withdraw_range(self, from_bucket, max_items):
+            # withdraws, in deadline order, at most max_items deposits of the expired
+            # buckets, starting at from_bucket, or at head when it is None, and stops at
+            # the first bucket that has not expired: the cost is bounded by max_items,
+            # whatever the number of deposits. Drained buckets are unlinked
+            sp.cast(from_bucket, sp.option[sp.int])
+            assert sp.sender == self.data.owner
+            current = self.data.head
+            if from_bucket.is_some():
+                assert self.data.links.contains(from_bucket.unwrap_some()), "UNKNOWN_BUCKET"
+                current = from_bucket
+            total = sp.tez(0)
+            nb_items = sp.nat(0)
+            walking = True
+            while walking:
+                walking = False
+                if current.is_some() and nb_items < max_items:
+                    bucket = current.unwrap_some()
+                    if sp.add_seconds(sp.timestamp(0), (bucket + 1) * sp.to_int(self.data.bucket_size)) <= sp.now:
+                        walking = True
+                        bucket_range = self.data.bucket_ranges[bucket]
+                        while bucket_range.first < bucket_range.next and nb_items < max_items:
+                            key = (bucket, bucket_range.first)
+                            total += self.data.deposits[key].amount
+                            del self.data.deposits[key]
+                            bucket_range.first += 1
+                            nb_items += 1
+                        link = self.data.links[bucket]
+                        if bucket_range.first == bucket_range.next:
+                            if link.previous.is_some():
+                                self.data.links[link.previous.unwrap_some()].next = link.next
+                            else:
+                                self.data.head = link.next
+                            if link.next.is_some():
+                                self.data.links[link.next.unwrap_some()].previous = link.previous
+                            del self.data.links[bucket]
+                            del self.data.bucket_ranges[bucket]
+                        else:
+                            self.data.bucket_ranges[bucket] = bucket_range
+                        current = link.next
+            if total > sp.tez(0):
+                sp.send(sp.sender, total)
+
+
+@sp.add_test()
+def test():
+    alice = sp.test_account("alice").address
+    bob = sp.test_account("bob").address
+    carl = sp.test_account("carl").address
+    scenario = sp.test_scenario("Test bounded withdrawals", main)
+    timeSafeContract = main.TimeSafe(owner = alice, bucket_size = 100)
+    scenario += timeSafeContract
+    timeSafeContract.deposit(deadline = sp.timestamp(100), previous_bucket = None, _sender = bob, _amount = sp.tez(10))
+    timeSafeContract.deposit(deadline = sp.timestamp(150), previous_bucket = None, _sender = carl, _amount = sp.tez(20))
+    timeSafeContract.deposit(deadline = sp.timestamp(250), previous_bucket = sp.Some(1), _sender = bob, _amount = sp.tez(5))
+    timeSafeContract.deposit(deadline = sp.timestamp(5000), previous_bucket = sp.Some(2), _sender = carl, _amount = sp.tez(7))
+    # empty deposits, and new buckets linked at the wrong place, are rejected
+    timeSafeContract.deposit(deadline = sp.timestamp(5000), previous_bucket = None, _sender = bob, _amount = sp.tez(0), _valid = False)
+    timeSafeContract.deposit(deadline = sp.timestamp(300), previous_bucket = None, _sender = bob, _amount = sp.tez(1), _valid = False)
+    timeSafeContract.deposit(deadline = sp.timestamp(300), previous_bucket = sp.Some(50), _sender = bob, _amount = sp.tez(1), _valid = False)
+    timeSafeContract.deposit(deadline = sp.timestamp(300), previous_bucket = sp.Some(1), _sender = bob, _amount = sp.tez(1), _valid = False)
+    timeSafeContract.withdraw_range(from_bucket = None, max_items = 10, _sender = bob, _now = sp.timestamp(10000), _valid = False)
+    timeSafeContract.withdraw_range(from_bucket = None, max_items = 10, _sender = alice, _now = sp.timestamp(0))
+    scenario.verify(timeSafeContract.balance == sp.tez(42))
+    timeSafeContract.withdraw_range(from_bucket = None, max_items = 1, _sender = alice, _now = sp.timestamp(200))
+    scenario.verify(timeSafeContract.balance == sp.tez(32))
+    # the walk stops at bucket 2, which has not expired
+    timeSafeContract.withdraw_range(from_bucket = None, max_items = 10, _sender = alice, _now = sp.timestamp(200))
+    scenario.verify(timeSafeContract.balance == sp.tez(12))
+    scenario.verify(timeSafeContract.data.head == sp.Some(2))
+    scenario.verify(timeSafeContract.data.links[50].next == None)
+    # a deposit in an old bucket becomes the new head, from_bucket starts after it
+    timeSafeContract.deposit(deadline = sp.timestamp(50), previous_bucket = None, _sender = bob, _amount = sp.tez(3))
+    timeSafeContract.withdraw_range(from_bucket = sp.Some(7), max_items = 10, _sender = alice, _now = sp.timestamp(300), _valid = False)
+    timeSafeContract.withdraw_range(from_bucket = sp.Some(2), max_items = 10, _sender = alice, _now = sp.timestamp(300))
+    scenario.verify(timeSafeContract.balance == sp.tez(10))
+    scenario.verify(timeSafeContract.data.links[0].next == sp.Some(50))
+    # the 49 empty buckets between 0 and 50 are never visited
+    timeSafeContract.withdraw_range(from_bucket = None, max_items = 2, _sender = alice, _now = sp.timestamp(10000))
+    scenario.verify(timeSafeContract.balance == sp.tez(0))
+    scenario.verify(timeSafeContract.data.head == None)
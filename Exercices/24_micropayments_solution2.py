@@ -1,7 +1,13 @@
 import smartpy as sp
 
+from tools import micropayments_client
+
 @sp.module
 def main():
+    # explicit layout: the bytes of a packed voucher don't depend on how the compiler orders fields
+    voucher_type:type = sp.record(destination = sp.address, amount = sp.mutez, counter = sp.nat, contract = sp.address
+                                 ).layout(("destination", ("amount", ("counter", "contract"))))
+
     class Micropayments(sp.Contract):
     
         def __init__(self):
@@ -21,23 +27,38 @@ def main():
                 self.data.deposits[key].deadline = deadline
                 self.data.deposits[key].amount += sp.amount
 
-        @sp.entrypoint
-        def claim_payments(self, source, packed_message, signature):
-            key = sp.record(source = source, destination = sp.sender)
+        @sp.private(with_storage="read-write")
+        def settle(self, voucher):
+            # checks a voucher of the cumulative amount owed by source, and returns what is left to pay
+            key = sp.record(source = voucher.source, destination = sp.sender)
             deposit = self.data.deposits[key]
-            assert sp.check_signature(deposit.public_key, signature, packed_message)
-            message = sp.unpack(packed_message,
-                                sp.record(destination = sp.address, amount = sp.mutez, counter = sp.nat, contract = sp.address)
-                               ).unwrap_some()
+            assert sp.check_signature(deposit.public_key, voucher.signature, voucher.packed_message)
+            message = sp.unpack(voucher.packed_message, voucher_type).unwrap_some()
             assert message.destination == sp.sender
             assert message.counter == deposit.counter
             assert message.contract == sp.self_address()
             amount_to_pay = message.amount - deposit.amount_spent
             assert deposit.amount >= amount_to_pay
-            self.data.deposits[key].amount = deposit.amount - amount_to_pay
-            self.data.deposits[key].amount_spent = deposit.amount_spent + amount_to_pay
+            deposit.amount -= amount_to_pay
+            deposit.amount_spent += amount_to_pay
+            self.data.deposits[key] = deposit
+            return amount_to_pay
+
+        @sp.entrypoint
+        def claim_payments(self, source, packed_message, signature):
+            amount_to_pay = self.settle(sp.record(source = source, packed_message = packed_message, signature = signature))
             sp.send(sp.sender, amount_to_pay)
 
+        @sp.entrypoint
+        def claim_many(self, vouchers):
+            # settles the channels of many payers to the sender, with one transfer of the total
+            sp.cast(vouchers, sp.list[sp.record(source = sp.address, packed_message = sp.bytes, signature = sp.signature)])
+            total = sp.tez(0)
+            for voucher in vouchers:
+                total += self.settle(voucher)
+            if total > sp.tez(0):
+                sp.send(sp.sender, total)
+
         @sp.entrypoint
         def close_account(self, destination):
             key = sp.record(source = sp.sender, destination = destination)
@@ -57,7 +78,75 @@ def test():
     micropayments.deposit(destination = bob, deadline = sp.timestamp(1000), public_key = alice.public_key, counter = sp.nat(1),
                           _sender = alice.address, _amount = sp.tez(100))
     message = sp.record(destination = bob, amount = sp.tez(5), counter = sp.nat(1), contract = micropayments.address)
-    packed_message = sp.pack(message)
+    packed_message = sp.pack(sp.cast(message, main.voucher_type))
     signature = sp.make_signature(alice.secret_key, packed_message)
     micropayments.claim_payments(source = alice.address, packed_message = packed_message, signature = signature,
                                  _sender = bob)
+
+@sp.add_test()
+def test_claim_many():
+    alice = sp.test_account("alice")
+    dave = sp.test_account("dave")
+    bob = sp.test_account("bob").address
+    carl = sp.test_account("carl").address
+    scenario = sp.test_scenario("Claim many", main)
+    micropayments = main.Micropayments()
+    scenario += micropayments
+    micropayments.deposit(destination = bob, deadline = sp.timestamp(1000), public_key = alice.public_key, counter = sp.nat(1),
+                          _sender = alice.address, _amount = sp.tez(100))
+    micropayments.deposit(destination = bob, deadline = sp.timestamp(1000), public_key = dave.public_key, counter = sp.nat(3),
+                          _sender = dave.address, _amount = sp.tez(50))
+
+    def voucher(payer, destination, amount, counter, source = None):
+        message = sp.record(destination = destination, amount = amount, counter = counter, contract = micropayments.address)
+        packed_message = sp.pack(sp.cast(message, main.voucher_type))
+        return sp.record(source = (source or payer).address, packed_message = packed_message,
+                         signature = sp.make_signature(payer.secret_key, packed_message))
+
+    message = sp.record(destination = bob, amount = sp.tez(5), counter = sp.nat(1), contract = micropayments.address)
+    packed_message = sp.pack(sp.cast(message, main.voucher_type))
+    micropayments.claim_payments(source = alice.address, packed_message = packed_message,
+                                 signature = sp.make_signature(alice.secret_key, packed_message), _sender = bob)
+    # vouchers are cumulative: only the latest one of each channel is claimed
+    micropayments.claim_many([voucher(alice, bob, sp.tez(12), sp.nat(1)), voucher(dave, bob, sp.tez(20), sp.nat(3))], _sender = bob)
+    scenario.verify(micropayments.balance == sp.tez(118))
+    scenario.verify(micropayments.data.deposits[sp.record(source = alice.address, destination = bob)].amount_spent == sp.tez(12))
+    micropayments.claim_many([voucher(alice, bob, sp.tez(12), sp.nat(1))], _sender = bob)
+    scenario.verify(micropayments.balance == sp.tez(118))
+
+    micropayments.claim_many([voucher(alice, bob, sp.tez(15), sp.nat(2))], _sender = bob, _valid = False)
+    micropayments.claim_many([voucher(alice, carl, sp.tez(15), sp.nat(1))], _sender = bob, _valid = False)
+    micropayments.claim_many([voucher(dave, bob, sp.tez(51), sp.nat(3))], _sender = bob, _valid = False)
+    forged = voucher(alice, bob, sp.tez(30), sp.nat(3), source = dave)
+    micropayments.claim_many([voucher(alice, bob, sp.tez(15), sp.nat(1)), forged], _sender = bob, _valid = False)
+    scenario.verify(micropayments.balance == sp.tez(118))
+
+@sp.add_test()
+def test_client_vouchers():
+    # vouchers packed and signed off-chain by tools/micropayments_client.py settle through claim_many
+    contract = "KT1TezoooozzSmartPyzzSTATiCzzzwwBFA1"  # address of the first contract originated in a scenario
+    destination = "tz1MBKRfrhZhFj5DRE7VEN7pgHDNmNxvP2sh"
+    scenario = sp.test_scenario("Client vouchers", main)
+    micropayments = main.Micropayments()
+    scenario += micropayments
+    scenario.verify(micropayments.address == sp.address(contract))
+    client = micropayments_client.Client(contract, "edsk2yKNBD9nq4vEyXjz1y7qx7pvEYr7Y11KWHHxcV1Du1ULULwWcT")
+    client.open(destination, counter = 1, deposit = 100_000_000)
+    micropayments.deposit(destination = sp.address(destination), deadline = sp.timestamp(1000), public_key = sp.key(client.public_key),
+                          counter = sp.nat(1), _sender = sp.address(client.source), _amount = sp.tez(100))
+    vouchers = client.pay_many([(destination, 1_000_000), (destination, 2_500_000), (destination, 4_000_000)])
+
+    def claimed(voucher):
+        return sp.record(source = sp.address(voucher["source"]), packed_message = sp.bytes("0x" + voucher["packed_message"]),
+                         signature = sp.signature(voucher["signature"]))
+
+    message = sp.record(destination = sp.address(destination), amount = sp.mutez(7_500_000), counter = sp.nat(1),
+                        contract = sp.address(contract))
+    scenario.verify(sp.pack(sp.cast(message, main.voucher_type)) == sp.bytes("0x" + vouchers[-1]["packed_message"]))
+    micropayments.claim_many([claimed(voucher) for voucher in micropayments_client.latest(vouchers)],
+                             _sender = sp.address(destination))
+    scenario.verify(micropayments.balance == sp.mutez(92_500_000))
+    scenario.verify(micropayments.data.deposits[sp.record(source = sp.address(client.source),
+                                                          destination = sp.address(destination))].amount_spent == sp.mutez(7_500_000))
+    # an older voucher of the channel pays less than what was already claimed
+    micropayments.claim_many([claimed(vouchers[0])], _sender = sp.address(destination), _valid = False)
@@ -1,125 +1,18 @@
 import smartpy as sp
-
-@sp.module
-def main():
-    param_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
-
-    class Ledger(sp.Contract):
-        def __init__(self, owner, total_supply):
-            self.data.balances = sp.big_map({ owner : total_supply })
-            self.data.allowances = sp.big_map({})
-          
-        @sp.entrypoint
-        def transfer(self, source, destination, amount):
-            if source != sp.sender:
-                allowed = self.data.allowances[(source, sp.sender)]
-                assert allowed >= amount
-                self.data.allowances[(source, sp.sender)] = sp.as_nat(allowed - amount)
-            assert self.data.balances[source] >= amount
-            self.data.balances[source] = sp.as_nat(self.data.balances[source] - amount)
-            if not self.data.balances.contains(destination):
-                self.data.balances[destination] = sp.nat(0)
-            self.data.balances[destination] += amount
-
-        @sp.onchain_view
-        def get_balance(self, user):
-            sp.cast(user, sp.address)
-            return self.data.balances[user]
-
-        @sp.entrypoint
-        def allow(self, operator, amount):
-            if not self.data.allowances.contains((sp.sender, operator)):
-                self.data.allowances[(sp.sender, operator)] = 0
-            self.data.allowances[(sp.sender, operator)] += amount
-
-    class LiquidityPool(sp.Contract):
-        def __init__(self, owner, ledger):
-            self.data.ledger = ledger
-            self.data.owner = owner
-            self.data.K = sp.tez(0)
-            self.data.tokens_owned = sp.nat(0)
-            self.data.ledger_contract_opt = None
-            # tokens_owned * sp.balance = K -> should always be true
-
-        @sp.entrypoint
-        def provide_liquidity(self, deposited_tokens):
-            assert sp.sender == self.data.owner
-            assert self.data.K == sp.tez(0)
-            self.data.K = sp.mul(sp.balance, deposited_tokens)
-
-            self.data.tokens_owned = deposited_tokens
-
-            self.data.ledger_contract_opt = sp.contract(param_type, self.data.ledger, entrypoint="transfer")
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens),
-                        sp.tez(0),
-                        self.data.ledger_contract_opt.unwrap_some()
-                       )
-            
-        @sp.entrypoint
-        def withdraw_liquidity(self):
-            assert sp.sender == self.data.owner
-            sp.send(sp.sender, sp.balance)
-            
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned = sp.nat(0)
-            self.data.K = sp.tez(0)
-
-        
-        @sp.entrypoint
-        def sell_tokens(self, nb_tokens_sold, min_tez_requested):
-            ratio = sp.ediv(self.data.K, self.data.tokens_owned + nb_tokens_sold).unwrap_some()
-            tez_obtained = sp.balance - sp.fst(ratio)
-            assert tez_obtained >= min_tez_requested
-
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned += nb_tokens_sold
-            sp.send(sp.sender, tez_obtained)
-
-        @sp.entrypoint
-        def buy_tokens(self, min_tokens_bought):
-            sp.cast(min_tokens_bought, sp.nat)
-            tokens_obtained = sp.as_nat(self.data.tokens_owned - sp.fst(sp.ediv(self.data.K, sp.balance).unwrap_some()))
-            assert tokens_obtained >= min_tokens_bought
-
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned = sp.as_nat(self.data.tokens_owned - tokens_obtained)
-            
-
-        @sp.onchain_view
-        def get_token_price(self):
-            # returns what we would get if we sold one token
-            ratio1 = sp.ediv(self.data.K, self.data.tokens_owned).unwrap_some()
-            ratio2 = sp.ediv(self.data.K, sp.as_nat(self.data.tokens_owned - 1)).unwrap_some()
-            trace ("The current value of K is:")
-            trace(self.data.K)
-            trace("The pool owns this amount of tokens:")
-            trace(self.data.tokens_owned)
-            trace("The balance of the pool is:")
-            trace(sp.balance)
-            trace("The ratios before and after a potential purchase of 1 token would be:")
-            trace(ratio1)
-            trace(ratio2)
-            token_price = sp.fst(ratio2) - sp.fst(ratio1)
-            trace("The price of the token returned is:")
-            trace(token_price)
-            return token_price
-
+from defi_contracts import defi
 
 @sp.add_test()
 def test():
     alice = sp.test_account("alice")
     bob = sp.test_account("bob")
     carl = sp.test_account("carl")
-    scenario = sp.test_scenario("Test" , main)
-    ledger = main.Ledger(owner = alice.address, total_supply = 1000000)
+    scenario = sp.test_scenario("Test", defi)
+    ledger = defi.Ledger(owner = alice.address, total_supply = 1000000)
 
     scenario += ledger
 
     
-    liquidity_pool = main.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    liquidity_pool = defi.FeeLiquidityPool(owner = alice.address, ledger = ledger.address, fee_rate = 30)
     scenario += liquidity_pool
 
     ledger.allow(sp.record(operator = liquidity_pool.address, amount = 2000), _sender = alice)
@@ -129,5 +22,34 @@ def test():
 
     liquidity_pool.buy_tokens(500, _sender = carl, _amount = sp.tez(1000))
 
-    ledger.allow(sp.record(operator = liquidity_pool.address, amount = 96), _sender = bob)
-    liquidity_pool.sell_tokens(nb_tokens_sold = 96, min_tez_requested = sp.tez(200), _sender = bob)
+    # with the 0.3% fee, bob got 94 tokens for his 100 tez (96 before fees were charged)
+    scenario.verify(ledger.data.balances[bob.address] == 94)
+    ledger.allow(sp.record(operator = liquidity_pool.address, amount = 94), _sender = bob)
+    liquidity_pool.sell_tokens(nb_tokens_sold = 94, min_tez_requested = sp.tez(200), _sender = bob)
+
+    ledger.transfer_batch([sp.record(source = alice.address,
+                                     txs = [sp.record(destination = bob.address, amount = 10),
+                                            sp.record(destination = carl.address, amount = 20)])],
+                          _sender = alice)
+    ledger.allow(sp.record(operator = carl.address, amount = 5), _sender = bob)
+    ledger.transfer_batch([sp.record(source = bob.address,
+                                     txs = [sp.record(destination = carl.address, amount = 3),
+                                            sp.record(destination = carl.address, amount = 3)])],
+                          _sender = carl, _valid = False)
+
+    ledger.allow(sp.record(operator = liquidity_pool.address, amount = 100), _sender = carl)
+    swaps = [sp.variant("buy", sp.record(tez_in = sp.tez(10), min_tokens_out = 1)),
+             sp.variant("sell", sp.record(tokens_in = 100, min_tez_out = sp.tez(100)))]
+    liquidity_pool.swap_batch(swaps = swaps, deadline = sp.timestamp(100), _sender = carl, _amount = sp.tez(10),
+                              _now = sp.timestamp(200), _valid = False)
+    # a swap that would give less than its minimum fails the whole batch
+    too_few_tokens = [sp.variant("buy", sp.record(tez_in = sp.tez(10), min_tokens_out = 100))]
+    liquidity_pool.swap_batch(swaps = too_few_tokens, deadline = sp.timestamp(100), _sender = carl, _amount = sp.tez(10),
+                              _now = sp.timestamp(50), _valid = False, _exception = "MIN_TOKENS_OUT")
+    too_few_tez = [sp.variant("buy", sp.record(tez_in = sp.tez(10), min_tokens_out = 1)),
+                   sp.variant("sell", sp.record(tokens_in = 100, min_tez_out = sp.tez(1000)))]
+    liquidity_pool.swap_batch(swaps = too_few_tez, deadline = sp.timestamp(100), _sender = carl, _amount = sp.tez(10),
+                              _now = sp.timestamp(50), _valid = False, _exception = "MIN_TEZ_OUT")
+    liquidity_pool.swap_batch(swaps = swaps, deadline = sp.timestamp(100), _sender = carl, _amount = sp.tez(10),
+                              _now = sp.timestamp(50))
+    scenario.verify(liquidity_pool.balance == liquidity_pool.data.tez_reserve)
@@ -1,129 +1,62 @@
 import smartpy as sp
+from defi_contracts import defi
 
 @sp.module
 def main():
-    param_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
 
-    class Ledger(sp.Contract):
-        def __init__(self, owner, total_supply):
-            self.data.balances = sp.big_map({ owner : total_supply })
-            self.data.allowances = sp.big_map({})
-          
-        @sp.entrypoint
-        def transfer(self, source, destination, amount):
-            if source != sp.sender:
-                allowed = self.data.allowances[(source, sp.sender)]
-                assert allowed >= amount
-                self.data.allowances[(source, sp.sender)] = sp.as_nat(allowed - amount)
-            assert self.data.balances[source] >= amount
-            self.data.balances[source] = sp.as_nat(self.data.balances[source] - amount)
-            if not self.data.balances.contains(destination):
-                self.data.balances[destination] = sp.nat(0)
-            self.data.balances[destination] += amount
-
-        @sp.onchain_view
-        def get_balance(self, user):
-            sp.cast(user, sp.address)
-            return self.data.balances[user]
-
-        @sp.entrypoint
-        def allow(self, operator, amount):
-            if not self.data.allowances.contains((sp.sender, operator)):
-                self.data.allowances[(sp.sender, operator)] = 0
-            self.data.allowances[(sp.sender, operator)] += amount
-
-    class LiquidityPool(sp.Contract):
-        def __init__(self, owner, ledger):
+    class FlashArbitrage(sp.Contract):
+        def __init__(self, flash_loan, ledger, cheap_pool, expensive_pool, tez_amount, nb_tokens, interest_rate):
+            # buys nb_tokens with tez_amount on cheap_pool while selling nb_tokens on expensive_pool,
+            # with both the tez and the tokens borrowed in a single flash loan
+            self.data.flash_loan = flash_loan
             self.data.ledger = ledger
-            self.data.owner = owner
-            self.data.K = sp.tez(0)
-            self.data.tokens_owned = sp.nat(0)
-            self.data.ledger_contract_opt = None
-            # tokens_owned * sp.balance = K -> should always be true
+            self.data.cheap_pool = cheap_pool
+            self.data.expensive_pool = expensive_pool
+            self.data.tez_amount = tez_amount
+            self.data.nb_tokens = nb_tokens
+            self.data.interest_rate = interest_rate
 
         @sp.entrypoint
-        def provide_liquidity(self, deposited_tokens):
-            assert sp.sender == self.data.owner
-            assert self.data.K == sp.tez(0)
-            self.data.K = sp.mul(sp.balance, deposited_tokens)
-
-            self.data.tokens_owned = deposited_tokens
-
-            self.data.ledger_contract_opt = sp.contract(param_type, self.data.ledger, entrypoint="transfer")
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens),
-                        sp.tez(0),
-                        self.data.ledger_contract_opt.unwrap_some()
-                       )
-            
-        @sp.entrypoint
-        def withdraw_liquidity(self):
-            assert sp.sender == self.data.owner
-            sp.send(sp.sender, sp.balance)
-            
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned = sp.nat(0)
-            self.data.K = sp.tez(0)
+        def start(self):
+            flash_loan_borrow = sp.contract(sp.record(tez_amount = sp.mutez,
+                                                      tokens = sp.list[sp.record(asset = sp.record(ledger = sp.address, token_id = sp.option[sp.nat]), amount = sp.nat)],
+                                                      callback = sp.contract[sp.unit]),
+                                            self.data.flash_loan,
+                                            entrypoint="borrow").unwrap_some()
+            tokens = [sp.record(asset = sp.record(ledger = self.data.ledger, token_id = None), amount = self.data.nb_tokens)]
+            sp.transfer(sp.record(tez_amount = self.data.tez_amount, tokens = tokens, callback = sp.self_entrypoint("execute")), sp.tez(0), flash_loan_borrow)
 
-        
         @sp.entrypoint
-        def sell_tokens(self, nb_tokens_sold, min_tez_requested):
-            ratio = sp.ediv(self.data.K, self.data.tokens_owned + nb_tokens_sold).unwrap_some()
-            tez_obtained = sp.balance - sp.fst(ratio)
-            assert tez_obtained >= min_tez_requested
-
-            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned += nb_tokens_sold
-            sp.send(sp.sender, tez_obtained)
+        def execute(self):
+            assert sp.sender == self.data.flash_loan
+            cheap_pool_buy_tokens = sp.contract(sp.nat, self.data.cheap_pool, entrypoint="buy_tokens").unwrap_some()
+            sp.transfer(self.data.nb_tokens, self.data.tez_amount, cheap_pool_buy_tokens)
+            expensive_pool_sell_tokens = sp.contract(sp.record(nb_tokens_sold = sp.nat, min_tez_requested = sp.mutez), self.data.expensive_pool, entrypoint="sell_tokens").unwrap_some()
+            sp.transfer(sp.record(nb_tokens_sold = self.data.nb_tokens, min_tez_requested = sp.tez(0)), sp.tez(0), expensive_pool_sell_tokens)
+            # the tokens and their interest are taken back by the flash loan itself
+            flash_loan_repay = sp.contract(sp.unit, self.data.flash_loan, entrypoint="repay").unwrap_some()
+            sp.transfer((), sp.split_tokens(self.data.tez_amount, 100 + self.data.interest_rate, 100), flash_loan_repay)
 
         @sp.entrypoint
-        def buy_tokens(self, min_tokens_bought):
-            trace("Test")
-            sp.cast(min_tokens_bought, sp.nat)
-            tokens_obtained = sp.as_nat(self.data.tokens_owned - sp.fst(sp.ediv(self.data.K, sp.balance).unwrap_some()))
-            assert tokens_obtained >= min_tokens_bought
-
-            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), self.data.ledger_contract_opt.unwrap_some())
-
-            self.data.tokens_owned = sp.as_nat(self.data.tokens_owned - tokens_obtained)
-            
-
-        @sp.onchain_view
-        def get_token_price(self):
-            # returns what we would get if we sold one token
-            ratio1 = sp.ediv(self.data.K, self.data.tokens_owned).unwrap_some()
-            ratio2 = sp.ediv(self.data.K, sp.as_nat(self.data.tokens_owned - 1)).unwrap_some()
-            sp.trace ("The current value of K is:")
-            sp.trace(self.data.K)
-            sp.trace("The pool owns this amount of tokens:")
-            sp.trace(self.data.tokens_owned)
-            sp.trace("The balance of the pool is:")
-            sp.trace(sp.balance)
-            sp.trace("The ratios before and after a potential purchase of 1 token would be:")
-            sp.trace(ratio1)
-            sp.trace(ratio2)
-            token_price = sp.fst(ratio2) - sp.fst(ratio1)
-            sp.trace("The price of the token returned is:")
-            sp.trace(token_price)
-            return token_price
+        def default(self):
+            pass
 
 @sp.add_test()
 def test():
     alice = sp.test_account("alice")
     bob = sp.test_account("bob")
     carl = sp.test_account("carl")
-    scenario = sp.test_scenario("Test" , main)
-    ledger = main.Ledger(owner = alice.address, total_supply = 10000000)
+    scenario = sp.test_scenario("Test", defi)
+    ledger = defi.Ledger(owner = alice.address, total_supply = 10000000)
 
     scenario += ledger
     
-    lp1 = main.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    lp1 = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
     scenario += lp1
     ledger.allow(sp.record(operator = lp1.address, amount = 1000000), _sender = alice)
     lp1.provide_liquidity(1000000, _sender = alice, _amount = sp.tez(1000))
 
-    lp2 = main.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    lp2 = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
     scenario += lp2
     ledger.allow(sp.record(operator = lp2.address, amount = 1000000), _sender = alice)
     lp2.provide_liquidity(1000000, _sender = alice, _amount = sp.tez(1000))
@@ -148,4 +81,49 @@ def test():
 
     scenario.verify(lp1.get_token_price() > sp.mutez(90))
     scenario.verify(lp2.get_token_price() > sp.mutez(90))
-    
+
+@sp.add_test()
+def test_flash_arbitrage():
+    alice = sp.test_account("alice")
+    bob = sp.test_account("bob")
+    carl = sp.test_account("carl")
+    scenario = sp.test_scenario("Arbitrage with a multi-asset flash loan", [defi, main])
+    ledger = defi.Ledger(owner = alice.address, total_supply = 10000000)
+    scenario += ledger
+
+    lp1 = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += lp1
+    ledger.allow(sp.record(operator = lp1.address, amount = 1000000), _sender = alice)
+    lp1.provide_liquidity(1000000, _sender = alice, _amount = sp.tez(1000))
+
+    lp2 = defi.LiquidityPool(owner = alice.address, ledger = ledger.address)
+    scenario += lp2
+    ledger.allow(sp.record(operator = lp2.address, amount = 1000000), _sender = alice)
+    lp2.provide_liquidity(1000000, _sender = alice, _amount = sp.tez(1000))
+
+    lp1.buy_tokens(80000, _sender = bob, _amount = sp.tez(100))
+
+    flash_loan = defi.MultiAssetFlashLoan(owner = alice.address, interest_rate = 1)
+    scenario += flash_loan
+    asset = sp.record(ledger = ledger.address, token_id = None)
+    ledger.allow(sp.record(operator = flash_loan.address, amount = 100000), _sender = alice)
+    flash_loan.deposit([sp.record(asset = asset, amount = 100000)], _sender = alice, _amount = sp.tez(1000))
+
+    # one borrow of 48 tez and 45802 tokens, one callback, one repayment check
+    arbitrage = main.FlashArbitrage(flash_loan = flash_loan.address, ledger = ledger.address, cheap_pool = lp2.address, expensive_pool = lp1.address,
+                                    tez_amount = sp.tez(48), nb_tokens = 45802, interest_rate = 1)
+    scenario += arbitrage
+    # the bot holds enough tokens to pay the interest on the tokens it borrows
+    ledger.transfer(source = alice.address, destination = arbitrage.address, amount = 1000, _sender = alice)
+    ledger.allow(sp.record(operator = lp1.address, amount = 45802), _sender = arbitrage.address)
+    # the tokens can't be taken back yet: the whole loan is reverted
+    arbitrage.start(_sender = carl, _valid = False)
+    ledger.allow(sp.record(operator = flash_loan.address, amount = 46260), _sender = arbitrage.address)
+    arbitrage.start(_sender = carl)
+
+    scenario.verify(arbitrage.balance == sp.mutez(4281150))
+    scenario.verify(flash_loan.balance == sp.mutez(1000480000))
+    scenario.verify(flash_loan.data.reserves[asset] == 100458)
+    scenario.verify(ledger.data.balances[arbitrage.address] == 1000 + 45802 - 46260)
+    scenario.verify(flash_loan.data.in_progress == False)
+    flash_loan.check_repaid(_sender = carl, _valid = False)
@@ -0,0 +1,520 @@
+import smartpy as sp
+
+# Token, liquidity pool and flash loan contracts shared by the DeFi exercises
+# (Exercices/32_0*.py, Big_exercise/0*.py and their starting templates).
+#
+# Scenarios import this module with
+#
+#     from defi_contracts import defi
+#
+# and pass it to sp.test_scenario before their own module: sp.test_scenario("Test", [defi, main]).
+# Run them from the root of the repository with it on the path, as tools/run_all.py
+# does: PYTHONPATH=. python Exercices/32_04_manipulating_price_solution.py
+
+@sp.module
+def defi():
+    param_type:type = sp.record(source = sp.address, destination = sp.address, amount = sp.nat)
+    batch_type:type = sp.list[sp.record(source = sp.address,
+                                        txs = sp.list[sp.record(destination = sp.address, amount = sp.nat)])]
+
+    class Ledger(sp.Contract):
+        def __init__(self, owner, total_supply):
+            self.data.balances = sp.big_map({ owner : total_supply })
+            self.data.allowances = sp.big_map({})
+
+        @sp.entrypoint
+        def transfer(self, source, destination, amount):
+            if source != sp.sender:
+                allowed = self.data.allowances[(source, sp.sender)]
+                assert allowed >= amount
+                self.data.allowances[(source, sp.sender)] = sp.as_nat(allowed - amount)
+            assert self.data.balances[source] >= amount
+            self.data.balances[source] = sp.as_nat(self.data.balances[source] - amount)
+            if not self.data.balances.contains(destination):
+                self.data.balances[destination] = sp.nat(0)
+            self.data.balances[destination] += amount
+
+        @sp.entrypoint
+        def transfer_batch(self, batch):
+            sp.cast(batch, batch_type)
+            for group in batch:
+                # the source is checked and debited once for the whole group
+                total = sp.nat(0)
+                for tx in group.txs:
+                    total += tx.amount
+                if group.source != sp.sender:
+                    allowed = self.data.allowances[(group.source, sp.sender)]
+                    assert allowed >= total
+                    self.data.allowances[(group.source, sp.sender)] = sp.as_nat(allowed - total)
+                source_balance = self.data.balances[group.source]
+                assert source_balance >= total
+                self.data.balances[group.source] = sp.as_nat(source_balance - total)
+                for tx in group.txs:
+                    if not self.data.balances.contains(tx.destination):
+                        self.data.balances[tx.destination] = sp.nat(0)
+                    self.data.balances[tx.destination] += tx.amount
+
+        @sp.onchain_view
+        def get_balance(self, user):
+            sp.cast(user, sp.address)
+            return self.data.balances[user]
+
+        @sp.entrypoint
+        def allow(self, operator, amount):
+            if not self.data.allowances.contains((sp.sender, operator)):
+                self.data.allowances[(sp.sender, operator)] = 0
+            self.data.allowances[(sp.sender, operator)] += amount
+
+    def marginal_price(pool):
+        # what we would get if we sold one token, as returned by get_token_price. With a
+        # single token left there is no tokens_owned - 1 to divide by, so the price is the
+        # one of the next token sold, K - K / 2, and an empty pool has no price
+        price = sp.tez(0)
+        if pool.tokens_owned > 1:
+            ratio1 = sp.ediv(pool.K, pool.tokens_owned).unwrap_some()
+            ratio2 = sp.ediv(pool.K, sp.as_nat(pool.tokens_owned - 1)).unwrap_some()
+            price = sp.fst(ratio2) - sp.fst(ratio1)
+        else:
+            if pool.tokens_owned == 1:
+                price = pool.K - sp.fst(sp.ediv(pool.K, sp.nat(2)).unwrap_some())
+        return price
+
+    class LiquidityPool(sp.Contract):
+        def __init__(self, owner, ledger):
+            self.data.ledger = ledger
+            self.data.owner = owner
+            self.data.K = sp.tez(0)
+            self.data.tokens_owned = sp.nat(0)
+            # tokens_owned * sp.balance = K -> should always be true
+
+            # time-weighted average price: twap_cumulative is the sum of price * seconds since
+            # twap_start, and twap_observations keeps its value at the start of each of the last
+            # twap_slots periods of twap_period seconds, in a ring indexed by period % twap_slots.
+            # Sums are in mutez * seconds, as nats, which unlike mutez can't overflow
+            self.data.twap_period = sp.nat(600)
+            self.data.twap_slots = sp.nat(24)
+            self.data.twap_cumulative = sp.nat(0)
+            self.data.twap_start = sp.timestamp(0)
+            self.data.last_update = sp.timestamp(0)
+            self.data.last_period = sp.int(0)
+            self.data.twap_observations = sp.big_map({})
+            sp.cast(self.data.twap_observations, sp.big_map[sp.nat, sp.record(period = sp.int, cumulative = sp.nat)])
+
+        @sp.private(with_storage="read-write")
+        def update_twap(self, price):
+            # called before each trade with the current price: the first trade of a block
+            # accumulates the price left by the previous block, the next ones change nothing
+            if sp.now > self.data.last_update:
+                price_in_mutez = sp.fst(sp.ediv(price, sp.mutez(1)).unwrap_some())
+                period = sp.fst(sp.ediv(sp.now - sp.timestamp(0), self.data.twap_period).unwrap_some())
+                # the periods started since the last update, only the last twap_slots ones are kept
+                first_period = self.data.last_period + 1
+                if first_period < period + 1 - sp.to_int(self.data.twap_slots):
+                    first_period = period + 1 - sp.to_int(self.data.twap_slots)
+                while first_period <= period:
+                    period_start = sp.add_seconds(sp.timestamp(0), first_period * sp.to_int(self.data.twap_period))
+                    self.data.twap_observations[sp.snd(sp.ediv(first_period, self.data.twap_slots).unwrap_some())] = sp.record(
+                        period = first_period,
+                        cumulative = self.data.twap_cumulative + price_in_mutez * sp.as_nat(period_start - self.data.last_update))
+                    first_period += 1
+                self.data.twap_cumulative += price_in_mutez * sp.as_nat(sp.now - self.data.last_update)
+                self.data.last_update = sp.now
+                self.data.last_period = period
+
+        @sp.entrypoint
+        def provide_liquidity(self, deposited_tokens):
+            assert sp.sender == self.data.owner
+            assert self.data.K == sp.tez(0)
+            self.data.K = sp.mul(sp.balance, deposited_tokens)
+
+            self.data.tokens_owned = deposited_tokens
+
+            period = sp.fst(sp.ediv(sp.now - sp.timestamp(0), self.data.twap_period).unwrap_some())
+            self.data.twap_start = sp.now
+            self.data.last_update = sp.now
+            self.data.last_period = period
+            self.data.twap_observations[sp.snd(sp.ediv(period, self.data.twap_slots).unwrap_some())] = sp.record(period = period, cumulative = sp.nat(0))
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens), sp.tez(0), ledger_transfer)
+
+        @sp.entrypoint
+        def withdraw_liquidity(self):
+            assert sp.sender == self.data.owner
+            sp.send(sp.sender, sp.balance)
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), ledger_transfer)
+
+            self.data.tokens_owned = sp.nat(0)
+            self.data.K = sp.tez(0)
+
+
+        @sp.entrypoint
+        def sell_tokens(self, nb_tokens_sold, min_tez_requested):
+            self.update_twap(marginal_price(sp.record(K = self.data.K, tokens_owned = self.data.tokens_owned)))
+            ratio = sp.ediv(self.data.K, self.data.tokens_owned + nb_tokens_sold).unwrap_some()
+            tez_obtained = sp.balance - sp.fst(ratio)
+            assert tez_obtained >= min_tez_requested
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), ledger_transfer)
+
+            self.data.tokens_owned += nb_tokens_sold
+            sp.send(sp.sender, tez_obtained)
+
+        @sp.entrypoint
+        def buy_tokens(self, min_tokens_bought):
+            sp.cast(min_tokens_bought, sp.nat)
+            self.update_twap(marginal_price(sp.record(K = self.data.K, tokens_owned = self.data.tokens_owned)))
+            tokens_obtained = sp.as_nat(self.data.tokens_owned - sp.fst(sp.ediv(self.data.K, sp.balance).unwrap_some()))
+            assert tokens_obtained >= min_tokens_bought
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), ledger_transfer)
+
+            self.data.tokens_owned = sp.as_nat(self.data.tokens_owned - tokens_obtained)
+
+
+        @sp.onchain_view
+        def get_token_price(self):
+            # returns what we would get if we sold one token
+            trace("The current value of K is:")
+            trace(self.data.K)
+            trace("The pool owns this amount of tokens:")
+            trace(self.data.tokens_owned)
+            trace("The balance of the pool is:")
+            trace(sp.balance)
+            if self.data.tokens_owned > 1:
+                trace("The ratios before and after a potential purchase of 1 token would be:")
+                trace(sp.ediv(self.data.K, self.data.tokens_owned).unwrap_some())
+                trace(sp.ediv(self.data.K, sp.as_nat(self.data.tokens_owned - 1)).unwrap_some())
+            token_price = marginal_price(sp.record(K = self.data.K, tokens_owned = self.data.tokens_owned))
+            trace("The price of the token returned is:")
+            trace(token_price)
+            return token_price
+
+        @sp.onchain_view
+        def get_twap(self, window):
+            # average price since the start of the period window seconds ago. Trades of the
+            # current block are not counted, so they can't move it
+            sp.cast(window, sp.nat)
+            assert window > 0
+            start_period = sp.fst(sp.ediv(sp.add_seconds(sp.now, -sp.to_int(window)) - sp.timestamp(0), self.data.twap_period).unwrap_some())
+            start = sp.add_seconds(sp.timestamp(0), start_period * sp.to_int(self.data.twap_period))
+            assert start >= self.data.twap_start, "TWAP_WINDOW_TOO_LONG"
+            price = marginal_price(sp.record(K = self.data.K, tokens_owned = self.data.tokens_owned))
+            twap = price
+            # with no trade since start, the price didn't change over the window
+            if self.data.last_update > start:
+                slot = sp.snd(sp.ediv(start_period, self.data.twap_slots).unwrap_some())
+                assert self.data.twap_observations.contains(slot), "TWAP_WINDOW_TOO_LONG"
+                observation = self.data.twap_observations[slot]
+                assert observation.period == start_period, "TWAP_WINDOW_TOO_LONG"
+                price_in_mutez = sp.fst(sp.ediv(price, sp.mutez(1)).unwrap_some())
+                cumulative = self.data.twap_cumulative + price_in_mutez * sp.as_nat(sp.now - self.data.last_update)
+                twap = sp.mul(sp.fst(sp.ediv(sp.as_nat(cumulative - observation.cumulative), sp.as_nat(sp.now - start)).unwrap_some()), sp.mutez(1))
+            return twap
+
+    swap_type:type = sp.variant(buy = sp.record(tez_in = sp.mutez, min_tokens_out = sp.nat),
+                                sell = sp.record(tokens_in = sp.nat, min_tez_out = sp.mutez))
+
+    def tokens_out(params):
+        # tokens obtained for params.tez_in, once the fee is deducted: x * y <= (x + dx) * (y - dy)
+        net_tez_in = params.tez_in - sp.split_tokens(params.tez_in, params.fee_rate, 10000)
+        return sp.fst(sp.ediv(sp.mul(net_tez_in, params.token_reserve), params.tez_reserve + net_tez_in).unwrap_some())
+
+    def tez_out(params):
+        # tez obtained for params.tokens_in, once the fee is deducted
+        net_tokens_in = sp.as_nat(params.tokens_in - (params.tokens_in * params.fee_rate) / 10000)
+        return sp.fst(sp.ediv(sp.mul(params.tez_reserve, net_tokens_in), params.token_reserve + net_tokens_in).unwrap_some())
+
+    class FeeLiquidityPool(sp.Contract):
+        def __init__(self, owner, ledger, fee_rate):
+            # constant product pool of Exercices/32_02 and Big_exercise/04. fee_rate is in
+            # basis points; fees stay in the reserves and accrue to the liquidity
+            self.data.ledger = ledger
+            self.data.owner = owner
+            self.data.fee_rate = fee_rate
+            sp.cast(self.data.fee_rate, sp.nat)
+            self.data.tez_reserve = sp.tez(0)
+            self.data.token_reserve = sp.nat(0)
+            self.data.tez_fees = sp.tez(0)
+            self.data.token_fees = sp.nat(0)
+
+        @sp.entrypoint
+        def provide_liquidity(self, deposited_tokens):
+            assert sp.sender == self.data.owner
+            assert self.data.token_reserve == 0
+            self.data.tez_reserve = sp.amount
+            self.data.token_reserve = deposited_tokens
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = deposited_tokens), sp.tez(0), ledger_transfer)
+
+        @sp.entrypoint
+        def withdraw_liquidity(self):
+            assert sp.sender == self.data.owner
+            sp.send(sp.sender, sp.balance)
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.token_reserve), sp.tez(0), ledger_transfer)
+
+            self.data.token_reserve = sp.nat(0)
+            self.data.tez_reserve = sp.tez(0)
+
+        @sp.entrypoint
+        def set_fee_rate(self, fee_rate):
+            assert sp.sender == self.data.owner
+            assert fee_rate < 10000
+            self.data.fee_rate = fee_rate
+
+        @sp.entrypoint
+        def sell_tokens(self, nb_tokens_sold, min_tez_requested):
+            tez_obtained = tez_out(sp.record(tokens_in = nb_tokens_sold, fee_rate = self.data.fee_rate,
+                                             tez_reserve = self.data.tez_reserve, token_reserve = self.data.token_reserve))
+            assert tez_obtained >= min_tez_requested
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = nb_tokens_sold), sp.tez(0), ledger_transfer)
+
+            self.data.token_fees += (nb_tokens_sold * self.data.fee_rate) / 10000
+            self.data.token_reserve += nb_tokens_sold
+            self.data.tez_reserve -= tez_obtained
+            sp.send(sp.sender, tez_obtained)
+
+        @sp.entrypoint
+        def buy_tokens(self, min_tokens_bought):
+            sp.cast(min_tokens_bought, sp.nat)
+            tokens_obtained = tokens_out(sp.record(tez_in = sp.amount, fee_rate = self.data.fee_rate,
+                                                   tez_reserve = self.data.tez_reserve, token_reserve = self.data.token_reserve))
+            assert tokens_obtained >= min_tokens_bought
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = tokens_obtained), sp.tez(0), ledger_transfer)
+
+            self.data.tez_fees += sp.split_tokens(sp.amount, self.data.fee_rate, 10000)
+            self.data.tez_reserve += sp.amount
+            self.data.token_reserve = sp.as_nat(self.data.token_reserve - tokens_obtained)
+
+        @sp.entrypoint
+        def swap_batch(self, swaps, deadline):
+            # executes the swaps in order against the updated reserves, then settles
+            # the net token and tez amounts with at most one transfer each
+            sp.cast(swaps, sp.list[swap_type])
+            assert sp.now <= deadline, "DEADLINE_PASSED"
+            total_tez_in = sp.tez(0)
+            total_tez_out = sp.tez(0)
+            total_tokens_in = sp.nat(0)
+            total_tokens_out = sp.nat(0)
+            for swap in swaps:
+                if swap.is_variant.buy():
+                    buy = swap.unwrap.buy()
+                    tokens_obtained = tokens_out(sp.record(tez_in = buy.tez_in, fee_rate = self.data.fee_rate,
+                                                           tez_reserve = self.data.tez_reserve, token_reserve = self.data.token_reserve))
+                    assert tokens_obtained >= buy.min_tokens_out, "MIN_TOKENS_OUT"
+                    self.data.tez_fees += sp.split_tokens(buy.tez_in, self.data.fee_rate, 10000)
+                    self.data.tez_reserve += buy.tez_in
+                    self.data.token_reserve = sp.as_nat(self.data.token_reserve - tokens_obtained)
+                    total_tez_in += buy.tez_in
+                    total_tokens_out += tokens_obtained
+                else:
+                    sell = swap.unwrap.sell()
+                    tez_obtained = tez_out(sp.record(tokens_in = sell.tokens_in, fee_rate = self.data.fee_rate,
+                                                     tez_reserve = self.data.tez_reserve, token_reserve = self.data.token_reserve))
+                    assert tez_obtained >= sell.min_tez_out, "MIN_TEZ_OUT"
+                    self.data.token_fees += (sell.tokens_in * self.data.fee_rate) / 10000
+                    self.data.token_reserve += sell.tokens_in
+                    self.data.tez_reserve -= tez_obtained
+                    total_tokens_in += sell.tokens_in
+                    total_tez_out += tez_obtained
+            assert sp.amount == total_tez_in, "WRONG_AMOUNT"
+
+            if total_tokens_in > total_tokens_out:
+                ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+                sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = sp.as_nat(total_tokens_in - total_tokens_out)),
+                            sp.tez(0), ledger_transfer)
+            if total_tokens_out > total_tokens_in:
+                ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+                sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = sp.as_nat(total_tokens_out - total_tokens_in)),
+                            sp.tez(0), ledger_transfer)
+            if total_tez_out > sp.tez(0):
+                sp.send(sp.sender, total_tez_out)
+
+        @sp.onchain_view
+        def get_token_price(self):
+            # returns what we would get if we sold one token
+            return tez_out(sp.record(tokens_in = 1, fee_rate = self.data.fee_rate,
+                                     tez_reserve = self.data.tez_reserve, token_reserve = self.data.token_reserve))
+
+    class FlashLoanTez(sp.Contract):
+        def __init__(self, owner, interest_rate):
+            self.data.owner = owner
+            self.data.interest_rate = interest_rate
+            # one entry per open loan, so that loans of different borrowers never share state
+            self.data.loans = sp.big_map({})
+            sp.cast(self.data.loans, sp.big_map[sp.address, sp.record(amount = sp.mutez, repaid = sp.bool)])
+
+        @sp.entrypoint
+        def deposit(self):
+            pass
+
+        @sp.entrypoint
+        def borrow(self, loan_amount, callback):
+            assert not self.data.loans.contains(sp.sender)
+            self.data.loans[sp.sender] = sp.record(amount = loan_amount, repaid = False)
+            sp.send(sp.sender, loan_amount)
+
+            sp.transfer((), sp.tez(0), callback)
+
+            sp.transfer(sp.sender, sp.tez(0), sp.self_entrypoint("check_repaid"))
+
+        @sp.entrypoint
+        def repay(self):
+            loan = self.data.loans[sp.sender]
+            assert sp.amount >= sp.split_tokens(loan.amount, 100 + self.data.interest_rate, 100)
+            self.data.loans[sp.sender].repaid = True
+
+        @sp.entrypoint
+        def check_repaid(self, borrower):
+            assert sp.sender == sp.self_address()
+            assert self.data.loans[borrower].repaid
+            del self.data.loans[borrower]
+
+        @sp.entrypoint
+        def claim(self):
+            assert sp.sender == self.data.owner
+            sp.send(sp.sender, sp.balance)
+
+    class FlashLoan(sp.Contract):
+        def __init__(self, owner, ledger, interest_rate):
+            self.data.ledger = ledger
+            self.data.owner = owner
+            self.data.interest_rate = interest_rate
+            self.data.in_progress = False
+            self.data.loan_amount = sp.nat(0)
+            self.data.tokens_owned = sp.nat(0)
+            self.data.borrower = owner
+
+        @sp.entrypoint
+        def deposit(self, tokens_deposited):
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.sender, destination = sp.self_address(), amount = tokens_deposited), sp.tez(0), ledger_transfer)
+            self.data.tokens_owned = tokens_deposited
+
+        @sp.entrypoint
+        def borrow(self, loan_amount, callback):
+            assert not self.data.in_progress
+            self.data.in_progress = True
+
+            self.data.borrower = sp.sender
+
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = loan_amount), sp.tez(0), ledger_transfer)
+            self.data.loan_amount = loan_amount
+
+            sp.transfer((), sp.tez(0), callback)
+
+            sp.transfer((), sp.tez(0), sp.self_entrypoint("check_repaid"))
+
+        @sp.entrypoint
+        def check_repaid(self):
+            assert self.data.in_progress
+            amount_repaid = (self.data.loan_amount * (100 + self.data.interest_rate)) / 100
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = self.data.borrower, destination = sp.self_address(), amount = amount_repaid), sp.tez(0), ledger_transfer)
+            self.data.in_progress = False
+
+        @sp.entrypoint
+        def claim(self):
+            assert sp.sender == self.data.owner
+            assert not self.data.in_progress
+            ledger_transfer = sp.contract(param_type, self.data.ledger, entrypoint="transfer").unwrap_some()
+            sp.transfer(sp.record(source = sp.self_address(), destination = sp.sender, amount = self.data.tokens_owned), sp.tez(0), ledger_transfer)
+            self.data.tokens_owned = sp.nat(0)
+
+    asset_type:type = sp.record(ledger = sp.address, token_id = sp.option[sp.nat])
+    token_amount_type:type = sp.record(asset = asset_type, amount = sp.nat)
+    fa2_transfer_type:type = sp.list[sp.record(from_ = sp.address,
+                                               txs = sp.list[sp.record(to_ = sp.address, token_id = sp.nat, amount = sp.nat)])]
+
+    class MultiAssetFlashLoan(sp.Contract):
+        def __init__(self, owner, interest_rate):
+            # lends tez and tokens of any number of ledgers in a single borrow. An asset
+            # with no token_id is a Ledger as above, one with a token_id is an FA2 token
+            self.data.owner = owner
+            self.data.interest_rate = interest_rate
+            self.data.reserves = sp.big_map({})
+            sp.cast(self.data.reserves, sp.big_map[asset_type, sp.nat])
+            self.data.in_progress = False
+            self.data.borrower = owner
+            self.data.expected_balance = sp.tez(0)
+            self.data.token_loans = []
+            sp.cast(self.data.token_loans, sp.list[token_amount_type])
+
+        @sp.private(with_operations=True)
+        def send_tokens(self, tx):
+            if tx.asset.token_id.is_some():
+                fa2_transfer = sp.contract(fa2_transfer_type, tx.asset.ledger, entrypoint="transfer").unwrap_some()
+                sp.transfer([sp.record(from_ = tx.source, txs = [sp.record(to_ = tx.destination, token_id = tx.asset.token_id.unwrap_some(), amount = tx.amount)])],
+                            sp.tez(0), fa2_transfer)
+            else:
+                ledger_transfer = sp.contract(param_type, tx.asset.ledger, entrypoint="transfer").unwrap_some()
+                sp.transfer(sp.record(source = tx.source, destination = tx.destination, amount = tx.amount), sp.tez(0), ledger_transfer)
+
+        @sp.entrypoint
+        def deposit(self, tokens):
+            # tez are deposited as the amount of the call, tokens must be allowed to this contract
+            sp.cast(tokens, sp.list[token_amount_type])
+            for token in tokens:
+                self.send_tokens(sp.record(asset = token.asset, source = sp.sender, destination = sp.self_address(), amount = token.amount))
+                if not self.data.reserves.contains(token.asset):
+                    self.data.reserves[token.asset] = sp.nat(0)
+                self.data.reserves[token.asset] += token.amount
+
+        @sp.entrypoint
+        def borrow(self, tez_amount, tokens, callback):
+            sp.cast(tokens, sp.list[token_amount_type])
+            assert not self.data.in_progress
+            self.data.in_progress = True
+            self.data.borrower = sp.sender
+            self.data.token_loans = tokens
+
+            for token in tokens:
+                self.data.reserves[token.asset] = sp.as_nat(self.data.reserves[token.asset] - token.amount)
+                self.send_tokens(sp.record(asset = token.asset, source = sp.self_address(), destination = sp.sender, amount = token.amount))
+            # tez come back through repay, so the balance after the callbacks is all there is to check
+            self.data.expected_balance = sp.balance + sp.split_tokens(tez_amount, self.data.interest_rate, 100)
+            if tez_amount > sp.tez(0):
+                sp.send(sp.sender, tez_amount)
+
+            sp.transfer((), sp.tez(0), callback)
+
+            sp.transfer((), sp.tez(0), sp.self_entrypoint("check_repaid"))
+
+        @sp.entrypoint
+        def repay(self):
+            assert self.data.in_progress
+
+        @sp.entrypoint
+        def check_repaid(self):
+            # one check for all the assets: the tez balance, and the tokens pulled back from the borrower
+            assert sp.sender == sp.self_address()
+            assert self.data.in_progress
+            assert sp.balance >= self.data.expected_balance
+            for token in self.data.token_loans:
+                amount_repaid = (token.amount * (100 + self.data.interest_rate)) / 100
+                self.send_tokens(sp.record(asset = token.asset, source = self.data.borrower, destination = sp.self_address(), amount = amount_repaid))
+                self.data.reserves[token.asset] += amount_repaid
+            self.data.token_loans = []
+            self.data.in_progress = False
+
+        @sp.entrypoint
+        def claim(self, assets):
+            sp.cast(assets, sp.list[asset_type])
+            assert sp.sender == self.data.owner
+            assert not self.data.in_progress
+            for asset in assets:
+                self.send_tokens(sp.record(asset = asset, source = sp.self_address(), destination = sp.sender, amount = self.data.reserves[asset]))
+                self.data.reserves[asset] = sp.nat(0)
+            sp.send(sp.sender, sp.balance)
@@ -1,5 +1,7 @@
 import smartpy as sp
 
+from tools import michelson, multisig_signatures
+
 @sp.module
 def main():
     @sp.effects(with_operations=True)
@@ -7,11 +9,21 @@ def main():
         sp.send(sp.address("tz142114b421"), sp.tez(100))
 
     class Multisig(sp.Contract):
-       def __init__(self, participants, required_votes):
-           sp.cast(participants, sp.map[sp.address, sp.bool])
+       def __init__(self, admin, participants, required_weight):
+           # weight of each participant: a vote only reads the weight of its voter
+           sp.cast(participants, sp.big_map[sp.address, sp.nat])
+           self.data.admin = admin
            self.data.participants = participants
+           # a vote only reads and writes the small record of its proposal and one
+           # (proposal_id, voter) key; the code is only loaded once the threshold is reached
            self.data.proposals = sp.big_map({})
-           self.data.required_votes = required_votes
+           sp.cast(self.data.proposals, sp.big_map[sp.nat, sp.record(deadline = sp.timestamp, approved_weight = sp.nat)])
+           self.data.codes = sp.big_map({})
+           sp.cast(self.data.codes, sp.big_map[sp.nat, sp.lambda_(sp.unit, sp.unit, with_operations=True)])
+           self.data.votes = sp.big_map({})
+           sp.cast(self.data.votes, sp.big_map[sp.pair[sp.nat, sp.address], sp.unit])
+           self.data.required_weight = required_weight
+           sp.cast(self.data.required_weight, sp.nat)
            self.data.next_id = 0
 
        @sp.entrypoint
@@ -19,12 +31,11 @@ def main():
            sp.cast(code, sp.lambda_(sp.unit, sp.unit, with_operations=True))
            sp.cast(deadline, sp.timestamp)
            assert self.data.participants.contains(sp.sender)
-           self.data.proposals[self.data.next_id] =  sp.record(
-               code = code,
+           self.data.proposals[self.data.next_id] = sp.record(
                deadline = deadline,
-               nb_approved = 0,
-               has_voted = {}
+               approved_weight = 0
            )
+           self.data.codes[self.data.next_id] = code
            self.data.next_id += 1
            
        @sp.entrypoint
@@ -32,12 +43,57 @@ def main():
            proposal = self.data.proposals[proposal_id]
            assert sp.now < proposal.deadline
            assert self.data.participants.contains(sp.sender)
-           assert not proposal.has_voted.contains(sp.sender)
-           proposal.has_voted[sp.sender] = True
-           proposal.nb_approved += 1
+           assert not self.data.votes.contains((proposal_id, sp.sender))
+           self.data.votes[(proposal_id, sp.sender)] = ()
+           # the weight of the voter when voting counts, even if it is changed later
+           proposal.approved_weight += self.data.participants[sp.sender]
            self.data.proposals[proposal_id] = proposal
-           if proposal.nb_approved == self.data.required_votes:
-               proposal.code()
+           if proposal.approved_weight >= self.data.required_weight and self.data.codes.contains(proposal_id):
+               code = self.data.codes[proposal_id]
+               del self.data.codes[proposal_id]
+               code()
+
+       @sp.entrypoint
+       def execute_with_signatures(self, proposal_id, signatures):
+           # approvals signed off-chain over sp.pack((contract, proposal_id)), counted with the
+           # votes already cast: a single operation can reach the threshold. Proposal ids are
+           # never reused and the code of a proposal is deleted when it runs, so an approval
+           # can't be replayed, and executing a proposal leaves the approvals of the others valid
+           sp.cast(signatures, sp.list[sp.record(signature = sp.signature, signer = sp.key)])
+           proposal = self.data.proposals[proposal_id]
+           assert sp.now < proposal.deadline
+           payload = sp.pack((sp.self_address(), proposal_id))
+           signers = sp.set()
+           for approval in signatures:
+               signer = sp.to_address(sp.implicit_account(sp.hash_key(approval.signer)))
+               assert self.data.participants.contains(signer)
+               assert sp.check_signature(approval.signer, approval.signature, payload)
+               if not signers.contains(signer) and not self.data.votes.contains((proposal_id, signer)):
+                   signers.add(signer)
+                   proposal.approved_weight += self.data.participants[signer]
+           assert proposal.approved_weight >= self.data.required_weight
+           self.data.proposals[proposal_id] = proposal
+           code = self.data.codes[proposal_id]
+           del self.data.codes[proposal_id]
+           code()
+
+       @sp.entrypoint
+       def update_participants(self, changes):
+           # adds, reweights or removes (weight None) any number of participants at once
+           sp.cast(changes, sp.list[sp.record(participant = sp.address, weight = sp.option[sp.nat])])
+           assert sp.sender == self.data.admin
+           for change in changes:
+               match change.weight:
+                   case Some(weight):
+                       self.data.participants[change.participant] = weight
+                   case None:
+                       del self.data.participants[change.participant]
+
+       @sp.entrypoint
+       def set_required_weight(self, required_weight):
+           assert sp.sender == self.data.admin
+           assert required_weight > 0
+           self.data.required_weight = required_weight
 
 @sp.add_test()
 def test():
@@ -45,13 +101,127 @@ def test():
     bob=sp.test_account("Bob")
     eve=sp.test_account("Eve")
     sc = sp.test_scenario("Test", main)
-    multi_sig = main.Multisig(participants = {
-        alice.address: True,
-        bob.address: True
-    }, required_votes = 2)
+    admin=sp.test_account("Admin")
+    multi_sig = main.Multisig(admin = admin.address, participants = sp.big_map({
+        alice.address: 1,
+        bob.address: 1
+    }), required_weight = 2)
     sc += multi_sig
     multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = alice, _amount = sp.tez(200))
     multi_sig.vote(0, _sender = alice)
+    multi_sig.vote(0, _sender = alice, _valid = False)
+    multi_sig.vote(0, _sender = eve, _valid = False)
+    multi_sig.vote(0, _sender = bob)
+    sc.verify(multi_sig.balance == sp.tez(100))
+    sc.verify(multi_sig.data.codes.contains(0) == False)
+
+@sp.add_test()
+def test_signatures():
+    alice=sp.test_account("Alice")
+    bob=sp.test_account("Bob")
+    carl=sp.test_account("Carl")
+    eve=sp.test_account("Eve")
+    sc = sp.test_scenario("Execution with off-chain signatures", main)
+    admin=sp.test_account("Admin")
+    multi_sig = main.Multisig(admin = admin.address, participants = sp.big_map({
+        alice.address: 1,
+        bob.address: 1,
+        carl.address: 1
+    }), required_weight = 2)
+    sc += multi_sig
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = alice, _amount = sp.tez(200))
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = alice)
+    # what tools/multisig_signatures.py signs for each participant
+    payload_0 = sp.pack((multi_sig.address, sp.nat(0)))
+    payload_1 = sp.pack((multi_sig.address, sp.nat(1)))
+    def approval(account, payload):
+        return sp.record(signature = sp.make_signature(account.secret_key, payload), signer = account.public_key)
+    # bob approves proposal 1 before proposal 0 is executed
+    bob_approval_1 = approval(bob, payload_1)
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = [approval(alice, payload_0), approval(alice, payload_0)], _sender = eve, _valid = False)
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = [approval(alice, payload_0), approval(eve, payload_0)], _sender = eve, _valid = False)
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = [approval(alice, payload_0), approval(bob, payload_0)], _sender = eve)
+    sc.verify(multi_sig.balance == sp.tez(100))
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = [approval(alice, payload_0), approval(bob, payload_0)], _sender = eve, _valid = False)
+
+    # an on-chain vote and a signature reach the threshold together; an approval of
+    # another proposal doesn't count, the one bob signed earlier is still valid
+    multi_sig.vote(1, _sender = carl)
+    multi_sig.execute_with_signatures(proposal_id = 1, signatures = [approval(bob, payload_0)], _sender = eve, _valid = False)
+    multi_sig.execute_with_signatures(proposal_id = 1, signatures = [bob_approval_1], _sender = eve)
+    sc.verify(multi_sig.balance == sp.tez(0))
+
+@sp.add_test()
+def test_tool_signatures():
+    # approvals made off-chain by tools/multisig_signatures.py execute the proposal
+    contract = "KT1TezoooozzSmartPyzzSTATiCzzzwwBFA1"  # address of the first contract originated in a scenario
+    secret_keys = ["edsk46oN6URWHBdL6zCYPNPFd9kFjL3qYKaZFAGS6ESsK4E6D1xt4u", "edsk2gMmwLq9CLVScnvbSJQSqqrtxUzJgcjLtMrQMTdANaHtvChhUC"]
+    participants = [sp.address(michelson.key_hash(michelson.public_key(secret_key))) for secret_key in secret_keys]
+    eve=sp.test_account("Eve")
+    sc = sp.test_scenario("Execution with the signatures of the tool", main)
+    admin=sp.test_account("Admin")
+    multi_sig = main.Multisig(admin = admin.address, participants = sp.big_map({participant: 1 for participant in participants}), required_weight = 2)
+    sc += multi_sig
+    sc.verify(multi_sig.address == sp.address(contract))
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = participants[0], _amount = sp.tez(200))
+    sc.verify(sp.pack((multi_sig.address, sp.nat(0))) == sp.bytes("0x" + multisig_signatures.payload(contract, 0).hex()))
+    approvals = [multisig_signatures.approve(secret_key, contract, 0) for secret_key in secret_keys]
+    valid, rejected = multisig_signatures.aggregate(approvals + approvals[:1], contract, 0)
+    def signatures(approvals):
+        return [sp.record(signature = sp.signature(approval["signature"]), signer = sp.key(approval["signer"])) for approval in approvals]
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = signatures(valid[:1]), _sender = eve, _valid = False)
+    multi_sig.execute_with_signatures(proposal_id = 0, signatures = signatures(valid), _sender = eve)
+    sc.verify(multi_sig.balance == sp.tez(100))
+
+@sp.add_test()
+def test_weights():
+    admin=sp.test_account("Admin")
+    alice=sp.test_account("Alice")
+    bob=sp.test_account("Bob")
+    carl=sp.test_account("Carl")
+    dave=sp.test_account("Dave")
+    sc = sp.test_scenario("Weighted votes and rotation of the participants", main)
+    multi_sig = main.Multisig(admin = admin.address, participants = sp.big_map({
+        alice.address: 2,
+        bob.address: 1,
+        carl.address: 1
+    }), required_weight = 3)
+    sc += multi_sig
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = alice, _amount = sp.tez(200))
     multi_sig.vote(0, _sender = bob)
-    
-    
+    multi_sig.vote(0, _sender = carl)
+    sc.verify(multi_sig.data.proposals[0].approved_weight == 2)
+    sc.verify(multi_sig.balance == sp.tez(200))
+    multi_sig.vote(0, _sender = alice)
+    sc.verify(multi_sig.balance == sp.tez(100))
+
+    changes = [
+        sp.record(participant = bob.address, weight = None),
+        sp.record(participant = carl.address, weight = sp.Some(sp.nat(2))),
+        sp.record(participant = dave.address, weight = sp.Some(sp.nat(1)))
+    ]
+    multi_sig.update_participants(changes, _sender = alice, _valid = False)
+    multi_sig.update_participants(changes, _sender = admin)
+    multi_sig.set_required_weight(0, _sender = admin, _valid = False)
+    multi_sig.set_required_weight(4, _sender = admin)
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = dave)
+    multi_sig.vote(1, _sender = bob, _valid = False)
+    multi_sig.vote(1, _sender = carl)
+    multi_sig.vote(1, _sender = dave)
+    sc.verify(multi_sig.balance == sp.tez(100))
+    multi_sig.vote(1, _sender = alice)
+    sc.verify(multi_sig.balance == sp.tez(0))
+
+@sp.add_test()
+def test_vote_gas():
+    participants = [sp.test_account("participant_%d" % i) for i in range(200)]
+    # the gas of each vote (tools/benchmark.py) grows neither with the number of
+    # votes cast nor with the number of participants
+    sc = sp.test_scenario("Vote gas with 200 participants", main)
+    admin=sp.test_account("Admin")
+    multi_sig = main.Multisig(admin = admin.address, participants = sp.big_map({participant.address: 1 for participant in participants}), required_weight = 20)
+    sc += multi_sig
+    multi_sig.propose(code = main.transfer_proposal, deadline = sp.timestamp(100), _sender = participants[0], _amount = sp.tez(100))
+    for participant in participants[:20]:
+        multi_sig.vote(0, _sender = participant)
+    sc.verify(multi_sig.balance == sp.tez(0))
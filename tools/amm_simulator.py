@@ -0,0 +1,88 @@
+"""Off-chain simulator of the LiquidityPool pricing.
+
+Reproduces, with NumPy int64 arrays, the exact integer arithmetic of the
+`LiquidityPool` contract of the DeFi exercises (32_03, 32_04, Big_exercise),
+where `K = balance * tokens_owned` is fixed when the liquidity is provided:
+
+    buy_tokens:      tokens = tokens_owned - ediv(K, balance + amount)
+    sell_tokens:     tez = balance - ediv(K, tokens_owned + nb_tokens_sold)
+    get_token_price: ediv(K, tokens_owned - 1) - ediv(K, tokens_owned)
+                     K - ediv(K, 2) with one token left, 0 with none
+
+Amounts of tez are in mutez. Every function accepts scalars or arrays of
+trade sizes and returns the result together with a `valid` mask, False
+where the contract would fail (negative `sp.as_nat`, mutez underflow or
+division by zero). Mutez are int64 on chain, so int64 arithmetic is exact
+for every state the contract can reach.
+
+    python tools/amm_simulator.py    # best arbitrage of the 32_03 scenario
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Pool(NamedTuple):
+    K: int
+    balance: int
+    tokens_owned: int
+
+
+def provide_liquidity(tez, tokens):
+    return Pool(K = tez * tokens, balance = tez, tokens_owned = tokens)
+
+
+def _ediv(a, b):
+    b = np.asarray(b, dtype = np.int64)
+    safe_b = np.where(b > 0, b, 1)
+    return np.floor_divide(np.int64(a), safe_b), b > 0
+
+
+def buy_tokens(pool, amount):
+    """Tokens obtained by sending `amount` mutez, and the resulting pools."""
+    amount = np.asarray(amount, dtype = np.int64)
+    balance = pool.balance + amount
+    ratio, valid = _ediv(pool.K, balance)
+    tokens = pool.tokens_owned - ratio
+    valid &= tokens >= 0
+    return tokens, valid, Pool(pool.K, balance, pool.tokens_owned - tokens)
+
+
+def sell_tokens(pool, nb_tokens_sold):
+    """Mutez obtained by selling `nb_tokens_sold`, and the resulting pools."""
+    nb_tokens_sold = np.asarray(nb_tokens_sold, dtype = np.int64)
+    ratio, valid = _ediv(pool.K, pool.tokens_owned + nb_tokens_sold)
+    tez = pool.balance - ratio
+    valid &= tez >= 0
+    return tez, valid, Pool(pool.K, pool.balance - tez, pool.tokens_owned + nb_tokens_sold)
+
+
+def get_token_price(pool):
+    """Mutez returned by the get_token_price view."""
+    tokens_owned = np.asarray(pool.tokens_owned, dtype = np.int64)
+    ratio1, _ = _ediv(pool.K, tokens_owned)
+    ratio2, _ = _ediv(pool.K, tokens_owned - 1)
+    price = np.where(tokens_owned > 1, ratio2 - ratio1, np.where(tokens_owned == 1, pool.K - pool.K // 2, 0))
+    return price, tokens_owned >= 0
+
+
+def arbitrage_profit(buy_pool, sell_pool, amount):
+    """Profit in mutez of buying tokens with `amount` in one pool and selling them in the other."""
+    tokens, valid_buy, _ = buy_tokens(buy_pool, amount)
+    tez, valid_sell, _ = sell_tokens(sell_pool, np.where(valid_buy, tokens, 0))
+    return tez - np.asarray(amount, dtype = np.int64), valid_buy & valid_sell
+
+
+if __name__ == "__main__":
+    # state of the 32_03 arbitrage scenario after bob's purchase on lp1
+    lp1 = provide_liquidity(1000 * 10**6, 1000000)
+    _, _, lp1 = buy_tokens(lp1, 100 * 10**6)
+    lp2 = provide_liquidity(1000 * 10**6, 1000000)
+
+    amounts = np.arange(1, 100 * 10**6, 10, dtype = np.int64)
+    profits, valid = arbitrage_profit(lp2, lp1, amounts)
+    profits = np.where(valid, profits, np.iinfo(np.int64).min)
+    best = int(np.argmax(profits))
+    print("%d candidate amounts evaluated" % len(amounts))
+    print("best: spend %d mutez on lp2, profit %d mutez" % (amounts[best], profits[best]))
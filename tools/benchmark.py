@@ -0,0 +1,228 @@
+"""Gas and storage cost benchmark of every scenario of the course.
+
+Runs the scenarios found by `scenarios.discover` and writes one row per
+origination and per entrypoint call:
+
+    file, scenario, step, contract, kind, entrypoint, status,
+    gas, storage_size, storage_diff, operation_size, internal_calls
+
+Rows are built from the structured lines SmartPy writes in the log of each
+scenario: the `file step_<step>_cont_<contract>_...` outputs of a step, the
+`Executing <entrypoint>(...)` line of its call (the following ones are its
+internal operations), the ` -> <storage>` Michelson it leaves and the
+`Expected error` of the calls meant to fail. Sizes are in bytes of that
+Michelson and of the parameter of the call.
+
+The native SmartPy interpreter doesn't measure gas: it is read from the
+`Consumed gas:` receipts of octez-client, which SmartPy uses in mockup mode
+(`--mode mockup`, the default, needs octez-client on the PATH). Every applied
+call must then have its gas, or the benchmark fails. `--mode native` only
+measures the sizes and leaves the gas empty.
+
+Rows are sorted so that two reports can be diffed directly, and `--compare`
+prints the rows whose gas or storage grew compared to a previous report:
+
+    python tools/benchmark.py --output bench.json
+    python tools/benchmark.py --output new.json --compare bench.json
+    python tools/benchmark.py --mode native --output sizes.csv
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+
+import scenarios
+
+FIELDS = ["file", "scenario", "step", "contract", "kind", "entrypoint", "status",
+          "gas", "storage_size", "storage_diff", "operation_size", "internal_calls"]
+FILE_LINE = re.compile(r"^file (\S+)(?: contract (\w+))?$")
+EXECUTING_LINE = re.compile(r"^Executing (\w+)\(")
+STORAGE_LINE = re.compile(r"^ -> (.*)$")
+CONSUMED_GAS = re.compile(r"Consumed gas: (\d+(?:\.\d+)?)")
+MODES = {"native": None, "mockup": "--mode mockup"}
+
+
+class MissingGas(Exception):
+    pass
+
+
+def parse_log(path):
+    """Maps (step, contract) to what the scenario log says of that step.
+
+    Each value has the kind of the step, its entrypoint (or the class of the
+    originated contract), its status, the Michelson storage it leaves, the
+    number of internal calls it made and the gas of its receipts, if any.
+    """
+    steps = {}
+    if not os.path.isfile(path):
+        return steps
+    current = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("Creating contract "):
+                current = {"kind": "origination", "key": None, "entrypoint": None, "status": "applied",
+                           "storage": None, "internal_calls": 0, "gas": []}
+                continue
+            match = FILE_LINE.match(line)
+            if match:
+                step_match = scenarios.STEP_FILE.search(match.group(1))
+                if step_match is None:
+                    continue
+                key = (int(step_match.group(1)), int(step_match.group(2)))
+                if current is None or current["key"] not in (None, key):
+                    current = {"kind": "call", "key": None, "entrypoint": None, "status": "applied",
+                               "storage": None, "internal_calls": 0, "gas": []}
+                if current["key"] is None:
+                    current["key"] = key
+                    steps[key] = current
+                if match.group(2):
+                    current["entrypoint"] = match.group(2)
+                continue
+            if current is None:
+                continue
+            match = EXECUTING_LINE.match(line)
+            if match:
+                if current["kind"] == "call" and current["entrypoint"] is None:
+                    current["entrypoint"] = match.group(1)
+                else:
+                    current["internal_calls"] += 1
+                continue
+            match = STORAGE_LINE.match(line)
+            if match and current["storage"] is None:
+                current["storage"] = match.group(1)
+                continue
+            if line.startswith("Expected error"):
+                current["status"] = "failed"
+            current["gas"].extend(float(gas) for gas in CONSUMED_GAS.findall(line))
+    return steps
+
+
+def collect(result, require_gas = False):
+    """Builds the benchmark rows of one file from its scenario outputs.
+
+    With require_gas, raises MissingGas if an applied step has no gas receipt.
+    """
+    params = {}
+    for scenario, step, contract, kind, path in scenarios.step_files(result["output_dir"]):
+        if kind == "params.tz":
+            params[(scenario, step, contract)] = os.path.getsize(path)
+    rows = []
+    missing = []
+    for scenario in sorted(os.listdir(result["output_dir"])):
+        log = os.path.join(result["output_dir"], scenario, "log.txt")
+        last_storage = {}
+        for (step, contract), parsed in sorted(parse_log(log).items()):
+            storage_size = len(parsed["storage"].encode()) if parsed["storage"] is not None else None
+            previous = last_storage.get(contract)
+            if storage_size is not None:
+                last_storage[contract] = storage_size
+            gas = round(sum(parsed["gas"]), 3) if parsed["gas"] else None
+            if require_gas and gas is None and parsed["status"] == "applied":
+                missing.append("%s [%s] step %d cont %d %s" % (result["file"], scenario, step, contract, parsed["entrypoint"]))
+            rows.append({
+                "file": result["file"],
+                "scenario": scenario,
+                "step": step,
+                "contract": contract,
+                "kind": parsed["kind"],
+                "entrypoint": parsed["entrypoint"],
+                "status": parsed["status"],
+                "gas": gas,
+                "storage_size": storage_size,
+                "storage_diff": None if storage_size is None or previous is None else storage_size - previous,
+                "operation_size": params.get((scenario, step, contract)),
+                "internal_calls": parsed["internal_calls"],
+            })
+    if missing:
+        raise MissingGas("no gas receipt for %d steps:\n  %s" % (len(missing), "\n  ".join(missing)))
+    return rows
+
+
+def write_report(rows, path):
+    if path.endswith(".csv"):
+        with open(path, "w", newline = "") as f:
+            writer = csv.DictWriter(f, fieldnames = FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as f:
+            json.dump(rows, f, indent = 1, sort_keys = True)
+
+
+def number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value or None
+
+
+def read_report(path):
+    if path.endswith(".csv"):
+        with open(path, newline = "") as f:
+            return [{k: number(v) for k, v in row.items()} for row in csv.DictReader(f)]
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(old_rows, new_rows, threshold = 0.0):
+    """Returns (key, field, old, new) for every gas or storage increase above threshold."""
+    def key(row):
+        return (row["file"], row["scenario"], row["step"], row["contract"])
+    old_by_key = {key(row): row for row in old_rows}
+    regressions = []
+    for row in new_rows:
+        old = old_by_key.get(key(row))
+        if old is None:
+            continue
+        for field in ["gas", "storage_size", "operation_size"]:
+            if old[field] is not None and row[field] is not None and row[field] > old[field] * (1 + threshold):
+                regressions.append((key(row), row["entrypoint"], field, old[field], row[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("files", nargs = "*", help = "scenario files (default: all of them)")
+    parser.add_argument("--output", default = "bench_output.json", help = "report path, .json or .csv")
+    parser.add_argument("--work-dir", default = "bench_work", help = "where the scenarios are run")
+    parser.add_argument("--mode", choices = sorted(MODES), default = "mockup",
+                        help = "SmartPy simulation mode: only mockup measures gas")
+    parser.add_argument("--compare", help = "previous report to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.0, help = "tolerated relative increase")
+    args = parser.parse_args()
+
+    rows = []
+    failed = []
+    for path in args.files or scenarios.discover():
+        result = scenarios.run(path, args.work_dir, flags = MODES[args.mode])
+        if result["returncode"] != 0:
+            failed.append(path)
+            print("FAILED %s\n%s" % (path, result["stderr"]), file = sys.stderr)
+        try:
+            rows.extend(collect(result, require_gas = args.mode == "mockup"))
+        except MissingGas as e:
+            failed.append(path)
+            print("FAILED %s: %s" % (path, e), file = sys.stderr)
+    write_report(rows, args.output)
+    print("%d rows written to %s" % (len(rows), args.output))
+    if args.mode == "native":
+        print("native mode: gas not measured")
+
+    if args.compare:
+        regressions = compare(read_report(args.compare), rows, args.threshold)
+        for (file, scenario, step, contract), entrypoint, field, old, new in regressions:
+            print("%s [%s] step %d cont %d %s: %s %s -> %s" % (file, scenario, step, contract, entrypoint, field, old, new))
+        if regressions:
+            failed.append("regressions")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
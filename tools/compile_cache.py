@@ -0,0 +1,259 @@
+"""Content-addressed cache of the compiled course contracts.
+
+Each class of an `@sp.module` is identified by its module and class names
+and by the hash of its normalised source, of the module-level types,
+functions and classes it uses, of the whole source of the modules its
+module imports (directly or not), and of the SmartPy version. Copies of a
+class pasted in several files (the Ledger is in more than ten) therefore
+share one cache entry:
+
+    .compile_cache/<hash>/contract.tz         compiled Michelson
+    .compile_cache/<hash>/entrypoints.json    entrypoint names and parameter type
+    .compile_cache/<hash>/meta.json           module.class, files it was seen in
+
+The classes of a file are the ones its scenarios originate, whether they
+are defined in the file or in a course module it imports (such as
+defi_contracts.py). `build` only runs the scenarios of the files that
+originate a class missing from the cache, and captures the Michelson
+SmartPy writes when that class is originated. `show` lists the classes of
+files with their cache entries, without running anything:
+
+    python tools/compile_cache.py build
+    python tools/compile_cache.py show Big_exercise/05_membership.py
+
+The cache holds the compiled contracts for deployment and inspection, and
+spares `build` the files it has seen. Scenario runs, by tools/scenarios.py,
+tools/run_all.py or by hand, don't read it: SmartPy compiles every contract
+it originates again, as it has no way to load one from Michelson.
+"""
+
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import re
+import runpy
+import sys
+import tempfile
+
+import scenarios
+
+CACHE = os.path.join(scenarios.ROOT, ".compile_cache")
+
+
+def smartpy_version():
+    try:
+        from importlib.metadata import version
+        return version("smartpy")
+    except Exception:
+        return "unknown"
+
+
+def normalize(source):
+    """Source without comments, blank lines and trailing spaces, dedented."""
+    lines = []
+    for line in source.splitlines():
+        line = re.sub(r"\s*#.*$", "", line).rstrip()
+        if line:
+            lines.append(line)
+    indent = min((len(line) - len(line.lstrip()) for line in lines), default = 0)
+    return "\n".join(line[indent:] for line in lines)
+
+
+def smartpy_modules(path):
+    """Maps the name of every `@sp.module` of path to its definitions, the modules it imports and its source."""
+    with open(path) as f:
+        source = f.read()
+    modules = {}
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return modules  # starting templates with blanks left to the students
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.FunctionDef) and any("module" in ast.unparse(d) for d in node.decorator_list)):
+            continue
+        definitions = {}
+        imports = []
+        for statement in node.body:
+            if isinstance(statement, (ast.ClassDef, ast.FunctionDef)):
+                definitions[statement.name] = ast.get_source_segment(source, statement)
+            elif isinstance(statement, ast.AnnAssign) and isinstance(statement.target, ast.Name):
+                definitions[statement.target.id] = ast.get_source_segment(source, statement)
+            elif isinstance(statement, ast.Import):
+                imports.extend(alias.name for alias in statement.names)
+        classes = [statement.name for statement in node.body if isinstance(statement, ast.ClassDef)]
+        modules[node.name] = {"definitions": definitions, "classes": classes, "imports": imports,
+                              "source": normalize(ast.get_source_segment(source, node))}
+    return modules
+
+
+def class_hashes(modules, version = None):
+    """Maps (module, class) of every class of modules to its hash.
+
+    The hash covers the definitions of its module that the class uses and the
+    whole source of the modules its module imports, directly or not.
+    """
+    version = version or smartpy_version()
+    hashes = {}
+    for module_name, module in modules.items():
+        definitions = module["definitions"]
+        imported = set()
+        pending = list(module["imports"])
+        while pending:
+            name = pending.pop()
+            if name in modules and name not in imported:
+                imported.add(name)
+                pending.extend(modules[name]["imports"])
+        for name in module["classes"]:
+            used = {name}
+            pending = [definitions[name]]
+            while pending:
+                names = {n.id for n in ast.walk(ast.parse(normalize(pending.pop()))) if isinstance(n, ast.Name)}
+                for dependency in sorted(names & definitions.keys() - used):
+                    used.add(dependency)
+                    pending.append(definitions[dependency])
+            parts = ([version] + [normalize(definitions[n]) for n in sorted(used)]
+                     + [modules[n]["source"] for n in sorted(imported)])
+            hashes[(module_name, name)] = hashlib.sha256("\n\n".join(parts).encode()).hexdigest()
+    return hashes
+
+
+def imported_hashes(path, version = None):
+    """Hashes of the classes of path and of the SmartPy modules it imports from the course."""
+    with open(path) as f:
+        imported = re.findall(r"^from (\w+) import", f.read(), re.MULTILINE)
+    modules = {}
+    for name in imported:
+        for directory in [os.path.dirname(path), scenarios.ROOT]:
+            candidate = os.path.join(directory, name + ".py")
+            if os.path.isfile(candidate):
+                modules.update(smartpy_modules(candidate))
+                break
+    modules.update(smartpy_modules(path))
+    return class_hashes(modules, version)
+
+
+def originated(path):
+    """(module, class) of the contracts the scenarios of path instantiate, as in `defi.Ledger(...)`."""
+    with open(path) as f:
+        source = f.read()
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return set()
+    return {(node.func.value.id, node.func.attr) for node in ast.walk(tree)
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name)}
+
+
+def file_hashes(path, version = None):
+    """Hashes of the classes, defined in path or in the modules it imports, that path originates."""
+    contracts = originated(path)
+    return {key: digest for key, digest in imported_hashes(path, version).items() if key in contracts}
+
+
+def entrypoints(michelson):
+    """Entrypoint names and parameter type of a compiled contract."""
+    match = re.search(r"parameter\s+(.*?);\s*storage", michelson, re.DOTALL)
+    parameter = " ".join(match.group(1).split()) if match else ""
+    return {"parameter": parameter, "entrypoints": re.findall(r"%(\w+)", parameter)}
+
+
+def store(digest, name, path, michelson):
+    entry = os.path.join(CACHE, digest)
+    os.makedirs(entry, exist_ok = True)
+    with open(os.path.join(entry, "contract.tz"), "w") as f:
+        f.write(michelson)
+    with open(os.path.join(entry, "entrypoints.json"), "w") as f:
+        json.dump(entrypoints(michelson), f, indent = 1)
+    meta_path = os.path.join(entry, "meta.json")
+    meta = {"class": name, "files": []}
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    meta["files"] = sorted(set(meta["files"]) | {path})
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent = 1)
+
+
+def is_cached(digest):
+    return os.path.isfile(os.path.join(CACHE, digest, "contract.tz"))
+
+
+def capture(path, hashes):
+    """Runs the scenarios of path, storing the Michelson of each class it originates."""
+    import smartpy as sp
+
+    original_test_scenario = sp.test_scenario
+    original_adds = {}
+    def test_scenario(*args, **kwargs):
+        scenario = original_test_scenario(*args, **kwargs)
+        scenario_type = type(scenario)
+        if scenario_type not in original_adds:
+            original_add = original_adds[scenario_type] = scenario_type.__iadd__
+            def add(self, contract):
+                before = set(glob.glob("**/*_contract.tz", recursive = True))
+                result = original_add(self, contract)
+                key = (contract.contract_class.module.module_id.name, contract.contract_class.name)
+                new_files = sorted(set(glob.glob("**/*_contract.tz", recursive = True)) - before)
+                if key in hashes and new_files:
+                    with open(new_files[-1]) as f:
+                        store(hashes[key], "%s.%s" % key, path, f.read())
+                return result
+            scenario_type.__iadd__ = add
+        return scenario
+    sp.test_scenario = test_scenario
+
+    cwd = os.getcwd()
+    output_dir = os.environ.get("SMARTPY_OUTPUT_DIR")
+    sys.path[:0] = [os.path.dirname(os.path.join(scenarios.ROOT, path)), scenarios.ROOT]
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # the SmartPy runtime resolves relative output paths against its own directory
+            os.environ["SMARTPY_OUTPUT_DIR"] = directory
+            os.chdir(directory)
+            runpy.run_path(os.path.join(scenarios.ROOT, path), run_name = "__main__")
+    finally:
+        os.chdir(cwd)
+        if output_dir is None:
+            os.environ.pop("SMARTPY_OUTPUT_DIR", None)
+        else:
+            os.environ["SMARTPY_OUTPUT_DIR"] = output_dir
+        del sys.path[:2]
+        sp.test_scenario = original_test_scenario
+        for scenario_type, original_add in original_adds.items():
+            scenario_type.__iadd__ = original_add
+
+
+def build(paths):
+    for path in paths:
+        hashes = file_hashes(os.path.join(scenarios.ROOT, path))
+        missing = ["%s.%s" % key for key, digest in hashes.items() if not is_cached(digest)]
+        for key, digest in hashes.items():
+            if is_cached(digest):
+                store(digest, "%s.%s" % key, path, open(os.path.join(CACHE, digest, "contract.tz")).read())
+        if missing:
+            print("compiling %s (%s)" % (path, ", ".join(missing)))
+            try:
+                capture(path, hashes)
+            except Exception as e:
+                print("FAILED %s: %s" % (path, e), file = sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("command", choices = ["build", "show"])
+    parser.add_argument("files", nargs = "*", help = "scenario files (default: all of them)")
+    args = parser.parse_args()
+    paths = [os.path.relpath(os.path.abspath(path), scenarios.ROOT) for path in args.files] or scenarios.discover()
+    if args.command == "build":
+        build(paths)
+    else:
+        for path in paths:
+            for key, digest in sorted(file_hashes(os.path.join(scenarios.ROOT, path)).items()):
+                print("%-60s %-34s %s %s" % (path, "%s.%s" % key, digest[:12], "cached" if is_cached(digest) else "missing"))
+
+
+if __name__ == "__main__":
+    main()
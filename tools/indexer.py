@@ -0,0 +1,177 @@
+"""Streaming SQLite indexer for the course contracts.
+
+Replays applied operations of `FA2Token` (Examples/20), `MultipleNftSingleContract`
+(Examples/18), `BinaryBets` (Exercices/33) and `Ledger` (DeFi exercises), and
+keeps normalised tables that answer "who owns token X", "what does this
+address hold" or "which bets are open" with an index lookup:
+
+    tokens(contract, token_id, owner, author, metadata, price)
+    balances(contract, owner, balance)
+    bets(contract, bet_id, player1, player2, game_id, amount, expected_result, deadline, status)
+
+Operations are read one JSON object per line, in application order, as
+tools/scenario_operations.py writes them from the scenarios:
+
+    {"contract": "KT1...", "kind": "FA2Token", "entrypoint": "mint",
+     "sender": "tz1...", "amount": 0, "params": "Alice NFT 1"}
+
+params is the parameter of the entrypoint as the contract takes it: the bare
+value of an entrypoint with one argument, a record of its arguments
+otherwise. An "origination" entrypoint registers a contract, with its initial
+storage as params. Only successful operations must be given. Lines are
+processed as they are read and committed in batches, and the number of
+operations applied is stored with them, so a later run on the same stream
+resumes where the previous one stopped:
+
+    python tools/scenario_operations.py Examples/20_fa2_markeplace.py > operations.jsonl
+    python tools/indexer.py operations.jsonl --db index.sqlite
+    tail -f operations.jsonl | python tools/indexer.py - --db index.sqlite
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contracts (address TEXT PRIMARY KEY, kind TEXT NOT NULL, next_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS tokens (contract TEXT, token_id INTEGER, owner TEXT, author TEXT, metadata TEXT, price INTEGER,
+                                   PRIMARY KEY (contract, token_id));
+CREATE INDEX IF NOT EXISTS tokens_owner ON tokens (owner);
+CREATE INDEX IF NOT EXISTS tokens_token_id ON tokens (token_id);
+CREATE TABLE IF NOT EXISTS balances (contract TEXT, owner TEXT, balance INTEGER, PRIMARY KEY (contract, owner));
+CREATE INDEX IF NOT EXISTS balances_owner ON balances (owner);
+CREATE TABLE IF NOT EXISTS bets (contract TEXT, bet_id INTEGER, player1 TEXT, player2 TEXT, game_id INTEGER, amount INTEGER,
+                                 expected_result INTEGER, deadline TEXT, status TEXT, PRIMARY KEY (contract, bet_id));
+CREATE INDEX IF NOT EXISTS bets_status ON bets (status);
+CREATE INDEX IF NOT EXISTS bets_player1 ON bets (player1);
+CREATE INDEX IF NOT EXISTS bets_player2 ON bets (player2);
+CREATE TABLE IF NOT EXISTS progress (id INTEGER PRIMARY KEY CHECK (id = 1), nb_operations INTEGER NOT NULL);
+INSERT OR IGNORE INTO progress VALUES (1, 0);
+"""
+
+
+def next_id(db, contract):
+    (value,) = db.execute("SELECT next_id FROM contracts WHERE address = ?", (contract,)).fetchone()
+    db.execute("UPDATE contracts SET next_id = next_id + 1 WHERE address = ?", (contract,))
+    return value
+
+
+def credit(db, contract, owner, amount):
+    db.execute("INSERT INTO balances VALUES (?, ?, ?) ON CONFLICT (contract, owner) DO UPDATE SET balance = balance + ?",
+               (contract, owner, amount, amount))
+
+
+def fa2_token(db, op):
+    params = op["params"]
+    if op["entrypoint"] == "mint":
+        token_id = next_id(db, op["contract"])
+        db.execute("INSERT INTO tokens VALUES (?, ?, ?, ?, ?, NULL)",
+                   (op["contract"], token_id, op["sender"], op["sender"], params))
+    elif op["entrypoint"] == "transfer":
+        for transfer in params:
+            for tx in transfer["txs"]:
+                db.execute("UPDATE tokens SET owner = ? WHERE contract = ? AND token_id = ?",
+                           (tx["to_"], op["contract"], tx["token_id"]))
+
+
+def multiple_nft(db, op):
+    params = op["params"]
+    if op["entrypoint"] == "mint":
+        token_id = next_id(db, op["contract"])
+        db.execute("INSERT INTO tokens VALUES (?, ?, ?, ?, ?, ?)",
+                   (op["contract"], token_id, op["sender"], op["sender"], params, 1000000))
+    elif op["entrypoint"] == "buy":
+        # the price grows by 10% after each sale, as split_tokens(price, 10, 100)
+        db.execute("UPDATE tokens SET owner = ?, price = price + price * 10 / 100 WHERE contract = ? AND token_id = ?",
+                   (op["sender"], op["contract"], params))
+
+
+def binary_bets(db, op):
+    params = op["params"]
+    contract = op["contract"]
+    if op["entrypoint"] == "create_bet":
+        bet_id = next_id(db, contract)
+        db.execute("INSERT INTO bets VALUES (?, ?, ?, NULL, ?, ?, ?, ?, 'open')",
+                   (contract, bet_id, op["sender"], params["game_id"], op["amount"],
+                    int(params["expected_result"]), str(params["deadline"])))
+    elif op["entrypoint"] == "accept_bet":
+        db.execute("UPDATE bets SET player2 = ?, status = 'accepted' WHERE contract = ? AND bet_id = ?",
+                   (op["sender"], contract, params))
+    elif op["entrypoint"] in ("withdraw", "cancel_after_deadline"):
+        db.execute("UPDATE bets SET status = 'cancelled' WHERE contract = ? AND bet_id = ?", (contract, params))
+    elif op["entrypoint"] == "claim_prize":
+        db.execute("UPDATE bets SET status = 'settled' WHERE contract = ? AND bet_id = ?", (contract, params))
+
+
+def ledger(db, op):
+    params = op["params"]
+    contract = op["contract"]
+    if op["entrypoint"] == "origination":
+        for owner, balance in params["balances"]:
+            credit(db, contract, owner, balance)
+    elif op["entrypoint"] == "transfer":
+        credit(db, contract, params["source"], -params["amount"])
+        credit(db, contract, params["destination"], params["amount"])
+    elif op["entrypoint"] == "transfer_batch":
+        for group in params:
+            for tx in group["txs"]:
+                credit(db, contract, group["source"], -tx["amount"])
+                credit(db, contract, tx["destination"], tx["amount"])
+
+
+HANDLERS = {
+    "FA2Token": fa2_token,
+    "MultipleNftSingleContract": multiple_nft,
+    "BinaryBets": binary_bets,
+    "Ledger": ledger,
+}
+
+
+def apply(db, op):
+    if op["entrypoint"] == "origination":
+        db.execute("INSERT INTO contracts VALUES (?, ?, 1)", (op["contract"], op["kind"]))
+    handler = HANDLERS.get(op["kind"])
+    if handler is not None:
+        handler(db, op)
+
+
+def index(lines, db, batch_size = 1000):
+    """Applies the operations of `lines` not applied yet, returns how many were applied."""
+    db.executescript(SCHEMA)
+    (already_applied,) = db.execute("SELECT nb_operations FROM progress").fetchone()
+    position = 0
+    applied = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        position += 1
+        if position <= already_applied:
+            continue
+        apply(db, json.loads(line))
+        applied += 1
+        if applied % batch_size == 0:
+            db.execute("UPDATE progress SET nb_operations = ?", (position,))
+            db.commit()
+    db.execute("UPDATE progress SET nb_operations = ?", (max(position, already_applied),))
+    db.commit()
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("operations", help = "JSON lines file of operations, - for stdin")
+    parser.add_argument("--db", default = "index.sqlite")
+    parser.add_argument("--batch-size", type = int, default = 1000)
+    args = parser.parse_args()
+    db = sqlite3.connect(args.db)
+    if args.operations == "-":
+        applied = index(sys.stdin, db, args.batch_size)
+    else:
+        with open(args.operations) as f:
+            applied = index(f, db, args.batch_size)
+    print("%d operations applied to %s" % (applied, args.db))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Off-chain encoding and signing of the values contracts check with `sp.check_signature`.
+
+A contract verifies a signature over `sp.pack(value)`: the value serialised
+in the Micheline binary format, prefixed with 0x05. Tezos signs the 32 bytes
+BLAKE2b hash of that message. This module packs the types used by the course
+contracts (nat, int, mutez, timestamp, string, bytes, address, key, unit,
+pairs and lists) and handles the base58check encodings of ed25519 keys,
+signatures and addresses:
+
+    payload = pack(pair(address("KT1..."), nat(0), nat(3)))
+    signature = sign("edsk...", payload)
+    assert check_signature(public_key("edsk..."), signature, payload)
+
+The signatures are made with PyNaCl when it is installed (it releases the GIL,
+so signing many messages on threads runs in parallel); otherwise with the
+slower, pure Python arithmetic of RFC 8032.
+"""
+
+import hashlib
+import json
+
+try:
+    import nacl.bindings
+    import nacl.exceptions
+except ImportError:
+    nacl = None
+
+BASE58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+PREFIXES = {
+    "tz1": bytes([6, 161, 159]),
+    "KT1": bytes([2, 90, 121]),
+    "edpk": bytes([13, 15, 37, 217]),
+    "edsk": bytes([13, 15, 58, 7]),          # 32 bytes seed
+    "edsk64": bytes([43, 246, 78, 7]),       # seed followed by the public key
+    "edsig": bytes([9, 245, 205, 134, 18]),
+}
+
+
+def b58check_encode(prefix, payload):
+    data = PREFIXES[prefix] + payload
+    data += hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    number = int.from_bytes(data, "big")
+    text = ""
+    while number:
+        number, digit = divmod(number, 58)
+        text = BASE58[digit] + text
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + text
+
+
+def b58check_decode(text, prefix):
+    number = 0
+    for character in text:
+        number = number * 58 + BASE58.index(character)
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    data = b"\0" * (len(text) - len(text.lstrip("1"))) + data
+    data, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4] != checksum:
+        raise ValueError("invalid checksum: %s" % text)
+    if not data.startswith(PREFIXES[prefix]):
+        raise ValueError("not a %s: %s" % (prefix, text))
+    return data[len(PREFIXES[prefix]):]
+
+
+# Micheline values, as (tag, content) tuples packed by `pack`
+
+def nat(value):
+    if value < 0:
+        raise ValueError("negative nat: %d" % value)
+    return ("int", value)
+
+
+def int_(value):
+    return ("int", value)
+
+
+mutez = nat
+timestamp = int_
+
+
+def string(value):
+    return ("string", value.encode())
+
+
+def bytes_(value):
+    return ("bytes", bytes(value))
+
+
+def address(value):
+    """An address is packed as 22 bytes: a tag and the key hash, or the contract hash."""
+    if value.startswith("tz1"):
+        return ("bytes", b"\0\0" + b58check_decode(value, "tz1"))
+    if value.startswith("KT1"):
+        return ("bytes", b"\1" + b58check_decode(value, "KT1") + b"\0")
+    raise ValueError("unsupported address: %s" % value)
+
+
+def key(value):
+    return ("bytes", b"\0" + b58check_decode(value, "edpk"))
+
+
+def pair(*values):
+    """Right comb pair, like the tuples of SmartPy: pair(a, b, c) is (a, (b, c))."""
+    if len(values) < 2:
+        raise ValueError("a pair needs two values")
+    if len(values) > 2:
+        values = (values[0], pair(*values[1:]))
+    return ("pair", values)
+
+
+def list_(values):
+    return ("list", list(values))
+
+
+UNIT = ("unit", None)
+
+
+def zarith(value):
+    sign = 0x40 if value < 0 else 0
+    value = abs(value)
+    result = bytearray([sign | (value & 0x3F)])
+    value >>= 6
+    while value:
+        result[-1] |= 0x80
+        result.append(value & 0x7F)
+        value >>= 7
+    return bytes(result)
+
+
+def encode(value):
+    tag, content = value
+    if tag == "int":
+        return b"\0" + zarith(content)
+    if tag in ("string", "bytes"):
+        return (b"\1" if tag == "string" else b"\x0a") + len(content).to_bytes(4, "big") + content
+    if tag == "pair":
+        return b"\7\7" + encode(content[0]) + encode(content[1])  # prim Pair with two arguments
+    if tag == "list":
+        items = b"".join(encode(item) for item in content)
+        return b"\2" + len(items).to_bytes(4, "big") + items
+    if tag == "unit":
+        return b"\3\x0b"
+    raise ValueError("unknown tag: %s" % tag)
+
+
+def pack(value):
+    """The bytes of `sp.pack(value)`."""
+    return b"\5" + encode(value)
+
+
+def micheline(value):
+    """Micheline JSON of value, as octez-client and the RPCs take parameters."""
+    tag, content = value
+    if tag == "int":
+        return {"int": str(content)}
+    if tag == "string":
+        return {"string": content.decode()}
+    if tag == "bytes":
+        return {"bytes": content.hex()}
+    if tag == "pair":
+        return {"prim": "Pair", "args": [micheline(content[0]), micheline(content[1])]}
+    if tag == "list":
+        return [micheline(item) for item in content]
+    return {"prim": "Unit"}
+
+
+def expression(value):
+    """Michelson expression of value, as the --arg of octez-client."""
+    tag, content = value
+    if tag == "int":
+        return str(content)
+    if tag == "string":
+        return json.dumps(content.decode())
+    if tag == "bytes":
+        return "0x" + content.hex()
+    if tag == "pair":
+        return "(Pair %s %s)" % (expression(content[0]), expression(content[1]))
+    if tag == "list":
+        return "{%s}" % "; ".join(expression(item) for item in content)
+    return "Unit"
+
+
+# ed25519 (RFC 8032), used when PyNaCl isn't installed
+
+P = 2 ** 255 - 19
+L = 2 ** 252 + 27742317777372353535851937790883648493
+D = -121665 * pow(121666, P - 2, P) % P
+SQRT_M1 = pow(2, (P - 1) // 4, P)
+
+
+def point_add(a, b):
+    x1, y1, z1, t1 = a
+    x2, y2, z2, t2 = b
+    e = (y1 - x1) * (y2 - x2) % P
+    f = (y1 + x1) * (y2 + x2) % P
+    g = 2 * t1 * t2 * D % P
+    h = 2 * z1 * z2 % P
+    e, f, g, h = f - e, h - g, h + g, f + e
+    return (e * f % P, g * h % P, f * g % P, e * h % P)
+
+
+def point_multiply(scalar, point):
+    result = (0, 1, 1, 0)
+    while scalar:
+        if scalar & 1:
+            result = point_add(result, point)
+        point = point_add(point, point)
+        scalar >>= 1
+    return result
+
+
+def point_compress(point):
+    x, y, z, _ = point
+    inverse = pow(z, P - 2, P)
+    x, y = x * inverse % P, y * inverse % P
+    return (y | (x & 1) << 255).to_bytes(32, "little")
+
+
+def point_decompress(data):
+    y = int.from_bytes(data, "little")
+    sign, y = y >> 255, y & (1 << 255) - 1
+    if y >= P:
+        return None
+    x2 = (y * y - 1) * pow(D * y * y + 1, P - 2, P) % P
+    x = pow(x2, (P + 3) // 8, P)
+    if (x * x - x2) % P:
+        x = x * SQRT_M1 % P
+    if (x * x - x2) % P or (x == 0 and sign):
+        return None
+    if x & 1 != sign:
+        x = P - x
+    return (x, y, 1, x * y % P)
+
+
+def point_equal(a, b):
+    return ((a[0] * b[2] - b[0] * a[2]) % P == 0
+            and (a[1] * b[2] - b[1] * a[2]) % P == 0)
+
+
+G_Y = 4 * pow(5, P - 2, P) % P
+G = point_decompress(G_Y.to_bytes(32, "little"))
+
+
+def sha512_int(*parts):
+    return int.from_bytes(hashlib.sha512(b"".join(parts)).digest(), "little")
+
+
+def expand_seed(seed):
+    digest = hashlib.sha512(seed).digest()
+    scalar = int.from_bytes(digest[:32], "little")
+    scalar &= (1 << 254) - 8
+    scalar |= 1 << 254
+    return scalar, digest[32:]
+
+
+def ed25519_public_key(seed):
+    if nacl:
+        return nacl.bindings.crypto_sign_seed_keypair(seed)[0]
+    return point_compress(point_multiply(expand_seed(seed)[0], G))
+
+
+def ed25519_sign(seed, message):
+    if nacl:
+        secret = nacl.bindings.crypto_sign_seed_keypair(seed)[1]
+        return nacl.bindings.crypto_sign(message, secret)[:64]
+    scalar, prefix = expand_seed(seed)
+    public = point_compress(point_multiply(scalar, G))
+    r = sha512_int(prefix, message) % L
+    big_r = point_compress(point_multiply(r, G))
+    s = (r + sha512_int(big_r, public, message) * scalar) % L
+    return big_r + s.to_bytes(32, "little")
+
+
+def ed25519_verify(public, message, signature):
+    if nacl:
+        try:
+            nacl.bindings.crypto_sign_open(signature + message, public)
+            return True
+        except nacl.exceptions.BadSignatureError:
+            return False
+    if len(public) != 32 or len(signature) != 64:
+        return False
+    point = point_decompress(public)
+    big_r = point_decompress(signature[:32])
+    s = int.from_bytes(signature[32:], "little")
+    if point is None or big_r is None or s >= L:
+        return False
+    h = sha512_int(signature[:32], public, message) % L
+    return point_equal(point_multiply(s, G), point_add(big_r, point_multiply(h, point)))
+
+
+# Tezos keys and signatures
+
+def seed(secret_key):
+    if len(secret_key) == 98:
+        return b58check_decode(secret_key, "edsk64")[:32]
+    return b58check_decode(secret_key, "edsk")
+
+
+def public_key(secret_key):
+    return b58check_encode("edpk", ed25519_public_key(seed(secret_key)))
+
+
+def key_hash(public):
+    """tz1 address of an edpk public key, as `sp.hash_key` and `sp.implicit_account` give."""
+    digest = hashlib.blake2b(b58check_decode(public, "edpk"), digest_size = 20).digest()
+    return b58check_encode("tz1", digest)
+
+
+def message_hash(message):
+    return hashlib.blake2b(message, digest_size = 32).digest()
+
+
+def sign(secret_key, message):
+    """edsig signature of message, that `sp.check_signature` accepts with the matching key."""
+    return b58check_encode("edsig", ed25519_sign(seed(secret_key), message_hash(message)))
+
+
+def check_signature(public, signature, message):
+    """Off-chain equivalent of `sp.check_signature`."""
+    try:
+        return ed25519_verify(b58check_decode(public, "edpk"), message_hash(message),
+                              b58check_decode(signature, "edsig"))
+    except ValueError:
+        return False
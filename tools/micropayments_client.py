@@ -0,0 +1,185 @@
+"""Payment channel client of Exercices/24_micropayments_solution2.py.
+
+A payer who deposited tez for a destination pays it off-chain, by signing
+vouchers of the cumulative amount paid so far on the channel; the
+destination claims the latest one with `claim_payments` or `claim_many`.
+This library keeps the state of each channel (its counter, the deposit and
+the cumulative amount), packs vouchers exactly as the contract unpacks
+`voucher_type`, signs them in bulk and verifies them before they are
+submitted:
+
+    client = Client("KT1...", "edsk...", state_path = "channels.json")
+    client.open("tz1...", counter = 1, deposit = 100_000_000)
+    vouchers = client.pay_many([("tz1...", 1_000), ("tz1...", 2_500)])
+    assert all(verify(voucher, client.public_key, deposit = 100_000_000) for voucher in vouchers)
+
+The same, from the command line, with the channel state kept in a file:
+
+    python tools/micropayments_client.py open KT1... tz1... --counter 1 --deposit 100000000 --secret-key edsk...
+    python tools/micropayments_client.py pay KT1... tz1... 1000 2500 --secret-key edsk... > vouchers.json
+    python tools/micropayments_client.py verify vouchers.json --public-key edpk... --deposit 100000000
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+
+try:
+    import michelson
+except ImportError:  # imported by a scenario, as tools.micropayments_client
+    from tools import michelson
+
+
+def pack_voucher(contract, destination, amount, counter):
+    """sp.pack of voucher_type, laid out as (destination, (amount, (counter, contract)))."""
+    return michelson.pack(michelson.pair(michelson.address(destination), michelson.mutez(amount),
+                                         michelson.nat(counter), michelson.address(contract)))
+
+
+def verify(voucher, public_key, deposit = None):
+    """Checks that the packed message matches the fields of voucher, is signed by public_key and is covered by deposit."""
+    packed_message = bytes.fromhex(voucher["packed_message"])
+    if packed_message != pack_voucher(voucher["contract"], voucher["destination"], voucher["amount"], voucher["counter"]):
+        return False
+    if deposit is not None and voucher["amount"] > deposit:
+        return False
+    return (michelson.key_hash(public_key) == voucher["source"]
+            and michelson.check_signature(public_key, voucher["signature"], packed_message))
+
+
+class Client:
+    """Channels of one payer on one Micropayments contract."""
+
+    def __init__(self, contract, secret_key, state_path = None, workers = None):
+        self.contract = contract
+        self.secret_key = secret_key
+        self.public_key = michelson.public_key(secret_key)
+        self.source = michelson.key_hash(self.public_key)
+        self.state_path = state_path
+        self.workers = workers or os.cpu_count()
+        self.lock = threading.Lock()
+        self.channels = {}  # destination -> {"counter", "deposit", "amount"}
+        if state_path and os.path.isfile(state_path):
+            with open(state_path) as f:
+                self.channels = json.load(f).get(contract, {})
+
+    def save(self):
+        if not self.state_path:
+            return
+        states = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                states = json.load(f)
+        states[self.contract] = self.channels
+        with open(self.state_path, "w") as f:
+            json.dump(states, f, indent = 1, sort_keys = True)
+
+    def open(self, destination, counter, deposit):
+        """Records a deposit made on the contract; a new counter restarts the cumulative amount."""
+        with self.lock:
+            channel = self.channels.get(destination)
+            if channel is None or channel["counter"] != counter:
+                channel = self.channels[destination] = {"counter": counter, "deposit": 0, "amount": 0}
+            channel["deposit"] = deposit
+            self.save()
+
+    def reserve(self, payments):
+        """Adds the payments to the cumulative amounts of their channels, returns the unsigned vouchers."""
+        with self.lock:
+            amounts = {destination: channel["amount"] for destination, channel in self.channels.items()}
+            vouchers = []
+            for destination, amount in payments:
+                if destination not in self.channels:
+                    raise KeyError("no channel to %s" % destination)
+                if amount <= 0:
+                    raise ValueError("payments must be positive: %d" % amount)
+                channel = self.channels[destination]
+                amounts[destination] += amount
+                if amounts[destination] > channel["deposit"]:
+                    raise ValueError("channel to %s: %d mutez paid, more than the deposit of %d"
+                                     % (destination, amounts[destination], channel["deposit"]))
+                vouchers.append({"contract": self.contract, "source": self.source, "destination": destination,
+                                 "amount": amounts[destination], "counter": channel["counter"]})
+            for destination, amount in amounts.items():
+                self.channels[destination]["amount"] = amount
+            self.save()
+        return vouchers
+
+    def sign(self, voucher):
+        packed_message = pack_voucher(voucher["contract"], voucher["destination"], voucher["amount"], voucher["counter"])
+        return dict(voucher, packed_message = packed_message.hex(),
+                    signature = michelson.sign(self.secret_key, packed_message))
+
+    def pay_many(self, payments):
+        """Signed vouchers of the (destination, mutez) payments, in order.
+
+        The channel state is updated first, under the lock, so that concurrent
+        callers never sign two vouchers of the same cumulative amount. The
+        signatures are made on a thread pool only with PyNaCl, which releases
+        the GIL (`pip install pynacl`); the pure Python fallback of michelson.py
+        holds it, so threads would only add overhead and it signs in turn.
+        """
+        vouchers = self.reserve(payments)
+        if len(vouchers) < 2 or not michelson.nacl:
+            return [self.sign(voucher) for voucher in vouchers]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.workers) as executor:
+            return list(executor.map(self.sign, vouchers))
+
+    def pay(self, destination, amount):
+        return self.pay_many([(destination, amount)])[0]
+
+
+def latest(vouchers):
+    """The voucher of the highest cumulative amount of each channel: the only ones worth claiming."""
+    result = {}
+    for voucher in vouchers:
+        key = (voucher["contract"], voucher["source"], voucher["destination"], voucher["counter"])
+        if key not in result or result[key]["amount"] < voucher["amount"]:
+            result[key] = voucher
+    return list(result.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    open_parser = subparsers.add_parser("open", help = "record a deposit")
+    pay_parser = subparsers.add_parser("pay", help = "sign vouchers of payments to one destination")
+    for subparser in [open_parser, pay_parser]:
+        subparser.add_argument("contract", help = "address of the Micropayments contract")
+        subparser.add_argument("destination")
+        subparser.add_argument("--secret-key", required = True, help = "edsk key of the payer")
+        subparser.add_argument("--state", default = "channels.json", help = "channel state file")
+    open_parser.add_argument("--counter", type = int, required = True, help = "counter of the deposit")
+    open_parser.add_argument("--deposit", type = int, required = True, help = "mutez deposited")
+    pay_parser.add_argument("amounts", type = int, nargs = "+", help = "mutez of each payment")
+    verify_parser = subparsers.add_parser("verify", help = "check vouchers before claiming them")
+    verify_parser.add_argument("vouchers", help = "JSON list of vouchers, as written by pay")
+    verify_parser.add_argument("--public-key", required = True, help = "edpk key of the payer")
+    verify_parser.add_argument("--deposit", type = int, help = "mutez deposited")
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        with open(args.vouchers) as f:
+            vouchers = json.load(f)
+        invalid = [voucher for voucher in vouchers if not verify(voucher, args.public_key, args.deposit)]
+        for voucher in invalid:
+            print("invalid voucher of %d mutez to %s" % (voucher["amount"], voucher["destination"]), file = sys.stderr)
+        print("%d valid, %d invalid" % (len(vouchers) - len(invalid), len(invalid)))
+        sys.exit(1 if invalid else 0)
+
+    client = Client(args.contract, args.secret_key, state_path = args.state)
+    if args.command == "open":
+        client.open(args.destination, args.counter, args.deposit)
+    else:
+        try:
+            vouchers = client.pay_many([(args.destination, amount) for amount in args.amounts])
+        except (KeyError, ValueError) as e:
+            sys.exit(str(e))
+        print(json.dumps(vouchers, indent = 1))
+
+
+if __name__ == "__main__":
+    main()
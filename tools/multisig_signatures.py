@@ -0,0 +1,90 @@
+"""Off-chain approvals of the proposals of minimal_multisig.py.
+
+Instead of one `vote` operation per participant, each participant signs
+`sp.pack((multisig, proposal_id))`, and anyone submits all the signatures at
+once to `execute_with_signatures`. Proposal ids are never reused and a
+proposal runs only once, so an approval can't be replayed, and it stays valid
+however many other proposals are executed before it is submitted:
+
+    python tools/multisig_signatures.py sign KT1... 0 --secret-key edsk... > alice.json
+    python tools/multisig_signatures.py sign KT1... 0 --secret-key edsk... > bob.json
+    python tools/multisig_signatures.py aggregate KT1... 0 alice.json bob.json
+
+`aggregate` checks the signatures, drops duplicated signers and prints the
+Micheline JSON parameter of the call, with the octez-client command to send it.
+"""
+
+import argparse
+import json
+import sys
+
+try:
+    import michelson
+except ImportError:  # imported by a scenario, as tools.multisig_signatures
+    from tools import michelson
+
+
+def payload(contract, proposal_id):
+    return michelson.pack(michelson.pair(michelson.address(contract), michelson.nat(proposal_id)))
+
+
+def approve(secret_key, contract, proposal_id):
+    """Approval of one participant, as an element of the `signatures` parameter."""
+    return {"signer": michelson.public_key(secret_key),
+            "signature": michelson.sign(secret_key, payload(contract, proposal_id))}
+
+
+def aggregate(approvals, contract, proposal_id):
+    """Valid approvals of distinct signers, and the rejected ones."""
+    message = payload(contract, proposal_id)
+    valid, rejected, signers = [], [], set()
+    for approval in approvals:
+        if approval["signer"] in signers:
+            continue
+        if michelson.check_signature(approval["signer"], approval["signature"], message):
+            signers.add(approval["signer"])
+            valid.append(approval)
+        else:
+            rejected.append(approval)
+    return valid, rejected
+
+
+def parameter(proposal_id, approvals):
+    """Parameter of execute_with_signatures: (proposal_id, [(signature, signer)])."""
+    return michelson.pair(
+        michelson.nat(proposal_id),
+        michelson.list_(michelson.pair(michelson.string(approval["signature"]), michelson.string(approval["signer"]))
+                        for approval in approvals))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("command", choices = ["payload", "sign", "aggregate"])
+    parser.add_argument("contract", help = "address of the multisig")
+    parser.add_argument("proposal_id", type = int)
+    parser.add_argument("approvals", nargs = "*", help = "files written by sign")
+    parser.add_argument("--secret-key", help = "edsk key of the participant who signs")
+    args = parser.parse_args()
+
+    if args.command == "payload":
+        print(payload(args.contract, args.proposal_id).hex())
+    elif args.command == "sign":
+        if not args.secret_key:
+            parser.error("sign needs --secret-key")
+        print(json.dumps(approve(args.secret_key, args.contract, args.proposal_id)))
+    else:
+        approvals = []
+        for path in args.approvals:
+            with open(path) as f:
+                approvals.append(json.load(f))
+        valid, rejected = aggregate(approvals, args.contract, args.proposal_id)
+        for approval in rejected:
+            print("invalid signature of %s" % michelson.key_hash(approval["signer"]), file = sys.stderr)
+        argument = parameter(args.proposal_id, valid)
+        print(json.dumps(michelson.micheline(argument)))
+        print("octez-client transfer 0 from <account> to %s --entrypoint execute_with_signatures --arg '%s'"
+              % (args.contract, michelson.expression(argument)), file = sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
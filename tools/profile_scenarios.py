@@ -0,0 +1,287 @@
+"""Per-entrypoint profiler for the course scenarios.
+
+Runs scenario files in-process, in a temporary output directory, with the
+scenarios created by `sp.test_scenario` instrumented so that every
+origination, entrypoint call and verification reports:
+
+    compile time       parsing its `@sp.module`, type checking and compiling the contract to Michelson
+    interpret time     running the origination, call or verification in the SmartPy interpreter
+    trace time         writing what `sp.trace` and the runtime print on stderr
+    trace volume       bytes of that output
+    gas                taken from a tools/benchmark.py report when one is given
+
+The SmartPy runtime prints on the stderr it inherits when smartpy is
+imported: the profiler first sends that stderr to a file, so that the time
+spent interpreting a call and the time spent writing its trace are measured
+apart, and copies the trace to the real stderr after each step.
+
+Two outputs are written: a folded-stacks file (`file;scenario;contract;entrypoint;phase
+microseconds` per line) that flamegraph.pl, inferno or speedscope render
+directly, and a JSON summary aggregated per contract and entrypoint.
+
+    python tools/profile_scenarios.py Big_exercise/flashloan_full.py --folded profile.folded
+    python tools/profile_scenarios.py --gas-report bench.json --summary profile.json
+
+Gas is matched with the benchmark rows by file, scenario, step and contract
+id, read from the `file step_<step>_cont_<contract>_...` lines of the log
+of each scenario. The exit code is 1 if a scenario file fails.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import runpy
+import sys
+import tempfile
+import time
+
+import scenarios
+
+PHASES = ["compile", "interpret", "trace"]
+STATIC_ID = re.compile(r"static_id (\d+)")
+# scenario actions measured, with the phase of the time the runtime spends on them
+ACTIONS = {
+    "add_module": "compile",
+    "instantiateContract": "compile",
+    "originateContract": "interpret",
+    "message": "interpret",
+    "verify": "interpret",
+    "compute": "interpret",
+    "show": "interpret",
+}
+
+
+class TraceCapture:
+    """Sends file descriptor 2 to a temporary file until close().
+
+    Must be created before smartpy is imported, as the import starts the
+    runtime process, which keeps the stderr of that moment.
+    """
+
+    def __init__(self):
+        sys.stderr.flush()
+        self.stderr = os.fdopen(os.dup(2), "wb", buffering = 0)
+        self.file = tempfile.TemporaryFile(mode = "a+b")
+        os.dup2(self.file.fileno(), 2)
+        self.position = 0
+
+    def forward(self):
+        """Copies what was written since the last call to the real stderr, returns its size and the time it took."""
+        sys.stderr.flush()
+        self.file.seek(self.position)
+        data = self.file.read()
+        self.position += len(data)
+        start = time.perf_counter()
+        self.stderr.write(data)
+        return len(data), time.perf_counter() - start
+
+    def close(self):
+        self.forward()
+        os.dup2(self.stderr.fileno(), 2)
+        self.stderr.close()
+        self.file.close()
+
+
+class Profiler:
+    def __init__(self, trace = None):
+        self.trace = trace
+        self.events = []
+        self.file = None
+        self.output_dir = None
+
+    def event(self, scenario, contract, entrypoint):
+        event = {
+            "file": self.file,
+            "scenario": scenario,
+            "contract": contract,
+            "entrypoint": entrypoint,
+            "step": None,
+            "contract_id": None,
+            "compile_time": 0.0,
+            "interpret_time": 0.0,
+            "trace_time": 0.0,
+            "trace_size": 0,
+            "gas": None,
+        }
+        self.events.append(event)
+        return event
+
+    def forward_trace(self):
+        return self.trace.forward() if self.trace else (0, 0.0)
+
+    def wrap_scenario(self, scenario, name, compile_time):
+        """Measures the actions of this scenario only, by shadowing its `action` method."""
+        profiler = self
+        label = name.replace(" ", "_") if name else "(unnamed)"
+        log = {"path": os.path.join(self.output_dir, label, "log.txt") if name else None, "position": 0}
+        pending = {"compile_time": compile_time}  # module type checking, counted with the next contract
+        contracts = {}  # static id -> origination event
+        original_action = scenario.action
+
+        def new_step():
+            """(step, contract id) of the first step file the log mentions since the last call."""
+            if log["path"] is None or not os.path.isfile(log["path"]):
+                return None, None
+            with open(log["path"]) as f:
+                f.seek(log["position"])
+                text = f.read()
+                log["position"] = f.tell()
+            for line in text.splitlines():
+                match = scenarios.STEP_FILE.search(line) if line.startswith("file ") else None
+                if match:
+                    return int(match.group(1)), int(match.group(2))
+            return None, None
+
+        def action(data):
+            kind = data.get("action")
+            if kind not in ACTIONS:
+                return original_action(data)
+            profiler.forward_trace()  # output of the scenario code itself
+            start = time.perf_counter()
+            try:
+                result = original_action(data)
+            finally:
+                duration = time.perf_counter() - start
+                trace_size, trace_time = profiler.forward_trace()
+                step, contract_id = new_step()
+            if kind == "add_module":
+                pending["compile_time"] += duration
+                return result
+            if kind == "instantiateContract":
+                event = profiler.event(label, data["name"], "origination")
+                event["compile_time"] += pending["compile_time"]
+                pending["compile_time"] = 0.0
+                contracts[result["id"]["static_id"]] = event
+            elif kind == "originateContract" and static_id(data["id"]) in contracts:
+                event = contracts[static_id(data["id"])]
+            elif kind == "message":
+                origination = contracts.get(static_id(data["id"]))
+                event = profiler.event(label, origination["contract"] if origination else data["id"], data["message"])
+            else:
+                event = profiler.event(label, "(scenario)", kind)
+            event[ACTIONS[kind] + "_time"] += duration
+            event["trace_time"] += trace_time
+            event["trace_size"] += trace_size
+            if step is not None:
+                event["step"], event["contract_id"] = step, contract_id
+            return result
+
+        scenario.action = action
+        return scenario
+
+    def run(self, path, root = scenarios.ROOT):
+        """Profiles the scenarios of one file, which write their outputs in a temporary directory."""
+        import smartpy as sp
+        from smartpy.internal import modules
+
+        profiler = self
+        original_test_scenario = sp.test_scenario
+        original_parse = modules.parse_via_exe_or_js
+
+        def test_scenario(*args, **kwargs):
+            name = args[0] if args else kwargs.get("name")
+            start = time.perf_counter()
+            scenario = original_test_scenario(*args, **kwargs)
+            return profiler.wrap_scenario(scenario, name, time.perf_counter() - start)
+
+        def parse(*args, **kwargs):
+            start = time.perf_counter()
+            result = original_parse(*args, **kwargs)
+            module_name = result[0]  # the result is (module name, sexpr, elements, imports)
+            profiler.event("(modules)", module_name, "parse")["compile_time"] += time.perf_counter() - start
+            return result
+
+        self.file = path
+        cwd = os.getcwd()
+        output_dir = os.environ.get("SMARTPY_OUTPUT_DIR")
+        sp.test_scenario = test_scenario
+        modules.parse_via_exe_or_js = parse
+        sys.path[:0] = [os.path.dirname(os.path.join(root, path)), root]
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                # the SmartPy runtime resolves relative output paths against its own directory
+                self.output_dir = os.environ["SMARTPY_OUTPUT_DIR"] = directory
+                os.chdir(directory)
+                runpy.run_path(os.path.join(root, path), run_name = "__main__")
+        finally:
+            os.chdir(cwd)
+            if output_dir is None:
+                os.environ.pop("SMARTPY_OUTPUT_DIR", None)
+            else:
+                os.environ["SMARTPY_OUTPUT_DIR"] = output_dir
+            del sys.path[:2]
+            sp.test_scenario = original_test_scenario
+            modules.parse_via_exe_or_js = original_parse
+
+    def add_gas(self, report_rows):
+        """Copies the gas of the benchmark rows onto the events of the same step."""
+        gas = {(row["file"], row["scenario"], row["step"], row["contract"]): row["gas"] for row in report_rows}
+        for event in self.events:
+            if event["step"] is not None:
+                event["gas"] = gas.get((event["file"], event["scenario"], event["step"], event["contract_id"]))
+
+    def folded(self):
+        lines = collections.Counter()
+        for event in self.events:
+            for phase in PHASES:
+                stack = ";".join([event["file"], event["scenario"], event["contract"], event["entrypoint"], phase])
+                lines[stack] += int(event[phase + "_time"] * 1e6)
+        return ["%s %d" % (stack, value) for stack, value in sorted(lines.items()) if value]
+
+    def summary(self):
+        result = {}
+        for event in self.events:
+            contract = result.setdefault(event["contract"], {})
+            stats = contract.setdefault(event["entrypoint"], dict({"calls": 0, "trace_size": 0, "gas": None},
+                                                                  **{phase + "_time": 0.0 for phase in PHASES}))
+            stats["calls"] += 1
+            for phase in PHASES:
+                stats[phase + "_time"] += event[phase + "_time"]
+            stats["trace_size"] += event["trace_size"]
+            if event["gas"] is not None:  # gas stays None unless a benchmark row matched
+                stats["gas"] = (stats["gas"] or 0) + event["gas"]
+        return result
+
+
+def static_id(contract_id):
+    """Static id of an exported contract id such as `(("main.py" 20) static_id 0)`."""
+    match = STATIC_ID.search(contract_id)
+    return int(match.group(1)) if match else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("files", nargs = "*", help = "scenario files (default: all of them)")
+    parser.add_argument("--folded", default = "profile.folded", help = "folded stacks output")
+    parser.add_argument("--summary", default = "profile.json", help = "per contract and entrypoint summary")
+    parser.add_argument("--gas-report", help = "tools/benchmark.py report to take the gas from")
+    args = parser.parse_args()
+    paths = [os.path.relpath(os.path.abspath(path), scenarios.ROOT) for path in args.files] or scenarios.discover()
+
+    trace = TraceCapture()
+    profiler = Profiler(trace)
+    failed = []
+    try:
+        for path in paths:
+            try:
+                profiler.run(path)
+            except Exception as e:
+                print("FAILED %s: %s" % (path, e), file = sys.stderr)
+                failed.append(path)
+    finally:
+        trace.close()
+    if args.gas_report:
+        import benchmark
+        profiler.add_gas(benchmark.read_report(args.gas_report))
+    with open(args.folded, "w") as f:
+        f.write("\n".join(profiler.folded()) + "\n")
+    with open(args.summary, "w") as f:
+        json.dump(profiler.summary(), f, indent = 1, sort_keys = True)
+    print("%d steps profiled, %d files failed" % (len(profiler.events), len(failed)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
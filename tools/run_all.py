@@ -0,0 +1,82 @@
+"""Runs all the course scenarios in parallel.
+
+Each file runs in its own Python process and output directory (see
+`scenarios.run`), on as many workers as there are CPU cores. Files are
+started longest first, using the durations recorded by the previous runs,
+so that the whole run takes about as long as the slowest file. Files with
+no recorded duration are started first.
+
+    python tools/run_all.py
+    python tools/run_all.py Exercices/*.py --jobs 4
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import scenarios
+
+DURATIONS = os.path.join(scenarios.ROOT, ".scenario_durations.json")
+
+
+def read_durations(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def schedule(paths, durations):
+    """Orders the paths longest first, unknown durations first of all."""
+    return sorted(paths, key = lambda path: -durations.get(path, float("inf")))
+
+
+def run_all(paths, output_root, jobs, durations, timeout = None):
+    results = []
+    # every scenario already runs in its own process: the workers only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+        futures = [executor.submit(scenarios.run, path, output_root, timeout = timeout)
+                   for path in schedule(paths, durations)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            status = "ok" if result["returncode"] == 0 else "FAILED"
+            print("%-6s %6.1fs  %s" % (status, result["duration"], result["file"]), flush = True)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("files", nargs = "*", help = "scenario files (default: all of them)")
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(), help = "number of files run at once")
+    parser.add_argument("--output-dir", default = "test_output", help = "root of the per-file output directories")
+    parser.add_argument("--durations", default = DURATIONS, help = "durations recorded by the previous runs")
+    parser.add_argument("--timeout", type = float, help = "seconds after which a file is stopped")
+    args = parser.parse_args()
+
+    paths = [os.path.relpath(os.path.abspath(path), scenarios.ROOT) for path in args.files] or scenarios.discover()
+    durations = read_durations(args.durations)
+    start = time.perf_counter()
+    results = run_all(paths, args.output_dir, args.jobs, durations, args.timeout)
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        durations[result["file"]] = result["duration"]
+    with open(args.durations, "w") as f:
+        json.dump(durations, f, indent = 1, sort_keys = True)
+
+    failed = sorted((result for result in results if result["returncode"] != 0), key = lambda result: result["file"])
+    for result in failed:
+        print("\n== %s ==\n%s" % (result["file"], result["stderr"]))
+    slowest = max(results, key = lambda result: result["duration"], default = None)
+    print("%d passed, %d failed in %.1fs (%.1fs of scenarios on %d workers%s)"
+          % (len(results) - len(failed), len(failed), elapsed, sum(result["duration"] for result in results), args.jobs,
+             ", slowest: %s %.1fs" % (slowest["file"], slowest["duration"]) if slowest else ""))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Operations stream of the course scenarios, as read by tools/indexer.py.
+
+Every origination and every applied call of a scenario, internal calls
+included, becomes one JSON line of the indexer, in application order:
+
+    {"contract": "KT1...", "kind": "FA2Token", "entrypoint": "mint",
+     "sender": "tz1...", "amount": 0, "params": "Alice NFT 1"}
+
+Values are decoded from the Micheline the SmartPy runtime returns for each
+step, with the annotated types of the contract: a record becomes an object,
+a variant a one key object, a map a list of [key, value] pairs, a nat, int,
+mutez or timestamp a number. The parameter of an entrypoint with one
+argument is that argument, as in the contract; the params of an origination
+are its initial storage. Calls meant to fail are left out.
+
+    python tools/scenario_operations.py Examples/20_fa2_markeplace.py > operations.jsonl
+    python tools/scenario_operations.py Exercices/33_oracle_binarybets_solution.py --scenario Testing \\
+        | python tools/indexer.py - --db bets.sqlite
+
+The scenarios of a file originate their contracts at the same addresses, so
+one scenario is written at a time: the first one, or the one named by
+--scenario. A scenario can also record itself, to check what it indexes:
+
+    recorder = scenario_operations.Recorder(scenario)
+    ...
+    indexer.index((json.dumps(operation) for operation in recorder.operations), db)
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import runpy
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_ID = re.compile(r"static_id (\d+)")
+
+
+def annotation(type_):
+    for annot in type_.get("annots", []):
+        if annot.startswith("%"):
+            return annot[1:]
+    return None
+
+
+def pair_fields(type_, value):
+    """(type, value) of the fields of a pair type, nested pairs without annotation included."""
+    args = value["args"] if isinstance(value, dict) else value
+    if len(args) > 2:  # comb written as (Pair a b c)
+        args = [args[0], {"prim": "Pair", "args": args[1:]}]
+    for field_type, field_value in zip(type_["args"], args):
+        if field_type["prim"] == "pair" and annotation(field_type) is None:
+            yield from pair_fields(field_type, field_value)
+        else:
+            yield field_type, field_value
+
+
+def decode(type_, value):
+    """Python value of the Micheline value of an annotated Michelson type."""
+    prim = type_["prim"]
+    args = type_.get("args", [])
+    if prim in ("int", "nat", "mutez"):
+        return int(value["int"])
+    if prim == "timestamp":
+        return int(value["int"]) if "int" in value else value["string"]
+    if prim == "bool":
+        return value["prim"] == "True"
+    if prim == "unit":
+        return None
+    if prim == "bytes":
+        return value["bytes"]
+    if prim == "option":
+        return None if value["prim"] == "None" else decode(args[0], value["args"][0])
+    if prim in ("list", "set"):
+        return [decode(args[0], element) for element in value]
+    if prim in ("map", "big_map"):
+        if not isinstance(value, list):  # id of a big_map
+            return int(value["int"])
+        return [[decode(args[0], element["args"][0]), decode(args[1], element["args"][1])] for element in value]
+    if prim == "or":
+        branch = args[0] if value["prim"] == "Left" else args[1]
+        return {annotation(branch) or value["prim"]: decode(branch, value["args"][0])}
+    if prim == "pair":
+        fields = list(pair_fields(type_, value))
+        names = [annotation(field_type) for field_type, _ in fields]
+        decoded = [decode(field_type, field_value) for field_type, field_value in fields]
+        return dict(zip(names, decoded)) if all(names) else decoded
+    if isinstance(value, dict) and ("string" in value or "bytes" in value):
+        return value.get("string", value.get("bytes"))  # address, key, signature, contract...
+    return value  # lambdas and other code
+
+
+def entrypoint_argument(parameter_type, value, entrypoint):
+    """Decoded argument of entrypoint in the value of the whole parameter of a contract."""
+    while annotation(parameter_type) != entrypoint and parameter_type["prim"] == "or":
+        parameter_type = parameter_type["args"][0 if value["prim"] == "Left" else 1]
+        value = value["args"][0]
+    return decode(parameter_type, value)
+
+
+class Recorder:
+    """Operations of one scenario, recorded by shadowing its `action` method."""
+
+    def __init__(self, scenario):
+        self.operations = []
+        self.classes = {}    # static id -> class name
+        self.contracts = {}  # address -> (class name, parameter type)
+        original_action = scenario.action
+
+        def action(data):
+            result = original_action(data)
+            kind = data.get("action")
+            if kind == "instantiateContract":
+                self.classes[result["id"]["static_id"]] = data["name"]
+            elif kind == "originateContract":
+                self.originated(data, result)
+            elif kind == "message" and result["node_status"] == ["TopMessage", ["Pass"]]:
+                self.called(result)  # the call and all the calls it made were applied
+            return result
+
+        scenario.action = action
+
+    def originated(self, data, result):
+        match = STATIC_ID.search(data["id"])
+        name = self.classes.get(int(match.group(1))) if match else None
+        types = {section["prim"]: section["args"][0] for section in json.loads(result["code_micheline"])}
+        self.contracts[result["address"]] = (name, types["parameter"])
+        self.operations.append({
+            "contract": result["address"],
+            "kind": name,
+            "entrypoint": "origination",
+            "sender": None,
+            "amount": int(result["balance"]),
+            "params": decode(types["storage"], json.loads(result["initial_storage_micheline"])),
+        })
+
+    def called(self, node):
+        """Adds the call of a message node, then the calls it made, in the order they were applied."""
+        message = node["message"]
+        if message["receiver"] in self.contracts:
+            name, parameter_type = self.contracts[message["receiver"]]
+            self.operations.append({
+                "contract": message["receiver"],
+                "kind": name,
+                "entrypoint": message["entrypoint"],
+                "sender": message["sender"] or None,  # empty when the scenario gives no _sender
+                "amount": int(message["amount"]),
+                "params": entrypoint_argument(parameter_type, json.loads(message["arg_micheline"]), message["entrypoint"]),
+            })
+        for sub_kind, sub_node in node["sub_results"]:
+            if sub_kind == "Message_node":
+                self.called(sub_node)
+
+
+def run(path, root = ROOT):
+    """Runs the scenarios of one file in a temporary directory, returns the operations of each, by name."""
+    import smartpy as sp
+
+    recorded = {}
+    original_test_scenario = sp.test_scenario
+
+    def test_scenario(*args, **kwargs):
+        scenario = original_test_scenario(*args, **kwargs)
+        name = args[0] if args else kwargs.get("name")
+        recorded[name] = Recorder(scenario).operations
+        return scenario
+
+    cwd = os.getcwd()
+    output_dir = os.environ.get("SMARTPY_OUTPUT_DIR")
+    sp.test_scenario = test_scenario
+    sys.path[:0] = [os.path.dirname(os.path.join(root, path)), root]
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # the SmartPy runtime resolves relative output paths against its own directory
+            os.environ["SMARTPY_OUTPUT_DIR"] = directory
+            os.chdir(directory)
+            with contextlib.redirect_stdout(sys.stderr):  # stdout is left to the operations
+                runpy.run_path(os.path.join(root, path), run_name = "__main__")
+    finally:
+        os.chdir(cwd)
+        if output_dir is None:
+            os.environ.pop("SMARTPY_OUTPUT_DIR", None)
+        else:
+            os.environ["SMARTPY_OUTPUT_DIR"] = output_dir
+        del sys.path[:2]
+        sp.test_scenario = original_test_scenario
+    return recorded
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("file", help = "scenario file")
+    parser.add_argument("--scenario", help = "name of the scenario (default: the first one)")
+    args = parser.parse_args()
+    recorded = run(os.path.relpath(os.path.abspath(args.file), ROOT))
+    if not recorded:
+        sys.exit("no scenario in %s" % args.file)
+    name = args.scenario if args.scenario is not None else next(iter(recorded))
+    if name not in recorded:
+        sys.exit("no scenario %r in %s: %s" % (name, args.file, ", ".join(map(repr, recorded))))
+    for operation in recorded[name]:
+        print(json.dumps(operation))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Discovery and isolated execution of the course SmartPy scenarios.
+
+Every contract file of the course is a standalone script: running it with a
+Python that has SmartPy installed executes its `@sp.add_test()` functions and
+writes the scenario outputs (log, compiled contracts, storages, parameters)
+in the working directory. The helpers below copy each file to its own output
+directory before running it, so that runs never write into the source tree
+and can safely happen side by side.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIO_DIRS = ["Examples", "Exercices", "Big_exercise", "exercise_starting_templates", "other_high_level_languages"]
+ADD_TEST = re.compile(r"^@sp\.add_test\(", re.MULTILINE)
+STEP_FILE = re.compile(r"step_(\d+)_cont_(\d+)_(\w+)\.(tz|json|csv|py)$")
+
+
+def discover(root = ROOT):
+    """Returns the paths, relative to root, of all files declaring a scenario."""
+    candidates = [name for name in os.listdir(root) if name.endswith(".py")]
+    for directory in SCENARIO_DIRS:
+        for name in os.listdir(os.path.join(root, directory)):
+            if name.endswith(".py"):
+                candidates.append(os.path.join(directory, name))
+    paths = []
+    for path in sorted(candidates):
+        full_path = os.path.join(root, path)
+        if os.path.isfile(full_path):
+            with open(full_path) as f:
+                if ADD_TEST.search(f.read()):
+                    paths.append(path)
+    return paths
+
+
+def run(path, output_root, root = ROOT, python = sys.executable, timeout = None, flags = None):
+    """Runs the scenarios of one file in its own output directory.
+
+    flags are extra SmartPy flags, such as "--mode mockup". Returns a dict with the file, its output directory, the exit code, the
+    wall time in seconds and the captured stdout/stderr.
+    """
+    output_dir = os.path.join(output_root, os.path.splitext(path)[0])
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    script = os.path.join(output_dir, os.path.basename(path))
+    shutil.copyfile(os.path.join(root, path), script)
+    # the copied script still imports the helper modules sitting next to the original
+    source_dir = os.path.dirname(os.path.join(root, path))
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [source_dir, root, os.environ.get("PYTHONPATH")])))
+    if flags:
+        env["SMARTPY_FLAGS"] = flags
+    start = time.perf_counter()
+    try:
+        process = subprocess.run([python, os.path.basename(script)], cwd = output_dir, env = env,
+                                 capture_output = True, text = True, timeout = timeout)
+        returncode, stdout, stderr = process.returncode, process.stdout, process.stderr
+    except subprocess.TimeoutExpired as e:
+        returncode, stdout, stderr = None, e.stdout or "", "timeout after %ss" % timeout
+    return {
+        "file": path,
+        "output_dir": output_dir,
+        "returncode": returncode,
+        "duration": time.perf_counter() - start,
+        "stdout": stdout,
+        "stderr": stderr,
+    }
+
+
+def step_files(output_dir):
+    """Yields (scenario, step, contract, kind, path) for every step output file."""
+    for directory, _, names in os.walk(output_dir):
+        scenario = os.path.relpath(directory, output_dir)
+        for name in sorted(names):
+            match = STEP_FILE.search(name)
+            if match:
+                step, contract, kind, extension = match.groups()
+                yield scenario, int(step), int(contract), kind + "." + extension, os.path.join(directory, name)
@@ -0,0 +1,210 @@
+"""Release builds of the course contracts, without their trace calls.
+
+`trace(...)` and `sp.trace(...)` statements help following a scenario, but
+every one of them is interpreted again on each call. The debug scenarios keep
+them; this tool writes a release copy of scenario files in which the trace
+statements of the `@sp.module` functions are removed (a block left empty
+gets a `pass`), together with the course modules and packages they import,
+such as defi_contracts.py or tools:
+
+    python tools/strip_traces.py build Exercices/32_04_manipulating_price_solution.py --output-dir release
+
+Files that don't parse as Python, such as the starting templates with blanks
+left to the students, are copied unchanged with a warning.
+
+The release copy is what gets compiled for deployment: running it writes the
+Michelson of its contracts like any scenario. `compare` runs both builds and
+reports, for every origination and call, the contract size and the gas of
+each, as well as the wall time of each file. Gas is only measured in mockup
+mode, as for tools/benchmark.py; `--mode native` compares the sizes only:
+
+    python tools/strip_traces.py compare --report traces.csv
+    python tools/strip_traces.py compare --mode native --report sizes.csv
+"""
+
+import argparse
+import ast
+import csv
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import benchmark
+import scenarios
+
+IMPORT = re.compile(r"^from (\w+) import", re.MULTILINE)
+FIELDS = ["file", "scenario", "step", "contract", "kind", "entrypoint",
+          "size_debug", "size_release", "gas_debug", "gas_release"]
+
+
+def is_trace(statement):
+    if not (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call)):
+        return False
+    function = statement.value.func
+    return (isinstance(function, ast.Name) and function.id == "trace"
+            or isinstance(function, ast.Attribute) and function.attr == "trace"
+            and isinstance(function.value, ast.Name) and function.value.id == "sp")
+
+
+def strip(source):
+    """Source without the trace statements of its SmartPy modules, and their number."""
+    tree = ast.parse(source)
+    removed = {}  # first line -> (last line, replacement)
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.FunctionDef) and any("module" in ast.unparse(d) for d in node.decorator_list)):
+            continue
+        for block in ast.walk(node):
+            for field in ["body", "orelse", "finalbody"]:
+                statements = getattr(block, field, None)
+                if not isinstance(statements, list) or not statements or not isinstance(statements[0], ast.stmt):
+                    continue
+                traces = [s for s in statements if is_trace(s)]
+                for statement in traces:
+                    removed[statement.lineno] = (statement.end_lineno, None)
+                if traces and len(traces) == len(statements):
+                    first = traces[0]
+                    removed[first.lineno] = (first.end_lineno, " " * first.col_offset + "pass")
+    lines = source.splitlines(keepends = True)
+    output = []
+    number = 0
+    while number < len(lines):
+        if number + 1 in removed:
+            last, replacement = removed[number + 1]
+            if replacement is not None:
+                output.append(replacement + "\n")
+            number = last
+        else:
+            output.append(lines[number])
+            number += 1
+    return "".join(output), len(removed)
+
+
+def build(path, build_root, root = scenarios.ROOT):
+    """Writes the release copy of path, and of the course modules it imports, under build_root."""
+    source_path = os.path.join(root, path)
+    with open(source_path) as f:
+        source = f.read()
+    copies = [(source_path, os.path.join(build_root, path))]
+    for name in IMPORT.findall(source):
+        for directory in [os.path.dirname(path), ""]:
+            candidate = os.path.join(root, directory, name)
+            if os.path.isfile(candidate + ".py"):
+                copies.append((candidate + ".py", os.path.join(build_root, directory, name + ".py")))
+                break
+            if os.path.isdir(candidate):
+                # a package, such as tools: its Python files, which may import each other
+                for package_dir, subdirs, names in os.walk(candidate):
+                    subdirs[:] = [subdir for subdir in subdirs if subdir != "__pycache__"]
+                    for file_name in names:
+                        if file_name.endswith(".py"):
+                            copy = os.path.join(package_dir, file_name)
+                            copies.append((copy, os.path.join(build_root, os.path.relpath(copy, root))))
+                break
+    nb_traces = 0
+    for source_file, target_file in copies:
+        with open(source_file) as f:
+            source = f.read()
+        try:
+            stripped, removed = strip(source)
+        except SyntaxError as e:
+            print("warning: %s: %s, copied unchanged" % (os.path.relpath(source_file, root), e.msg), file = sys.stderr)
+            stripped, removed = source, 0
+        nb_traces += removed
+        os.makedirs(os.path.dirname(target_file) or ".", exist_ok = True)
+        with open(target_file, "w") as f:
+            f.write(stripped)
+    return nb_traces
+
+
+def contract_sizes(output_dir):
+    return {(scenario, step, contract): os.path.getsize(file)
+            for scenario, step, contract, kind, file in scenarios.step_files(output_dir) if kind == "contract.tz"}
+
+
+def compare(paths, output_root, mode = "mockup"):
+    """Runs the debug and the release build of each file.
+
+    Returns the report rows, the durations and the files of which a build failed
+    or, in mockup mode, has an applied step with no gas receipt.
+    """
+    flags = benchmark.MODES[mode]
+    rows = []
+    durations = {}
+    failed = []
+    build_root = tempfile.mkdtemp()
+    try:
+        for path in paths:
+            build(path, build_root)
+            debug = scenarios.run(path, os.path.join(output_root, "debug"), flags = flags)
+            release = scenarios.run(path, os.path.join(output_root, "release"), root = build_root, flags = flags)
+            durations[path] = (debug["duration"], release["duration"])
+            for build_name, result in [("debug", debug), ("release", release)]:
+                if result["returncode"] != 0:
+                    failed.append(path)
+                    print("FAILED %s (%s build)\n%s" % (path, build_name, result["stderr"]), file = sys.stderr)
+            sizes = [contract_sizes(result["output_dir"]) for result in (debug, release)]
+            try:
+                release_rows = {(row["scenario"], row["step"], row["contract"]): row
+                                for row in benchmark.collect(release, require_gas = mode == "mockup")}
+                debug_rows = benchmark.collect(debug, require_gas = mode == "mockup")
+            except benchmark.MissingGas as e:
+                failed.append(path)
+                print("FAILED %s: %s" % (path, e), file = sys.stderr)
+                continue
+            for row in debug_rows:
+                key = (row["scenario"], row["step"], row["contract"])
+                release_row = release_rows.get(key, {})
+                rows.append({
+                    "file": path,
+                    "scenario": row["scenario"],
+                    "step": row["step"],
+                    "contract": row["contract"],
+                    "kind": row["kind"],
+                    "entrypoint": row["entrypoint"],
+                    "size_debug": sizes[0].get(key),
+                    "size_release": sizes[1].get(key),
+                    "gas_debug": row["gas"],
+                    "gas_release": release_row.get("gas"),
+                })
+    finally:
+        shutil.rmtree(build_root)
+    return rows, durations, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("command", choices = ["build", "compare"])
+    parser.add_argument("files", nargs = "*", help = "scenario files (default: all of them)")
+    parser.add_argument("--output-dir", default = "release", help = "root of the release copies, or of the scenario outputs")
+    parser.add_argument("--report", default = "traces.json", help = "comparison report, .json or .csv")
+    parser.add_argument("--mode", choices = sorted(benchmark.MODES), default = "mockup",
+                        help = "SmartPy simulation mode of compare: only mockup measures gas")
+    args = parser.parse_intermixed_args()  # options may come before or after the files
+    paths = [os.path.relpath(os.path.abspath(path), scenarios.ROOT) for path in args.files] or scenarios.discover()
+
+    if args.command == "build":
+        for path in paths:
+            print("%4d traces removed from %s" % (build(path, args.output_dir), path))
+        return
+
+    rows, durations, failed = compare(paths, args.output_dir, args.mode)
+    if args.report.endswith(".csv"):
+        with open(args.report, "w", newline = "") as f:
+            writer = csv.DictWriter(f, fieldnames = FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(args.report, "w") as f:
+            json.dump({"rows": rows, "durations": durations}, f, indent = 1, sort_keys = True)
+    for path, (debug, release) in sorted(durations.items()):
+        changed = [row for row in rows if row["file"] == path
+                   and (row["size_debug"] != row["size_release"] or row["gas_debug"] != row["gas_release"])]
+        print("%-60s %6.1fs -> %6.1fs  %d steps changed" % (path, debug, release, len(changed)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()